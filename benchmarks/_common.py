@@ -0,0 +1,100 @@
+"""Общее для бенчмарков: окружение для импорта bot, замер задержек, синтетический каталог.
+
+Запуск из корня репозитория: python benchmarks/bench_<name>.py
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+_TMP = tempfile.mkdtemp(prefix="egirlz-bench-")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-token")
+os.environ.setdefault("GIRLS_MANIFEST_URL", "http://127.0.0.1:9/girls.json")
+os.environ["DB_PATH"] = os.path.join(_TMP, "bench.db")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+logging.disable(logging.INFO)  # миграции и старт не мешают выводу замеров
+
+
+def fresh_db() -> str:
+    bot.db_close()
+    path = os.path.join(_TMP, f"bench-{time.monotonic_ns()}.db")
+    bot.DB_PATH = path
+    bot.db_init()
+    return path
+
+
+def stats(samples_ms: List[float]) -> Dict[str, float]:
+    s = sorted(samples_ms)
+    return {
+        "p50": s[len(s) // 2],
+        "p95": s[min(len(s) - 1, int(len(s) * 0.95))],
+        "mean": sum(s) / len(s),
+    }
+
+
+def measure(fn: Callable[[], Any], n: int) -> Dict[str, float]:
+    out = []
+    for _ in range(n):
+        t = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t) * 1000)
+    return stats(out)
+
+
+async def measure_async(fn: Callable[[], Any], n: int) -> Dict[str, float]:
+    out = []
+    for _ in range(n):
+        t = time.perf_counter()
+        await fn()
+        out.append((time.perf_counter() - t) * 1000)
+    return stats(out)
+
+
+def report(label: str, st: Dict[str, float], unit: str = "ms"):
+    print(f"{label:<34} p50 {st['p50']:9.3f}{unit}  p95 {st['p95']:9.3f}{unit}  mean {st['mean']:9.3f}{unit}")
+
+
+def now() -> datetime:
+    return bot._msk_now_naive()
+
+
+def synthetic_manifest(n: int, seed: int = 1, slots_per_day: int = 3) -> Dict[str, Any]:
+    """Каталог из n анкет: цены, категории, игры, описание, ops_calendar на вчера..+3 дня."""
+    rnd = random.Random(seed)
+    syl = ["ka", "mi", "ra", "to", "li", "na", "se", "vo", "ya", "ro", "an", "el"]
+    cats = ["bestseller", "main", "chat", "games", "voice", "anime", "asmr", "cosplay"]
+    games = ["valorant", "dota-2", "cs2", "minecraft", "genshin-impact", "fortnite", "apex-legends"]
+    words = ("люблю играть вечером общаться смотреть аниме слушать музыку болтать шутить петь "
+             "стримы фильмы сериалы кофе кошки путешествия спорт книги гитара танцы").split()
+    base = now()
+    girls = []
+    for i in range(1, n + 1):
+        cal = []
+        for d in range(-1, 4):
+            day = f"{base + timedelta(days=d):%Y-%m-%d}"
+            slots = []
+            for _ in range(rnd.randint(0, slots_per_day)):
+                h = rnd.randint(0, 22)
+                slots.append({"start": f"{h:02d}:00", "end": f"{h + 1:02d}:00"})
+            cal.append({"date": day, "slots": slots})
+        girls.append({
+            "id": i,
+            "name": "".join(rnd.choice(syl) for _ in range(rnd.randint(2, 4))).capitalize(),
+            "price": rnd.choice([None, 300, 500, 700, 1000, 1500, 2500, 4000]),
+            "category_slugs": rnd.sample(cats, rnd.randint(0, 3)),
+            "ops_calendar": cal,
+            "acf": {
+                "favorite_games": [f"https://x/img/{g}.png" for g in rnd.sample(games, rnd.randint(0, 2))],
+                "achievements": ["x"] * rnd.randint(0, 1),
+                "description": " ".join(rnd.choice(words) for _ in range(rnd.randint(10, 30))),
+            },
+        })
+    return {"girls": girls}
@@ -0,0 +1,45 @@
+"""Прежний полный перебор каталога из _pick_recommendations (до RecoIndex) — эталон для bench_reco_index.py.
+
+Скопирован как был, только `now` передаётся явно, чтобы сравнение не зависело от часов.
+"""
+from datetime import datetime
+from typing import Any, Dict, List
+
+from _common import bot
+
+
+def pick_recommendations(mf: Dict[str, Any], viewed_ids: List[int], now: datetime, limit: int = 3) -> List[Any]:
+    recs = bot.girl_recs(mf)
+    uniq_viewed = list(dict.fromkeys(viewed_ids))
+    viewed_girls = [g for g in (bot.girl_rec(mf, gid) for gid in uniq_viewed) if g]
+    if len(uniq_viewed) < 2 or len(viewed_girls) < 2:
+        return []
+    pref_tokens: Dict[str, int] = {}
+    prices: List[float] = []
+    for vg in viewed_girls:
+        for t in vg.style:
+            pref_tokens[t] = pref_tokens.get(t, 0) + 1
+        if vg.price is not None:
+            prices.append(vg.price)
+    target_price = (sum(prices) / len(prices)) if prices else None
+    viewed_set = set(uniq_viewed)
+    scored = []
+    for rec in recs:
+        if rec.gid in viewed_set:
+            continue
+        score = 0.0
+        for t in rec.style:
+            score += pref_tokens.get(t, 0) * 1.5
+        if target_price is not None and rec.price is not None:
+            diff = abs(rec.price - target_price)
+            if diff <= 100:
+                score += 3.0
+            elif diff <= 300:
+                score += 2.0
+            elif diff <= 600:
+                score += 1.0
+        if rec.slots.first(now) is not None:
+            score += 0.5
+        scored.append((score, rec.view))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [cand for score, cand in scored if score > 0][:limit]
@@ -0,0 +1,111 @@
+"""Прежние парсеры слотов (до SlotIndex) — эталон для bench_slot_index.py.
+
+Скопированы как были, только `now` передаётся явно, чтобы сравнение не зависело от часов.
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _parse_slot_dt(date_s: Optional[str], time_s: Optional[str]) -> Optional[datetime]:
+    if not date_s or not time_s:
+        return None
+    try:
+        return datetime.strptime(f"{date_s} {time_s}", "%Y-%m-%d %H:%M")
+    except Exception:
+        return None
+
+
+def today_slots(g: Dict[str, Any], now: datetime) -> List[Tuple[datetime, str]]:
+    today_s = now.strftime("%Y-%m-%d")
+    out: List[Tuple[datetime, str]] = []
+    seen: set[str] = set()
+    for day in (g.get("ops_calendar") or []):
+        if str(day.get("date")) != today_s:
+            continue
+        for s in (day.get("slots") or []):
+            if s.get("available", True) is False:
+                continue
+            start = str(s.get("start") or "").strip()
+            end = str(s.get("end") or "").strip()
+            if not start or not end or start == end:
+                continue
+            dt = _parse_slot_dt(today_s, start)
+            if not dt or dt < now:
+                continue
+            key = f"{today_s}|{start}|{end}"
+            if key in seen:
+                continue
+            seen.add(key)
+            out.append((dt, f"{start} - {end}"))
+    out.sort(key=lambda x: x[0])
+    return out
+
+
+def collect_available_slots(g: Dict[str, Any], slots: Dict[str, Any], now: datetime) -> List[str]:
+    items: List[Tuple[datetime, str]] = []
+    seen: set[str] = set()
+
+    def _push(date_s, start, end, label, available=True):
+        if available is False:
+            return
+        start = (start or "").strip()
+        end = (end or "").strip()
+        if not start or not end or start == end:
+            return
+        dt = _parse_slot_dt(date_s, start)
+        if not dt or dt < now:
+            return
+        label_core = (label or f"{start} - {end}").strip()
+        try:
+            day = datetime.strptime(date_s or "", "%Y-%m-%d").strftime("%d.%m")
+            pretty = f"{day} {label_core}"
+        except Exception:
+            pretty = label_core
+        key = f"{dt.isoformat()}::{pretty}"
+        if key in seen:
+            return
+        seen.add(key)
+        items.append((dt, pretty))
+
+    for day in (g.get("ops_calendar") or []):
+        date_s = day.get("date")
+        for s in (day.get("slots") or []):
+            _push(s.get("date") or date_s, s.get("start"), s.get("end"), s.get("label"), s.get("available", True))
+    for s in (slots.get("slots") or []):
+        _push(s.get("date"), s.get("start"), s.get("end"), s.get("label"), s.get("available", True))
+    items.sort(key=lambda x: x[0])
+    return [lbl for _, lbl in items]
+
+
+def collect_available_slot_keys(g: Dict[str, Any], slots: Dict[str, Any], now: datetime) -> List[str]:
+    keys: List[Tuple[datetime, str]] = []
+    seen: set[str] = set()
+
+    def _push(date_s, start, end, available=True):
+        if available is False:
+            return
+        start = (start or "").strip()
+        end = (end or "").strip()
+        if not start or not end or start == end:
+            return
+        dt = _parse_slot_dt(date_s, start)
+        if not dt or dt < now:
+            return
+        key = f"{date_s}|{start}|{end}"
+        if key in seen:
+            return
+        seen.add(key)
+        keys.append((dt, key))
+
+    for day in (g.get("ops_calendar") or []):
+        date_s = day.get("date")
+        for s in (day.get("slots") or []):
+            _push(s.get("date") or date_s, s.get("start"), s.get("end"), s.get("available", True))
+    for s in (slots.get("slots") or []):
+        _push(s.get("date"), s.get("start"), s.get("end"), s.get("available", True))
+    keys.sort(key=lambda x: x[0])
+    return [k for _, k in keys]
+
+
+def has_future_slots(g: Dict[str, Any], now: datetime) -> bool:
+    return len(collect_available_slots(g, {}, now)) > 0
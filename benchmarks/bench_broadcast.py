@@ -0,0 +1,91 @@
+"""Движок рассылки против прежнего цикла send_message + sleep(0.05).
+
+Локальный фейковый Bot API (aiohttp) отвечает с задержкой LATENCY. Движок
+меряется при штатном лимите TG_GLOBAL_RATE и со снятым лимитом.
+"""
+import asyncio
+import sqlite3
+import time
+
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+
+from _common import bot, fresh_db
+
+LATENCY = 0.03
+RECIPIENTS = 600
+
+
+async def _fake_api():
+    calls = []
+    counter = [0]
+
+    async def handler(req):
+        await asyncio.sleep(LATENCY)
+        data = await req.post()
+        calls.append(req.match_info["method"])
+        counter[0] += 1
+        chat = int(data.get("chat_id") or 1)
+        return web.json_response({"ok": True, "result": {
+            "message_id": counter[0], "date": 0, "chat": {"id": chat, "type": "private"}, "text": "x",
+        }})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    bot.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    return runner, calls
+
+
+def _seed_users(path, n):
+    con = sqlite3.connect(path)
+    now = int(time.time())
+    con.executemany("INSERT INTO users(chat_id, added_at, last_seen) VALUES (?,?,?)",
+                    [(1000 + i, now, now) for i in range(n)])
+    con.commit()
+    con.close()
+
+
+async def engine(label):
+    path = fresh_db()
+    _seed_users(path, RECIPIENTS)
+    t = time.perf_counter()
+    job_id = await bot.broadcast_start(1, "all", "hi", None, [])
+    while job_id in bot._BCAST_TASKS:
+        await asyncio.sleep(0.01)
+    el = time.perf_counter() - t
+    job = await bot.db_bcast_job_get(job_id)
+    print(f"{label:<34} {job['sent']} sent in {el:6.2f}s = {job['sent'] / el:7.1f} msg/s ({job['status']})")
+    await bot.db_writer_stop()
+
+
+async def main():
+    runner, calls = await _fake_api()
+    path = fresh_db()
+    _seed_users(path, RECIPIENTS)
+    n_old = 100  # прежний цикл линейный — хватает выборки
+    t = time.perf_counter()
+    with bot.tg_lane("broadcast"):
+        for uid in range(1000, 1000 + n_old):
+            await bot.bot.send_message(uid, "hi")
+            await asyncio.sleep(0.05)
+    el = time.perf_counter() - t
+    print(f"{'old loop (send + sleep 0.05)':<34} {n_old} sent in {el:6.2f}s = {n_old / el:7.1f} msg/s")
+    await bot.db_writer_stop()
+
+    await engine(f"engine @ TG_GLOBAL_RATE={bot.TG_GLOBAL_RATE:g}")
+    bot.TG_GLOBAL_RATE = bot._tg_tokens = 10_000.0
+    bot.TG_CHAT_RATE = 10_000.0
+    await engine("engine, limit lifted")
+
+    bot.db_close()
+    await bot.bot.session.close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
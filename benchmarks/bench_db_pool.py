@@ -0,0 +1,46 @@
+"""db_run на пуле долгоживущих соединений против connect()/close() на каждый вызов (как было)."""
+import asyncio
+import sqlite3
+
+from _common import bot, fresh_db, measure_async, report
+
+N = 2000
+
+
+async def main():
+    path = fresh_db()
+    con = sqlite3.connect(path)
+    con.executemany("INSERT INTO favorites(chat_id, girl_id, created_at) VALUES (?,?,?)",
+                    [(i, i % 300, 0) for i in range(20000)])
+    con.commit()
+    con.close()
+
+    def _query(con, chat_id):
+        return con.execute("SELECT 1 FROM favorites WHERE chat_id=? AND girl_id=? LIMIT 1",
+                           (chat_id, chat_id % 300)).fetchone() is not None
+
+    async def per_call():
+        def _op():
+            c = sqlite3.connect(path)
+            try:
+                return _query(c, 42)
+            finally:
+                c.close()
+        return await asyncio.to_thread(_op)
+
+    async def pooled():
+        return await bot.db_run(lambda c: _query(c, 42))
+
+    await pooled()
+    report("connect per call (to_thread)", await measure_async(per_call, N))
+    report("pooled db_run", await measure_async(pooled, N))
+    for label, fn in (("connect per call x200 concurrent", per_call), ("pooled db_run x200 concurrent", pooled)):
+        t = asyncio.get_running_loop().time()
+        await asyncio.gather(*(fn() for _ in range(200)))
+        print(f"{label:<34} {(asyncio.get_running_loop().time() - t) * 1000:9.1f}ms total")
+    await bot.db_writer_stop()
+    bot.db_close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""FilterEngine (битсеты + heap top-k) против прежнего линейного прохода мастера find:.
+
+Все 192 комбинации фильтров, часы закреплены; результаты обязаны совпасть.
+"""
+import itertools
+import time
+
+from _common import bot, now, report, stats, synthetic_manifest
+
+COMBOS = list(itertools.product(
+    ["any", "low", "mid", "high"], ["any", "popular", "gamer", "new"],
+    ["any", "today", "soon", "now"], ["any", "top", "safe"],
+))
+
+
+def linear_pick(mf, budget="any", style="any", date_pref="any", rating_pref="any", limit=7):
+    """_filter_pick_girls до FilterEngine: скоринг каждой анкеты на каждый запрос."""
+    out = []
+    t_now = bot._msk_now_naive()
+    timeline = bot.availability(mf)
+    today = timeline.free_today(t_now)
+    free_now = timeline.free_at(t_now) if date_pref == "now" else {}
+    for rec in bot.girl_recs(mf):
+        p = rec.price
+        if budget == "low" and (p is None or p > 500):
+            continue
+        if budget == "mid" and (p is None or p < 500 or p > 1000):
+            continue
+        if budget == "high" and (p is None or p < 1000):
+            continue
+        cats = rec.cats
+        if style == "popular" and not ({"bestseller", "main"} & cats):
+            continue
+        if style == "gamer" and not rec.has_games:
+            continue
+        if style == "new" and not rec.has_achievements:
+            continue
+        first_today = today.get(rec.gid)
+        has_today = first_today is not None
+        has_any = rec.slots.first(t_now) is not None
+        if date_pref == "today" and not has_today:
+            continue
+        if date_pref == "now" and rec.gid not in free_now:
+            continue
+        if date_pref == "soon" and not has_any:
+            continue
+        score = 0.0
+        if rating_pref == "top":
+            if "bestseller" in cats:
+                score += 3.0
+            if "main" in cats:
+                score += 2.0
+        elif rating_pref == "safe":
+            if "main" in cats:
+                score += 2.0
+            if "bestseller" in cats:
+                score += 1.0
+        if has_today:
+            score += 1.5
+            score += max(0.0, 0.6 - min(0.6, (first_today[0] - t_now).total_seconds() / 36000.0))
+        elif has_any:
+            score += 0.4
+        if p is not None:
+            score += max(0.0, 1.0 - min(1.0, p / 2500.0))
+        out.append((score, rec.view))
+    out.sort(key=lambda x: x[0], reverse=True)
+    return [g for _, g in out[:limit]]
+
+
+def main():
+    pinned = now()
+    bot._msk_now_naive = lambda: pinned
+    for n in (1000, 10_000):
+        mf = synthetic_manifest(n, seed=n)
+        bot.manifest_index(mf)
+        for c in COMBOS:
+            assert [g["id"] for g in linear_pick(mf, *c, limit=5)] == \
+                   [g["id"] for g in bot._filter_pick_girls(mf, *c, limit=5)], c
+        for label, fn in (("linear scan", linear_pick), ("FilterEngine", bot._filter_pick_girls)):
+            lat = []
+            for _ in range(3):
+                for c in COMBOS:
+                    t = time.perf_counter()
+                    fn(mf, *c, limit=5)
+                    lat.append((time.perf_counter() - t) * 1000)
+            report(f"{n} girls, {label}", stats(lat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Экран "Свободны сегодня": готовый ответ из кэша против сборки на каждый клик."""
+import _legacy_slots as legacy
+from _common import bot, measure, now, report, synthetic_manifest
+
+N_GIRLS = 5000
+CLICKS = 1000
+
+
+def legacy_rank(mf, pinned, limit=5):
+    """Как было до таймлайна: слоты на сегодня разбираются у каждой анкеты на каждый клик."""
+    ranked = []
+    for g in mf["girls"]:
+        today = legacy.today_slots(g, pinned)
+        if today:
+            ranked.append((today[0][0], g["id"], today[0][1]))
+    ranked.sort(key=lambda x: x[0])
+    return ranked[:limit]
+
+
+def main():
+    pinned = now().replace(hour=9, minute=0, second=0, microsecond=0)
+    bot._msk_now_naive = lambda: pinned
+    mf = synthetic_manifest(N_GIRLS)
+    bot._manifest_cache = mf
+    bot.manifest_index(mf)
+    text, _ = bot.free_today_view(mf)
+    assert [gid for _, gid, _ in legacy_rank(mf, pinned)] == [
+        int(g["id"]) for g in bot.pick_free_today(mf, limit=5)
+    ]
+
+    def rebuild():
+        bot.free_today_invalidate()
+        bot.free_today_view(mf)
+
+    print(f"{N_GIRLS} girls, {text.count(chr(10)) + 1} lines on screen")
+    report("rank by scanning calendars", measure(lambda: legacy_rank(mf, pinned), 50))
+    report("timeline rank + render per click", measure(rebuild, 200))
+    report("cached response", measure(lambda: bot.free_today_view(mf), CLICKS))
+
+
+if __name__ == "__main__":
+    main()
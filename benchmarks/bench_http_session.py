@@ -0,0 +1,84 @@
+"""Общая keep-alive сессия на апстрим против ClientSession + SSL-контекста на каждый запрос.
+
+Локальный HTTPS-стаб с самоподписанным сертификатом (нужен openssl в PATH;
+без него — обычный HTTP, тогда экономия только на TCP и сессии).
+"""
+import asyncio
+import os
+import ssl
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+os.environ["SSL_NO_VERIFY"] = "1"  # стаб с самоподписанным сертификатом
+
+from _common import bot, measure_async, report  # noqa: E402
+
+try:
+    import certifi
+except Exception:
+    certifi = None
+
+MANIFEST = {"girls": [{"id": i, "name": f"g{i}", "price": 1000 + i} for i in range(200)]}
+N = 300
+
+
+def _server_ssl() -> ssl.SSLContext | None:
+    d = tempfile.mkdtemp(prefix="egirlz-bench-tls-")
+    cert, key = os.path.join(d, "c.pem"), os.path.join(d, "k.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+            check=True, capture_output=True,
+        )
+    except Exception:
+        return None
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx
+
+
+async def main():
+    async def handler(req):
+        return web.json_response(MANIFEST)
+
+    app = web.Application()
+    app.router.add_get("/girls.json", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    server_ctx = _server_ssl()
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=server_ctx)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"{'https' if server_ctx else 'http'}://127.0.0.1:{port}/girls.json"
+    print(f"upstream: {url}")
+
+    async def per_call():
+        ctx = ssl.create_default_context(cafile=certifi.where() if certifi else None)
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ctx)) as s:
+            async with s.get(url, timeout=20) as r:
+                r.raise_for_status()
+                return await r.json()
+
+    async def shared():
+        return await bot.http_get_json(url)
+
+    for label, fn in (("session per call", per_call), ("shared upstream session", shared)):
+        await fn()
+        report(label, await measure_async(fn, N))
+        t = time.perf_counter()
+        await asyncio.gather(*(fn() for _ in range(100)))
+        print(f"{label + ' x100 concurrent':<34} {(time.perf_counter() - t) * 1000:9.1f}ms total")
+
+    await bot.http_close()
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
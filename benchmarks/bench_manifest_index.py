@@ -0,0 +1,46 @@
+"""Индекс снимка манифеста: girl_by_id/girl_by_index против прежнего прохода по списку с копией."""
+import random
+
+from _common import bot, measure, report, synthetic_manifest
+
+N_GIRLS = 10_000
+LOOKUPS = 2_000
+
+
+def scan_by_id(mf, gid):
+    arr = list(mf.get("girls", []))
+    total = len(arr)
+    for i, x in enumerate(arr):
+        if int(x.get("id")) == int(gid):
+            y = x.copy()
+            y["_index"] = i
+            y["_total"] = total
+            return y
+    return None
+
+
+def scan_by_index(mf, idx):
+    arr = list(mf.get("girls", []))
+    y = arr[idx % len(arr)].copy()
+    y["_index"] = idx % len(arr)
+    y["_total"] = len(arr)
+    return y
+
+
+def main():
+    mf = synthetic_manifest(N_GIRLS)
+    rnd = random.Random(7)
+    ids = [rnd.randint(1, N_GIRLS) for _ in range(LOOKUPS)]
+    it = iter(ids * 10)
+
+    report(f"index build ({N_GIRLS} girls)", measure(lambda: bot._build_manifest_index(mf), 3))
+    bot.manifest_index(mf)
+    assert all(bot.girl_by_id(mf, g)["_index"] == scan_by_id(mf, g)["_index"] for g in ids[:200])
+    report("girl_by_id: scan + copy", measure(lambda: scan_by_id(mf, next(it)), LOOKUPS))
+    report("girl_by_id: index", measure(lambda: bot.girl_by_id(mf, next(it)), LOOKUPS))
+    report("girl_by_index: list + copy", measure(lambda: scan_by_index(mf, next(it)), LOOKUPS))
+    report("girl_by_index: index", measure(lambda: bot.girl_by_index(mf, next(it)), LOOKUPS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Рекомендации: RecoIndex (холодные и прогретые строки матрицы) против полного перебора каталога."""
+import random
+
+import _legacy_reco as legacy
+from _common import bot, measure, now, report, synthetic_manifest
+
+HISTORIES = 200
+
+
+def run(n_girls: int, pinned):
+    mf = synthetic_manifest(n_girls)
+    ix = bot.manifest_index(mf)
+    ri = ix["reco"]
+    rnd = random.Random(n_girls)
+    histories = [[rnd.randint(1, n_girls) for _ in range(rnd.randint(2, 12))] for _ in range(HISTORIES)]
+    for viewed in histories:
+        got = [g["id"] for g in bot._pick_recommendations(mf, viewed)]
+        want = [g["id"] for g in legacy.pick_recommendations(mf, viewed, pinned)]
+        assert got == want, viewed
+
+    print(f"--- {n_girls} girls, {len(ri.sigs)} token signatures")
+    report("RecoIndex build", measure(lambda: bot._build_reco_index(ix["recs"]), 5))
+    it = iter(histories * 3)
+    report("full scan (old)", measure(lambda: legacy.pick_recommendations(mf, next(it), pinned), HISTORIES))
+
+    def cold():
+        ri.rows.clear()  # как сразу после смены версии манифеста
+        bot._pick_recommendations(mf, next(it))
+
+    it = iter(histories * 3)
+    report("RecoIndex, cold rows", measure(cold, HISTORIES))
+    it = iter(histories * 3)
+    report("RecoIndex, warm rows", measure(lambda: bot._pick_recommendations(mf, next(it)), HISTORIES))
+
+
+def main():
+    pinned = now()
+    bot._msk_now_naive = lambda: pinned
+    for n in (1_000, 10_000):
+        run(n, pinned)
+
+
+if __name__ == "__main__":
+    main()
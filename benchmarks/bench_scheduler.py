@@ -0,0 +1,133 @@
+"""Планировщик шагов: 100k отложенных задач в scheduled_jobs против спящей таски на шаг.
+
+Меряется память (tracemalloc) и CPU в простое, стоимость рестарта, постановки
+через writer и выгребания созревших задач.
+"""
+import asyncio
+import json
+import random
+import sqlite3
+import time
+import tracemalloc
+
+from _common import bot, fresh_db
+
+PENDING = 100_000
+IDLE_SEC = 5
+ADD_SAMPLE = 2_000
+
+
+def _mb(n: int) -> str:
+    return f"{n / (1024 * 1024):.2f} MB"
+
+
+def _seed(path: str, now: int):
+    rnd = random.Random(8)
+    payload = json.dumps({"girl_id": 1, "viewed_at": now})
+    con = sqlite3.connect(path)
+    con.executemany(
+        "INSERT INTO scheduled_jobs(run_at, kind, chat_id, campaign, payload, created_at) VALUES (?,?,?,?,?,?)",
+        [(now + rnd.randint(3600, 6 * 3600), "timesall_followup", 1000 + i, None, payload, now) for i in range(PENDING)],
+    )
+    con.commit()
+    con.close()
+
+
+def _reset():
+    bot._SCHED_HEAP = []
+    bot._SCHED_IDS = set()
+    bot._SCHED_LOADED_UNTIL = -1
+    bot._SCHED_RUNNING = 0
+
+
+async def _idle(label: str, start):
+    """start() поднимает хранение задач; дальше IDLE_SEC простоя."""
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t = time.perf_counter()
+    handle = await start()
+    took = time.perf_counter() - t
+    cpu = time.process_time()
+    await asyncio.sleep(IDLE_SEC)
+    cpu = time.process_time() - cpu
+    held = tracemalloc.get_traced_memory()[0] - base  # после простоя: окно уже загружено
+    tracemalloc.stop()
+    print(f"{label:<34} start {took:7.3f}s  live heap +{_mb(held):>10}  CPU {cpu:.3f}s over {IDLE_SEC}s idle")
+    return handle
+
+
+async def bench_scheduler(path: str):
+    _reset()
+
+    async def start():
+        return asyncio.create_task(bot.scheduler_dispatcher())
+
+    task = await _idle("scheduler_dispatcher", start)
+    print(f"{'  jobs held in memory':<34} {len(bot._SCHED_HEAP)} (horizon {bot.SCHED_HORIZON_SEC}s)")
+    task.cancel()
+
+    # рестарт: память пустая, в таблице те же 100k строк
+    _reset()
+    task = await _idle("restart with 100k rows", start)
+    task.cancel()
+
+    t = time.perf_counter()
+    now = int(time.time())
+    await asyncio.gather(*(bot.scheduler_add("timesall_followup", 1, now + 7200, payload={"girl_id": 1, "viewed_at": now})
+                           for _ in range(ADD_SAMPLE)))
+    print(f"{'scheduler_add via writer':<34} {(time.perf_counter() - t) / ADD_SAMPLE * 1e6:7.1f}µs per job")
+
+    # выгребание: всё созрело разом (например, бот лежал дольше задержек)
+    con = sqlite3.connect(path)
+    con.execute("UPDATE scheduled_jobs SET run_at=?", (now - 1,))
+    con.commit()
+    total = con.execute("SELECT COUNT(*) FROM scheduled_jobs").fetchone()[0]
+    fired = [0]
+
+    async def fire(chat_id, girl_id, viewed_at):
+        fired[0] += 1
+
+    bot._timesall_followup_fire = fire
+    _reset()
+    t, cpu = time.perf_counter(), time.process_time()
+    task = asyncio.create_task(bot.scheduler_dispatcher())
+    while fired[0] < total:
+        await asyncio.sleep(0.05)
+    wall, cpu = time.perf_counter() - t, time.process_time() - cpu
+    task.cancel()
+    left = con.execute("SELECT COUNT(*) FROM scheduled_jobs").fetchone()[0]
+    con.close()
+    print(f"{'drain due jobs':<34} {total} in {wall:.1f}s wall / {cpu:.1f}s CPU ({total / wall:,.0f} jobs/s), left {left}")
+    await bot.db_writer_stop()
+
+
+async def bench_sleeping_tasks(now: int):
+    rnd = random.Random(8)
+    tasks = []
+
+    async def step(chat_id: int, delay: int, ctx: dict):
+        await asyncio.sleep(delay)
+
+    async def start():
+        for i in range(PENDING):
+            tasks.append(asyncio.create_task(step(1000 + i, rnd.randint(3600, 6 * 3600), {"girl_id": 1, "viewed_at": now})))
+        await asyncio.sleep(0)  # таски доходят до sleep и паркуются
+
+    await _idle("old: sleeping task per step", start)
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    now = int(time.time())
+    path = fresh_db()
+    _seed(path, now)
+    print(f"--- {PENDING} pending steps, 1-6h out; SCHED_BATCH={bot.SCHED_BATCH} "
+          f"SCHED_CONCURRENCY={bot.SCHED_CONCURRENCY} DB_WRITE_LINGER_MS={bot.DB_WRITE_LINGER_MS}")
+    asyncio.run(bench_sleeping_tasks(now))
+    asyncio.run(bench_scheduler(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Поиск по каталогу: индекс токенов и триграмм против линейного поиска подстроки."""
+import random
+
+from _common import bot, measure, report, synthetic_manifest
+
+N_GIRLS = 10_000
+QUERIES_EXTRA = ["valorant", "dota", "genshn impact", "minecraft аниме", "косплей",
+                 "valorrant", "apex", "гитара кошки", "asmr", "kamira"]
+
+
+def linear_search(mf, query, limit=8):
+    q = query.lower().replace("ё", "е")
+    out = []
+    for g in mf["girls"]:
+        f = bot._girl_search_fields(g)
+        if q in " ".join(f.values()).lower().replace("ё", "е"):
+            out.append(g)
+            if len(out) >= limit:
+                break
+    return out
+
+
+def main():
+    mf = synthetic_manifest(N_GIRLS)
+    rnd = random.Random(5)
+    queries = [g["name"].lower() for g in rnd.sample(mf["girls"], 30)] + QUERIES_EXTRA
+    ix = bot.manifest_index(mf)
+    report(f"search index build ({N_GIRLS} girls)", measure(lambda: bot._build_search_index(ix["recs"]), 3))
+    print(f"{'vocabulary':<34} {len(ix['search'].vocab)} tokens")
+
+    it = iter(queries * 100)
+    report("linear substring scan", measure(lambda: linear_search(mf, next(it)), len(queries) * 3))
+    it = iter(queries * 100)
+    report("search_girls (index)", measure(lambda: bot.search_girls(mf, next(it)), len(queries) * 5))
+
+    for q in ("valorrant", "genshn"):
+        print(f"typo {q!r:<28} index {len(bot.search_girls(mf, q))} hits, substring scan {len(linear_search(mf, q))}")
+    for name in (g["name"] for g in rnd.sample(mf["girls"], 50)):
+        same = sum(1 for g in mf["girls"] if g["name"] == name)
+        top = [g["name"] for g in bot.search_girls(mf, name.lower(), limit=min(same, 8))]
+        assert top == [name] * len(top), name
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Send gate: ожидание интерактивных ответов под нагрузкой рассылки.
+
+Транспорт заглушен (LATENCY на вызов). Сравнение с одной FIFO-очередью на тот же
+темп — так ответ юзеру стоит в хвосте рассылки.
+"""
+import asyncio
+import time
+
+from aiogram.methods import SendMessage
+
+from _common import bot, report, stats
+
+RATE = 200.0  # сообщений/с на бота; ниже — дольше, картина та же
+LATENCY = 0.005
+BROADCAST = 600
+CLICKS = 20
+
+
+async def fake_request(bot_, method):
+    await asyncio.sleep(LATENCY)
+    return True
+
+
+class FifoLimiter:
+    def __init__(self, rate: float):
+        self.gap = 1.0 / rate
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def send(self, method):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_at > now:
+                await asyncio.sleep(self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.gap
+        return await fake_request(None, method)
+
+
+async def run(send_broadcast, send_click):
+    waits = []
+
+    async def click(i):
+        await asyncio.sleep(0.1 + i * 0.05)
+        t = time.monotonic()
+        await send_click(SendMessage(chat_id=1_000_000 + i, text="ответ"))
+        waits.append((time.monotonic() - t) * 1000)
+
+    t = time.monotonic()
+    await asyncio.gather(
+        *(send_broadcast(SendMessage(chat_id=10 + i, text="рассылка")) for i in range(BROADCAST)),
+        *(click(i) for i in range(CLICKS)),
+    )
+    return waits, time.monotonic() - t
+
+
+async def main():
+    bot.TG_GLOBAL_RATE = RATE
+    bot._tg_tokens = RATE
+
+    async def gated(lane):
+        async def _send(method):
+            with bot.tg_lane(lane):
+                return await bot.tg_send_gate(fake_request, bot.bot, method)
+        return _send
+
+    fifo = FifoLimiter(RATE)
+    waits, total = await run(fifo.send, fifo.send)
+    report("FIFO limiter: click wait", stats(waits))
+    print(f"{'FIFO limiter: throughput':<34} {(BROADCAST + CLICKS) / total:9.1f} msg/s")
+
+    waits, total = await run(await gated("broadcast"), await gated("interactive"))
+    report("send gate: click wait", stats(waits))
+    print(f"{'send gate: throughput':<34} {(BROADCAST + CLICKS) / total:9.1f} msg/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
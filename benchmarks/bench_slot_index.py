@@ -0,0 +1,60 @@
+"""SlotIndex против трёх прежних парсеров: подписи, ключи, "сегодня" и "есть окна" на анкету."""
+import random
+from datetime import timedelta
+
+import _legacy_slots as legacy
+from _common import bot, measure, now, report, synthetic_manifest
+
+N_GIRLS = 1000
+
+
+def main():
+    pinned = now()
+    bot._msk_now_naive = lambda: pinned
+    mf = synthetic_manifest(N_GIRLS, slots_per_day=5)
+    rnd = random.Random(3)
+    slot_json = {}
+    for g in mf["girls"]:
+        url = f"https://x/slots/{g['id']}.json"
+        g["slot_json"] = url
+        slot_json[url] = {"slots": [
+            {"date": f"{pinned + timedelta(days=rnd.randint(-1, 3)):%Y-%m-%d}",
+             "start": f"{h:02d}:30", "end": f"{h + 1:02d}:30", "available": rnd.random() > 0.1}
+            for h in (rnd.randint(0, 22) for _ in range(rnd.randint(0, 10)))
+        ]}
+    bot._manifest_cache = mf
+    bot._slots_cache.update(slot_json)
+    views = [bot.girl_by_id(mf, g["id"]) for g in mf["girls"]]
+
+    for g, v in zip(mf["girls"], views):
+        s = slot_json[g["slot_json"]]
+        assert bot.collect_available_slots(v, s) == legacy.collect_available_slots(g, s, pinned)
+        assert bot.collect_available_slot_keys(v, s) == legacy.collect_available_slot_keys(g, s, pinned)
+        assert bot._today_slots_from_ops_calendar(v) == legacy.today_slots(g, pinned)
+        assert bot._has_future_slots(v) == legacy.has_future_slots(g, pinned)
+
+    def run_legacy():
+        for g in mf["girls"]:
+            s = slot_json[g["slot_json"]]
+            legacy.collect_available_slots(g, s, pinned)
+            legacy.collect_available_slot_keys(g, s, pinned)
+            legacy.today_slots(g, pinned)
+            legacy.has_future_slots(g, pinned)
+
+    def run_index():
+        for g, v in zip(mf["girls"], views):
+            s = slot_json[g["slot_json"]]
+            bot.collect_available_slots(v, s)
+            bot.collect_available_slot_keys(v, s)
+            bot._today_slots_from_ops_calendar(v)
+            bot._has_future_slots(v)
+
+    print(f"{N_GIRLS} girls x 4 queries, results identical")
+    report("three parsers", measure(run_legacy, 5))
+    report("SlotIndex (cached)", measure(run_index, 5))
+    report(f"SlotIndex build, {N_GIRLS} girls", measure(
+        lambda: [bot._build_slot_index(g, slot_json[g["slot_json"]]) for g in mf["girls"]], 3))
+
+
+if __name__ == "__main__":
+    main()
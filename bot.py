@@ -2,11 +2,17 @@
 # E-GIRLZ Telegram Bot — full version with robust logging
 # Aiogram v3
 
-import os, json, base64, logging, time, html, re, aiohttp, sqlite3, asyncio, tempfile, csv, traceback, ssl
+import os, json, base64, logging, time, html, re, aiohttp, sqlite3, asyncio, tempfile, csv, traceback, ssl, threading, heapq, hashlib, bisect
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from urllib.parse import quote_plus
-from typing import Any, Dict, List, Optional, Tuple
-from contextlib import suppress
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+from contextlib import suppress, contextmanager, asynccontextmanager
+from contextvars import ContextVar
+from collections import deque
+from types import MappingProxyType
+from dataclasses import dataclass
+from functools import lru_cache
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import (
@@ -16,10 +22,11 @@ from aiogram.types import (
 from aiogram.filters import CommandStart, CommandObject, Command
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from dotenv import load_dotenv
 
 import random
+import string
 try:
     import certifi
 except Exception:
@@ -67,6 +74,48 @@ POST_PURCHASE_VIP_DISCOUNT_PCT = int(os.getenv("POST_PURCHASE_VIP_DISCOUNT_PCT",
 POST_PURCHASE_VIP_WINDOW_HOURS = int(os.getenv("POST_PURCHASE_VIP_WINDOW_HOURS", "24") or 24)
 POST_PURCHASE_VIP_CODE = (os.getenv("POST_PURCHASE_VIP_CODE", "VIP50") or "VIP50").strip()
 DB_PATH = os.getenv("DB_PATH", "egirlz_bot.db")  # SQLite файл
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4") or 4)  # потоки/соединения DB-экзекьютора
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384") or 16384)
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "128") or 128)
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "200") or 200)  # макс. операций в одной транзакции
+DB_WRITE_LINGER_MS = int(os.getenv("DB_WRITE_LINGER_MS", "5") or 5)  # сколько ждать попутчиков в батч
+LAST_SEEN_FLUSH_SEC = int(os.getenv("LAST_SEEN_FLUSH_SEC", "5") or 5)
+RETENTION_INTERVAL_HOURS = int(os.getenv("RETENTION_INTERVAL_HOURS", "24") or 24)  # 0 = не чистить
+RETENTION_CHUNK = int(os.getenv("RETENTION_CHUNK", "500") or 500)  # строк за одну операцию записи
+DB_VACUUM_ON_START = int(os.getenv("DB_VACUUM_ON_START", "0") or 0)  # 1 = разовый VACUUM старой базы при старте (включает incremental auto_vacuum)
+CAMPAIGN_LOG_KEEP_DAYS = int(os.getenv("CAMPAIGN_LOG_KEEP_DAYS", "90") or 90)  # 0 = хранить всё
+INTERESTS_KEEP_DAYS = int(os.getenv("INTERESTS_KEEP_DAYS", "90") or 90)  # старше — в interests_daily
+RECO_PUSH_KEEP_DAYS = int(os.getenv("RECO_PUSH_KEEP_DAYS", "30") or 30)
+VIP_PAYMENTS_KEEP_DAYS = int(os.getenv("VIP_PAYMENTS_KEEP_DAYS", "365") or 365)
+SETTINGS_POLL_SEC = int(os.getenv("SETTINGS_POLL_SEC", "0") or 0)  # >0 — для нескольких процессов на одной БД
+SCHED_HORIZON_SEC = int(os.getenv("SCHED_HORIZON_SEC", "900") or 900)  # сколько вперёд держать задачи в памяти
+SCHED_BATCH = int(os.getenv("SCHED_BATCH", "200") or 200)  # задач за один проход диспетчера
+SCHED_CONCURRENCY = int(os.getenv("SCHED_CONCURRENCY", "20") or 20)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30") or 30)  # сообщений/с на бота
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1") or 1)  # сообщений/с в один чат
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3") or 3)  # фото+текст+кнопки в ответ на клик
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "3") or 3)  # повторов после RetryAfter
+TG_RETRY_AFTER_MAX = int(os.getenv("TG_RETRY_AFTER_MAX", "60") or 60)  # дольше — не ждём, отдаём ошибку
+BCAST_CONCURRENCY = int(os.getenv("BCAST_CONCURRENCY", "25") or 25)  # одновременных отправок; темп — у send gate
+BCAST_PAGE = int(os.getenv("BCAST_PAGE", "100") or 100)  # получателей за страницу (шаг сохранения курсора)
+BCAST_PROGRESS_SEC = int(os.getenv("BCAST_PROGRESS_SEC", "3") or 3)  # не чаще правим сообщение прогресса
+MEDIA_CACHE_CHAT_ID = int(os.getenv("MEDIA_CACHE_CHAT_ID", "0") or 0) or ADMIN_CHAT_ID  # куда заливать фото ради file_id
+MEDIA_WARM_SEC = int(os.getenv("MEDIA_WARM_SEC", "300") or 300)  # 0 = не прогревать фото анкет
+MEDIA_REVALIDATE_SEC = int(os.getenv("MEDIA_REVALIDATE_SEC", "3600") or 3600)  # как часто сверять ETag/хэш
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100") or 100)  # соединений на один апстрим всего
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", "10") or 10)  # keep-alive соединений на хост
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "30") or 30)
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300") or 300)  # кэш DNS-резолва, сек
+MANIFEST_REFRESH_AHEAD = float(os.getenv("MANIFEST_REFRESH_AHEAD", "0.8") or 0.8)  # доля TTL, после которой обновляем в фоне
+COVIEW_SEC = int(os.getenv("COVIEW_SEC", "300") or 300)  # как часто догонять interests; 0 = модель выключена
+COVIEW_BATCH = int(os.getenv("COVIEW_BATCH", "500") or 500)  # строк interests за одну запись
+COVIEW_WINDOW_HOURS = int(os.getenv("COVIEW_WINDOW_HOURS", "168") or 168)  # "смотрели вместе" = в пределах окна
+COVIEW_TOPK = int(os.getenv("COVIEW_TOPK", "20") or 20)  # соседей на анкету в coview_topk
+RECO_COVIEW_WEIGHT = float(os.getenv("RECO_COVIEW_WEIGHT", "2.0") or 0)  # вес co-view в баллах рекомендаций; 0 = только контент
+RECO_DEBOUNCE_SEC = float(os.getenv("RECO_DEBOUNCE_SEC", "4") or 0)  # пауза в листании, после которой подбираем рекомендации
+RECO_EVAL_BATCH = int(os.getenv("RECO_EVAL_BATCH", "100") or 100)  # чатов за один проход диспетчера
+RECO_EVAL_CONCURRENCY = int(os.getenv("RECO_EVAL_CONCURRENCY", "4") or 4)  # одновременных отправок рекомендаций
+MANIFEST_BACKOFF_MAX = int(os.getenv("MANIFEST_BACKOFF_MAX", "300") or 300)  # потолок паузы между повторами при ошибках
 
 COUPON_20 = (os.getenv("COUPON_20", "TODAY20") or "TODAY20").strip()
 TRIAL_PRICE = (os.getenv("TRIAL_PRICE", "99₽") or "99₽").strip()
@@ -87,9 +136,531 @@ dp  = Dispatcher()
 rt  = Router()
 dp.include_router(rt)
 
+# ─── OUTBOUND SEND GATE ──────────────────────────────────────────────────────
+# Все исходящие send*/copy*/forward*/edit* идут через request-middleware
+# сессии: общий token bucket на бота (TG_GLOBAL_RATE), bucket на чат
+# (TG_CHAT_RATE, всплеск TG_CHAT_BURST) и очереди по полосам приоритета.
+# Полоса берётся из контекста (TG_LANE / with tg_lane(...)); хэндлеры по
+# умолчанию interactive. RetryAfter — пауза чата и повтор, Forbidden —
+# пометка users.blocked_at (такие не попадают в рассылки).
+TG_LANES = ("interactive", "transactional", "campaign", "broadcast")
+TG_LANE: ContextVar[str] = ContextVar("TG_LANE", default="interactive")
+_TG_GATED_PREFIXES = ("Send", "Copy", "Forward", "Edit")
+
+_tg_tokens = TG_GLOBAL_RATE
+_tg_tokens_at = 0.0
+_TG_CHAT_BUCKETS: Dict[Any, List[float]] = {}  # chat -> [токены, когда пересчитано, пауза до]
+_TG_WAITERS: List[deque] = [deque() for _ in TG_LANES]  # (chat, future) по полосам
+_TG_WAKE: Optional[asyncio.Event] = None
+_tg_pump_task: Optional[asyncio.Task] = None
+_TG_METRICS: Dict[str, Dict[str, Any]] = {
+    lane: {"sent": 0, "errors": 0, "retry_after": 0, "forbidden": 0,
+           "wait_ms": deque(maxlen=1000), "latency_ms": deque(maxlen=1000)}
+    for lane in TG_LANES
+}
+
+@contextmanager
+def tg_lane(lane: str):
+    token = TG_LANE.set(lane)
+    try:
+        yield
+    finally:
+        TG_LANE.reset(token)
+
+def _tg_take(chat: Any, now: float) -> Tuple[float, float]:
+    """Списать по токену из общего и чатового bucket-а. Возвращает (ждать_глобально, ждать_чат); (0, 0) — списано."""
+    global _tg_tokens, _tg_tokens_at
+    _tg_tokens = min(TG_GLOBAL_RATE, _tg_tokens + (now - _tg_tokens_at) * TG_GLOBAL_RATE)
+    _tg_tokens_at = now
+    g_wait = 0.0 if _tg_tokens >= 1 else (1 - _tg_tokens) / TG_GLOBAL_RATE
+    b = None
+    c_wait = 0.0
+    if chat is not None:
+        b = _TG_CHAT_BUCKETS.get(chat)
+        if b is None:
+            b = _TG_CHAT_BUCKETS[chat] = [TG_CHAT_BURST, now, 0.0]
+        b[0] = min(TG_CHAT_BURST, b[0] + (now - b[1]) * TG_CHAT_RATE)
+        b[1] = now
+        c_wait = max(b[2] - now, 0.0 if b[0] >= 1 else (1 - b[0]) / TG_CHAT_RATE)
+    if g_wait or c_wait:
+        return g_wait, c_wait
+    _tg_tokens -= 1
+    if b is not None:
+        b[0] -= 1
+    return 0.0, 0.0
+
+def _tg_pause(chat: Any, seconds: float):
+    global _tg_tokens
+    _tg_tokens = 0.0  # общий темп тоже притормаживаем — 429 часто про весь бот
+    if chat is not None:
+        b = _TG_CHAT_BUCKETS.setdefault(chat, [0.0, time.monotonic(), 0.0])
+        b[0] = 0.0
+        b[2] = max(b[2], time.monotonic() + seconds)
+
+def _tg_grant(now: float) -> Optional[float]:
+    """Выдать разрешения ожидающим по приоритету. Возвращает, через сколько снова пробовать."""
+    next_try: Optional[float] = None
+    for dq in _TG_WAITERS:
+        kept = []
+        blocked = False
+        for _ in range(min(len(dq), 256)):  # не сканируем бесконечно длинную полосу
+            chat, fut = dq.popleft()
+            if fut.done():
+                continue
+            g_wait, c_wait = _tg_take(chat, now)
+            if not g_wait and not c_wait:
+                fut.set_result(None)
+                continue
+            kept.append((chat, fut))
+            wait = g_wait or c_wait
+            next_try = wait if next_try is None else min(next_try, wait)
+            if g_wait:
+                # общий bucket пуст — дальше (и в младших полосах) никто не пройдёт
+                blocked = True
+                break
+        dq.extendleft(reversed(kept))  # порядок внутри полосы сохраняется
+        if blocked:
+            break
+    return next_try
+
+async def _tg_pump():
+    while True:
+        now = time.monotonic()
+        wait = _tg_grant(now)
+        if len(_TG_CHAT_BUCKETS) > 10000:
+            full = TG_CHAT_BURST / max(TG_CHAT_RATE, 0.001)
+            for chat in [c for c, b in _TG_CHAT_BUCKETS.items() if now - b[1] > full and b[2] < now]:
+                del _TG_CHAT_BUCKETS[chat]
+        _TG_WAKE.clear()
+        if wait is None and not any(_TG_WAITERS):
+            await _TG_WAKE.wait()
+            continue
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_TG_WAKE.wait(), timeout=max(0.005, wait or 0.05))
+
+def _tg_pump_ensure():
+    global _TG_WAKE, _tg_pump_task
+    if _tg_pump_task is not None and not _tg_pump_task.done():
+        return
+    _TG_WAKE = asyncio.Event()
+    _tg_pump_task = asyncio.create_task(_tg_pump())
+
+async def _tg_acquire(lane_idx: int, chat: Any):
+    # быстрый путь: никто из своей и старших полос не ждёт и токены есть
+    if not any(_TG_WAITERS[i] for i in range(lane_idx + 1)):
+        g_wait, c_wait = _tg_take(chat, time.monotonic())
+        if not g_wait and not c_wait:
+            return
+    _tg_pump_ensure()
+    fut = asyncio.get_running_loop().create_future()
+    _TG_WAITERS[lane_idx].append((chat, fut))
+    _TG_WAKE.set()
+    await fut
+
+async def tg_send_gate(make_request, bot_: Bot, method):
+    if not type(method).__name__.startswith(_TG_GATED_PREFIXES):
+        return await make_request(bot_, method)
+    lane = TG_LANE.get()
+    lane_idx = TG_LANES.index(lane) if lane in TG_LANES else 0
+    lane = TG_LANES[lane_idx]
+    m = _TG_METRICS[lane]
+    chat_id = getattr(method, "chat_id", None)
+    chat = chat_id if chat_id not in (None, "") else None
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        await _tg_acquire(lane_idx, chat)
+        m["wait_ms"].append((time.monotonic() - started) * 1000)
+        try:
+            res = await make_request(bot_, method)
+        except TelegramRetryAfter as e:
+            m["retry_after"] += 1
+            attempt += 1
+            if attempt > TG_SEND_RETRIES or e.retry_after > TG_RETRY_AFTER_MAX:
+                m["errors"] += 1
+                raise
+            log.warning("TG: RetryAfter %ss lane=%s chat=%s method=%s (attempt %d)",
+                        e.retry_after, lane, chat, type(method).__name__, attempt)
+            _tg_pause(chat, e.retry_after)
+            continue
+        except TelegramForbiddenError:
+            m["forbidden"] += 1
+            m["errors"] += 1
+            if isinstance(chat_id, int) and chat_id > 0:
+                db_mark_user_blocked(chat_id)
+                asyncio.create_task(scheduler_cancel(chat_id))  # бот заблокирован — цепочки и follow-up'ы не нужны
+            raise
+        except Exception:
+            m["errors"] += 1
+            raise
+        m["sent"] += 1
+        m["latency_ms"].append((time.monotonic() - started) * 1000)
+        return res
+
+bot.session.middleware(tg_send_gate)
+
+def _pctl(values, q: float) -> float:
+    if not values:
+        return 0.0
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(q * len(vals)))]
+
+def tg_metrics() -> Dict[str, Dict[str, Any]]:
+    """Глубина очередей и задержки отправки по полосам (последние 1000 отправок)."""
+    out = {}
+    for i, lane in enumerate(TG_LANES):
+        m = _TG_METRICS[lane]
+        out[lane] = {
+            "queued": sum(1 for _, f in _TG_WAITERS[i] if not f.done()),
+            "sent": m["sent"], "errors": m["errors"],
+            "retry_after": m["retry_after"], "forbidden": m["forbidden"],
+            "wait_p50_ms": _pctl(m["wait_ms"], 0.5), "wait_p95_ms": _pctl(m["wait_ms"], 0.95),
+            "latency_p50_ms": _pctl(m["latency_ms"], 0.5), "latency_p95_ms": _pctl(m["latency_ms"], 0.95),
+        }
+    return out
+
+# ─── MEDIA CACHE (URL → file_id) ─────────────────────────────────────────────
+# Фото по URL Telegram скачивает при каждой отправке. После первой удачной
+# отправки запоминаем file_id (в памяти + media_cache) и дальше шлём его.
+# media_resolve() заливает картинку один раз в MEDIA_CACHE_CHAT_ID (и сразу
+# удаляет сообщение) — для рассылок, где первые отправки идут параллельно.
+_MEDIA_FILE_IDS: Dict[str, str] = {}
+_MEDIA_VALIDATORS: Dict[str, str] = {}  # url -> validator, с которым снят file_id
+_MEDIA_INFLIGHT: Dict[str, asyncio.Future] = {}
+
+async def media_cache_load():
+    rows = await db_run(lambda con: con.execute("SELECT url, file_id, validator FROM media_cache").fetchall())
+    for url, file_id, validator in rows:
+        _MEDIA_FILE_IDS[url] = file_id
+        if validator:
+            _MEDIA_VALIDATORS[url] = validator
+
+def media_remember(url: str, sent: Any, validator: str | None = None):
+    """Запомнить file_id из ответа send_photo/answer_photo/edit_media (Message)."""
+    photo = getattr(sent, "photo", None)
+    if not url or not photo or not url.startswith("http"):
+        return
+    file_id = photo[-1].file_id
+    if _MEDIA_FILE_IDS.get(url) == file_id and (validator is None or _MEDIA_VALIDATORS.get(url) == validator):
+        return
+    _MEDIA_FILE_IDS[url] = file_id
+    if validator is not None:
+        _MEDIA_VALIDATORS[url] = validator
+    now = int(time.time())
+    def _op(con):
+        con.execute("INSERT INTO media_cache(url, file_id, created_at, validator) VALUES(?,?,?,?) "
+                    "ON CONFLICT(url) DO UPDATE SET file_id=excluded.file_id, created_at=excluded.created_at, "
+                    "validator=COALESCE(excluded.validator, validator)",
+                    (url, file_id, now, validator))
+    db_write_nowait(_op)
+
+def _media_set_validator(url: str, validator: str):
+    _MEDIA_VALIDATORS[url] = validator
+    db_write_nowait(lambda con: con.execute("UPDATE media_cache SET validator=? WHERE url=?", (validator, url)))
+
+def media_forget(url: str):
+    _MEDIA_VALIDATORS.pop(url, None)
+    if _MEDIA_FILE_IDS.pop(url, None) is not None:
+        db_write_nowait(lambda con: con.execute("DELETE FROM media_cache WHERE url=?", (url,)))
+
+def media_for(url: str) -> str:
+    """Что передавать в photo=: file_id, если уже знаем, иначе сам URL."""
+    return _MEDIA_FILE_IDS.get(url) or url
+
+async def media_resolve(url: str, validator: str | None = None) -> str:
+    """file_id для URL; если неизвестен — одна заливка в MEDIA_CACHE_CHAT_ID (single-flight).
+    При неудаче возвращает URL как есть."""
+    if not url or not url.startswith("http"):
+        return url
+    if url in _MEDIA_FILE_IDS:
+        return _MEDIA_FILE_IDS[url]
+    if not MEDIA_CACHE_CHAT_ID:
+        return url
+    fut = _MEDIA_INFLIGHT.get(url)
+    if fut is not None:
+        return await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _MEDIA_INFLIGHT[url] = fut
+    try:
+        m = await bot.send_photo(MEDIA_CACHE_CHAT_ID, photo=url, disable_notification=True)
+        media_remember(url, m, validator)
+        with suppress(Exception):
+            await bot.delete_message(MEDIA_CACHE_CHAT_ID, m.message_id)
+    except Exception as e:
+        log.warning("MEDIA: upload failed url=%s: %s", url, e)
+    finally:
+        _MEDIA_INFLIGHT.pop(url, None)
+        fut.set_result(_MEDIA_FILE_IDS.get(url, url))
+    return fut.result()
+
+async def send_photo_cached(chat_id: int, url: str, **kwargs) -> Message:
+    """bot.send_photo по URL через кэш file_id; протухший file_id — забываем и шлём URL."""
+    file_id = _MEDIA_FILE_IDS.get(url)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise  # не про картинку (caption, кнопки) — URL тут не поможет
+            log.warning("MEDIA: cached file_id rejected for %s: %s", url, e)
+            media_forget(url)
+    m = await bot.send_photo(chat_id, photo=url, **kwargs)
+    media_remember(url, m)
+    return m
+
+async def edit_photo_cached(message: Message, url: str, caption: str, reply_markup: Any = None) -> Any:
+    """message.edit_media(фото) через кэш file_id — как send_photo_cached."""
+    file_id = _MEDIA_FILE_IDS.get(url)
+    if file_id:
+        try:
+            return await message.edit_media(
+                InputMediaPhoto(media=file_id, caption=caption, parse_mode=ParseMode.HTML), reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            log.warning("MEDIA: cached file_id rejected for %s: %s", url, e)
+            media_forget(url)
+    m = await message.edit_media(
+        InputMediaPhoto(media=url, caption=caption, parse_mode=ParseMode.HTML), reply_markup=reply_markup
+    )
+    media_remember(url, m)
+    return m
+
+async def _media_validator(session: aiohttp.ClientSession, url: str) -> Optional[str]:
+    # ETag / Last-Modified из HEAD; если сервер их не отдаёт — хэш содержимого
+    async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=15)) as r:
+        if r.status < 400:
+            if r.headers.get("ETag"):
+                return "etag:" + r.headers["ETag"]
+            if r.headers.get("Last-Modified"):
+                return "lm:" + r.headers["Last-Modified"]
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as r:
+        r.raise_for_status()
+        return "sha1:" + hashlib.sha1(await r.read()).hexdigest()
+
+async def media_warm(urls: List[str], revalidate: bool) -> Dict[str, int]:
+    """Залить ещё неизвестные картинки; при revalidate — перезалить изменившиеся."""
+    stats = {"uploaded": 0, "changed": 0, "errors": 0}
+    todo = [u for u in dict.fromkeys(urls) if u and u.startswith("http") and (revalidate or u not in _MEDIA_FILE_IDS)]
+    if not todo or not MEDIA_CACHE_CHAT_ID:
+        return stats
+    async with http_session("manifest") as session:
+        for url in todo:
+            try:
+                validator = await _media_validator(session, url)
+            except Exception as e:
+                log.debug("MEDIA: validator failed url=%s: %s", url, e)
+                validator = None
+            if url in _MEDIA_FILE_IDS:
+                known = _MEDIA_VALIDATORS.get(url)
+                if validator is None or validator == known:
+                    continue
+                if known is None:
+                    # file_id снят при обычной отправке — считаем его актуальным, только запоминаем validator
+                    _media_set_validator(url, validator)
+                    continue
+                log.info("MEDIA: image changed, re-uploading %s", url)
+                media_forget(url)
+                stats["changed"] += 1
+            if await media_resolve(url, validator) != url:
+                stats["uploaded"] += 1
+            else:
+                stats["errors"] += 1
+    return stats
+
 # ─── DATABASE (SQLite) ───────────────────────────────────────────────────────
-def db_init():
-    con = sqlite3.connect(DB_PATH)
+# Все db_* выполняются на выделенном экзекьюторе: у каждого его потока одно
+# долгоживущее соединение (WAL, прагмы, кэш подготовленных выражений),
+# так что на вызов больше не тратится sqlite3.connect()/close().
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_local = threading.local()
+_db_connections: List[sqlite3.Connection] = []
+_db_connections_lock = threading.Lock()
+
+def _db_connect() -> sqlite3.Connection:
+    # check_same_thread=False только ради close() в db_close(): работает
+    # с соединением всегда один поток экзекьютора.
+    con = sqlite3.connect(DB_PATH, timeout=30, cached_statements=256, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{max(0, DB_CACHE_SIZE_KB)}")
+    con.execute(f"PRAGMA mmap_size={max(0, DB_MMAP_SIZE_MB) * 1024 * 1024}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+def _db_thread_con() -> sqlite3.Connection:
+    con = getattr(_db_local, "con", None)
+    if con is None:
+        con = _db_connect()
+        _db_local.con = con
+        with _db_connections_lock:
+            _db_connections.append(con)
+    return con
+
+def _db_call(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    con = _db_thread_con()
+    try:
+        return fn(con)
+    except BaseException:
+        # соединение переиспользуется — не оставляем за собой открытую транзакцию
+        with suppress(Exception):
+            con.rollback()
+        raise
+
+async def db_run(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    """Выполнить fn(con) на DB-экзекьюторе с соединением из пула."""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=max(1, DB_POOL_SIZE), thread_name_prefix="db")
+    return await asyncio.get_running_loop().run_in_executor(_db_executor, _db_call, fn)
+
+# ─── DB WRITER (single writer + group commit) ───────────────────────────────
+# Все записи идут через одну очередь: writer-таск собирает батч (до
+# DB_WRITE_BATCH операций или DB_WRITE_LINGER_MS мс) и коммитит его одной
+# транзакцией на собственном соединении — без гонки за файловую блокировку.
+# Каждая операция обёрнута в SAVEPOINT, так что ошибка одной не валит батч.
+# Операции НЕ должны сами делать commit().
+_db_write_queue: Optional[asyncio.Queue] = None
+_db_writer_task: Optional[asyncio.Task] = None
+_db_writer_executor: Optional[ThreadPoolExecutor] = None
+_db_writer_con: Optional[sqlite3.Connection] = None
+_DB_WRITER_STOP = object()
+
+def _db_writer_connection() -> sqlite3.Connection:
+    global _db_writer_con
+    if _db_writer_con is None:
+        _db_writer_con = _db_connect()
+        _db_writer_con.isolation_level = None  # транзакциями управляем сами
+    return _db_writer_con
+
+def _db_apply_batch(fns: List[Callable[[sqlite3.Connection], Any]]) -> List[Tuple[bool, Any]]:
+    con = _db_writer_connection()
+    results: List[Tuple[bool, Any]] = []
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        for fn in fns:
+            con.execute("SAVEPOINT w")
+            try:
+                res = fn(con)
+                con.execute("RELEASE w")
+                results.append((True, res))
+            except Exception as e:
+                con.execute("ROLLBACK TO w")
+                con.execute("RELEASE w")
+                results.append((False, e))
+        con.execute("COMMIT")
+        return results
+    except Exception as e:
+        if con.in_transaction:
+            with suppress(Exception):
+                con.execute("ROLLBACK")
+        return [(False, e)] * len(fns)
+
+async def _db_writer_loop():
+    q = _db_write_queue
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        first = await q.get()
+        if first is _DB_WRITER_STOP:
+            break
+        batch = [first]
+        if DB_WRITE_LINGER_MS > 0 and q.qsize() < DB_WRITE_BATCH - 1:
+            await asyncio.sleep(DB_WRITE_LINGER_MS / 1000)
+        while len(batch) < DB_WRITE_BATCH and not q.empty():
+            item = q.get_nowait()
+            if item is _DB_WRITER_STOP:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            results = await loop.run_in_executor(_db_writer_executor, _db_apply_batch, [fn for fn, _ in batch])
+        except asyncio.CancelledError:
+            for _, fut in batch:
+                if fut is not None and not fut.done():
+                    fut.cancel()
+            raise
+        except Exception as e:
+            # батч не дошёл до БД (нет соединения, экзекьютор остановлен) — ждущие
+            # получают ошибку, а не висят; no-wait операции попадут в лог ниже
+            log.error("DB writer: batch of %d failed before apply: %s", len(batch), e)
+            results = [(False, e)] * len(batch)
+        for (fn, fut), (ok, res) in zip(batch, results):
+            if fut is None:
+                if not ok:
+                    log.warning("DB write (no-wait) failed in %s: %s", getattr(fn, "__qualname__", fn), res)
+            elif not fut.done():
+                if ok:
+                    fut.set_result(res)
+                else:
+                    fut.set_exception(res)
+
+def _db_writer_ensure():
+    global _db_write_queue, _db_writer_task, _db_writer_executor
+    if _db_writer_task is not None and not _db_writer_task.done():
+        return
+    if _db_writer_executor is None:
+        _db_writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    _db_write_queue = asyncio.Queue()
+    _db_writer_task = asyncio.create_task(_db_writer_loop())
+
+async def db_write(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    """Поставить fn(con) в очередь записи и дождаться коммита её батча."""
+    _db_writer_ensure()
+    fut = asyncio.get_running_loop().create_future()
+    _db_write_queue.put_nowait((fn, fut))
+    return await fut
+
+def db_write_nowait(fn: Callable[[sqlite3.Connection], Any]):
+    """Fire-and-forget запись: не ждём коммита, ошибки только логируются."""
+    _db_writer_ensure()
+    _db_write_queue.put_nowait((fn, None))
+
+async def db_writer_maintenance(fn: Callable[[sqlite3.Connection], Any]) -> Any:
+    """Выполнить fn(con) на соединении writer-а вне транзакции (VACUUM и т.п.).
+    Идёт на том же однопоточном экзекьюторе, так что с батчами не пересекается."""
+    _db_writer_ensure()
+    return await asyncio.get_running_loop().run_in_executor(
+        _db_writer_executor, lambda: fn(_db_writer_connection())
+    )
+
+async def db_writer_stop():
+    """Дописать всё, что уже в очереди, и остановить writer."""
+    global _db_writer_task, _db_writer_con
+    if _db_writer_task is not None and not _db_writer_task.done():
+        _db_write_queue.put_nowait(_DB_WRITER_STOP)
+        with suppress(Exception):
+            await _db_writer_task
+    _db_writer_task = None
+    if _db_writer_con is not None:
+        with suppress(Exception):
+            _db_writer_con.close()
+        _db_writer_con = None
+
+def db_close():
+    global _db_executor, _db_writer_executor
+    if _db_writer_executor is not None:
+        _db_writer_executor.shutdown(wait=True)
+        _db_writer_executor = None
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+    with _db_connections_lock:
+        for con in _db_connections:
+            with suppress(Exception):
+                con.close()
+        _db_connections.clear()
+
+# ─── SCHEMA MIGRATIONS ───────────────────────────────────────────────────────
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется в
+# своей транзакции вместе с бампом версии; если схема актуальна — db_init()
+# ничего не создаёт и не проверяет. Новые таблицы/индексы — только новой
+# миграцией в конце DB_MIGRATIONS, существующие не редактировать.
+def _db_has_column(con: sqlite3.Connection, table: str, column: str) -> bool:
+    return any(r[1] == column for r in con.execute(f"PRAGMA table_info({table})"))
+
+def _migration_1_baseline(con: sqlite3.Connection):
     # users
     con.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -103,11 +674,9 @@ def db_init():
             last_seen   INTEGER
         )
     """)
-    # миграция last_seen на старую базу
-    try:
+    # старые базы без last_seen
+    if not _db_has_column(con, "users", "last_seen"):
         con.execute("ALTER TABLE users ADD COLUMN last_seen INTEGER")
-    except Exception:
-        pass
     # interest_once — фиксация, что админу уже слали "Интерес к анкете" для (user,girl)
     con.execute("""
         CREATE TABLE IF NOT EXISTS interest_once (
@@ -288,8 +857,178 @@ def db_init():
         )
     """)
 
-    con.commit()
-    con.close()
+def _migration_2_perf_indexes(con: sqlite3.Connection):
+    # сегменты рассылки/статистика, шаги кампаний, вотчер подписок на слоты
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_users_added_at ON users(added_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_campaign_steps_camp ON campaign_steps(campaign_name, step_idx)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_slot_subs_girl ON slot_subscriptions(girl_id)")
+
+def _migration_3_retention(con: sqlite3.Connection):
+    # суточные свёртки удалённых interests + индексы по времени для порционной чистки
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS interests_daily (
+            day     TEXT NOT NULL,       -- YYYY-MM-DD (МСК)
+            girl_id INTEGER NOT NULL,
+            source  TEXT NOT NULL,
+            cnt     INTEGER NOT NULL,
+            PRIMARY KEY(day, girl_id, source)
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_campaign_log_sent ON campaign_log(sent_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_interests_created ON interests(created_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_reco_push_created ON reco_push_log(created_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_vip_payments_created ON vip_payments(created_at)")
+
+def _migration_4_change_counters(con: sqlite3.Connection):
+    # счётчики изменений для инвалидации кэшей между процессами; бампаются триггерами
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            n    INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    con.execute("INSERT OR IGNORE INTO change_counters(name, n) VALUES('settings', 0)")
+    for ev in ("INSERT", "UPDATE", "DELETE"):
+        con.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_settings_{ev.lower()} AFTER {ev} ON settings
+            BEGIN UPDATE change_counters SET n=n+1 WHERE name='settings'; END
+        """)
+
+def _migration_5_scheduled_jobs(con: sqlite3.Connection):
+    # отложенные шаги кампаний и follow-up-ы (переживают рестарт)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_at     INTEGER NOT NULL,
+            kind       TEXT NOT NULL,        -- 'campaign_step' | 'timesall_followup'
+            chat_id    INTEGER NOT NULL,
+            campaign   TEXT,
+            payload    TEXT,                 -- JSON
+            created_at INTEGER NOT NULL
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sched_run_at ON scheduled_jobs(run_at)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_sched_chat ON scheduled_jobs(chat_id, campaign)")
+
+def _migration_6_users_blocked(con: sqlite3.Connection):
+    # бот заблокирован юзером (Forbidden при отправке); сбрасывается при любой активности
+    if not _db_has_column(con, "users", "blocked_at"):
+        con.execute("ALTER TABLE users ADD COLUMN blocked_at INTEGER")
+
+def _migration_7_broadcast_jobs(con: sqlite3.Connection):
+    # рассылки: параметры, курсор по users.chat_id и счётчики — переживают рестарт
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            status        TEXT NOT NULL,     -- 'running' | 'paused' | 'cancelled' | 'done'
+            segment       TEXT NOT NULL,
+            seg_since     INTEGER,           -- last_seen >= (для active7/active30), NULL — все
+            text          TEXT,
+            photo         TEXT,
+            buttons_json  TEXT,
+            cursor        INTEGER NOT NULL DEFAULT 0,  -- все chat_id <= cursor обработаны
+            total         INTEGER NOT NULL DEFAULT 0,
+            sent          INTEGER NOT NULL DEFAULT 0,
+            failed        INTEGER NOT NULL DEFAULT 0,
+            admin_chat_id INTEGER,
+            progress_msg_id INTEGER,
+            created_at    INTEGER NOT NULL,
+            updated_at    INTEGER,
+            finished_at   INTEGER
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+def _migration_8_media_cache(con: sqlite3.Connection):
+    # URL картинки → Telegram file_id (чтобы Telegram не качал её заново на каждую отправку)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            url        TEXT PRIMARY KEY,
+            file_id    TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    """)
+
+def _migration_9_media_validator(con: sqlite3.Connection):
+    # ETag / Last-Modified / хэш содержимого, с которым снят file_id — поменялась картинка → перезаливка
+    if not _db_has_column(con, "media_cache", "validator"):
+        con.execute("ALTER TABLE media_cache ADD COLUMN validator TEXT")
+
+def _migration_10_coview(con: sqlite3.Connection):
+    # co-view: пары анкет, которые один юзер смотрел в пределах окна; считается
+    # инкрементально по interests (курсор — последний обработанный interests.id)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS coview_pairs (
+            girl_a INTEGER NOT NULL,
+            girl_b INTEGER NOT NULL,
+            cnt    INTEGER NOT NULL,
+            PRIMARY KEY(girl_a, girl_b)
+        ) WITHOUT ROWID
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS coview_topk (
+            girl_id    INTEGER PRIMARY KEY,
+            neighbours TEXT NOT NULL,   -- JSON [[girl_id, cnt], ...] по убыванию cnt
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS coview_state (
+            id               INTEGER PRIMARY KEY CHECK (id = 1),
+            last_interest_id INTEGER NOT NULL
+        )
+    """)
+    con.execute("INSERT OR IGNORE INTO coview_state(id, last_interest_id) VALUES (1, 0)")
+
+DB_MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline schema", _migration_1_baseline),
+    (2, "performance indexes", _migration_2_perf_indexes),
+    (3, "retention rollups", _migration_3_retention),
+    (4, "change counters", _migration_4_change_counters),
+    (5, "scheduled jobs", _migration_5_scheduled_jobs),
+    (6, "users.blocked_at", _migration_6_users_blocked),
+    (7, "broadcast jobs", _migration_7_broadcast_jobs),
+    (8, "media cache", _migration_8_media_cache),
+    (9, "media cache validator", _migration_9_media_validator),
+    (10, "co-view model", _migration_10_coview),
+]
+
+def db_init():
+    con = _db_connect()
+    con.isolation_level = None  # BEGIN/COMMIT вручную — DDL тоже транзакционный
+    try:
+        current = int(con.execute("PRAGMA user_version").fetchone()[0] or 0)
+        latest = DB_MIGRATIONS[-1][0]
+        if int(con.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+            # auto_vacuum меняется только полным VACUUM: на пустом файле он мгновенный,
+            # старую базу переводим лишь по DB_VACUUM_ON_START — до старта writer-а
+            empty = con.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None
+            if empty or DB_VACUUM_ON_START:
+                started = time.monotonic()
+                con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                con.execute("VACUUM")
+                if not empty:
+                    log.info("DB: VACUUM → incremental auto_vacuum in %.1fs", time.monotonic() - started)
+        if current >= latest:
+            log.info("DB: schema v%d is current", current)
+            return
+        for version, title, migrate in DB_MIGRATIONS:
+            if version <= current:
+                continue
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                migrate(con)
+                con.execute(f"PRAGMA user_version={int(version)}")
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                log.exception("DB: migration v%d (%s) failed", version, title)
+                raise
+            log.info("DB: migrated v%d → v%d (%s)", current, version, title)
+            current = version
+    finally:
+        con.close()
 
 # безопасный “мгновенный” ответ на callback
 async def ack(cb: CallbackQuery, text: str | None = None, alert: bool = False):
@@ -299,8 +1038,7 @@ async def ack(cb: CallbackQuery, text: str | None = None, alert: bool = False):
 async def db_upsert_user(chat_id: int, username: str | None, first: str | None,
                          last: str | None, reason: str | None, coupon: str | None):
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("""
             INSERT INTO users (chat_id, username, first_name, last_name, added_at, last_reason, last_coupon, last_seen)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?)
@@ -310,76 +1048,93 @@ async def db_upsert_user(chat_id: int, username: str | None, first: str | None,
                 last_name=excluded.last_name,
                 last_reason=excluded.last_reason,
                 last_coupon=excluded.last_coupon,
-                last_seen=excluded.last_seen
+                last_seen=excluded.last_seen,
+                blocked_at=NULL
         """, (chat_id, username, first, last, now, reason, coupon, now))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
-def _touch_user(chat_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        con.execute("UPDATE users SET last_seen=? WHERE chat_id=?", (int(time.time()), chat_id))
-        con.commit()
-        con.close()
-    return asyncio.to_thread(_op)
+def db_mark_user_blocked(chat_id: int):
+    now = int(time.time())
+    def _op(con):
+        con.execute("UPDATE users SET blocked_at=? WHERE chat_id=? AND blocked_at IS NULL", (now, chat_id))
+    db_write_nowait(_op)
+
+# last_seen копится в памяти и сбрасывается пачкой раз в LAST_SEEN_FLUSH_SEC:
+# листание каталога больше не даёт UPDATE на каждый клик.
+_LAST_SEEN_PENDING: Dict[int, int] = {}  # chat_id -> unix ts ещё не записанного касания
+
+async def _touch_user(chat_id: int):
+    _LAST_SEEN_PENDING[chat_id] = int(time.time())
+
+async def last_seen_flush():
+    if not _LAST_SEEN_PENDING:
+        return
+    batch = list(_LAST_SEEN_PENDING.items())
+    def _op(con):
+        con.executemany(
+            "UPDATE users SET last_seen=MAX(COALESCE(last_seen, 0), ?), blocked_at=NULL WHERE chat_id=?",
+            [(ts, chat_id) for chat_id, ts in batch]
+        )
+    await db_write(_op)
+    # Значения остаются в памяти до коммита, чтобы чтения их видели;
+    # убираем только те, что не обновились, пока шла запись.
+    for chat_id, ts in batch:
+        if _LAST_SEEN_PENDING.get(chat_id) == ts:
+            del _LAST_SEEN_PENDING[chat_id]
+
+async def last_seen_flusher():
+    while True:
+        await asyncio.sleep(max(1, LAST_SEEN_FLUSH_SEC))
+        try:
+            await last_seen_flush()
+        except Exception as e:
+            log.warning("last_seen flush failed: %s", e)
 
 async def db_add_interest(chat_id: int, girl_id: int, source: str = "deeplink"):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    now = int(time.time())
+    def _op(con):
         con.execute(
             "INSERT INTO interests (chat_id, girl_id, source, created_at) VALUES (?, ?, ?, ?)",
-            (chat_id, girl_id, source, int(time.time()))
+            (chat_id, girl_id, source, now)
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    db_write_nowait(_op)
 
 async def db_recent_interest_exists(chat_id: int, girl_id: int, within_sec: int = 24*3600) -> bool:
     """Есть ли у юзера интерес к этой девочке за последние within_sec секунд?"""
     cutoff = int(time.time()) - int(within_sec)
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT MAX(created_at) FROM interests WHERE chat_id=? AND girl_id=?",
-                (chat_id, girl_id)
-            )
-            row = cur.fetchone()
-            if not row or row[0] is None:
-                return False
-            last = int(row[0])
-            # если вдруг в БД лежат миллисекунды — нормализуем
-            if last > 10**12:  # ~ миллисекунды
-                last //= 1000
-            return last >= cutoff
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            "SELECT MAX(created_at) FROM interests WHERE chat_id=? AND girl_id=?",
+            (chat_id, girl_id)
+        )
+        row = cur.fetchone()
+        if not row or row[0] is None:
+            return False
+        last = int(row[0])
+        # если вдруг в БД лежат миллисекунды — нормализуем
+        if last > 10**12:  # ~ миллисекунды
+            last //= 1000
+        return last >= cutoff
+    return await db_run(_op)
 
 async def db_interest_seen_once(chat_id: int, girl_id: int) -> bool:
     """
     True  — если для (chat_id, girl_id) уже когда-то слали "Интерес к анкете".
     False — если ещё не слали (и в этом случае помечаем как слали — один раз и навсегда).
     """
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT 1 FROM interest_once WHERE chat_id=? AND girl_id=?",
-                (chat_id, girl_id)
+    def _op(con):
+        cur = con.execute(
+            "SELECT 1 FROM interest_once WHERE chat_id=? AND girl_id=?",
+            (chat_id, girl_id)
+        )
+        exists = cur.fetchone() is not None
+        if not exists:
+            con.execute(
+                "INSERT INTO interest_once(chat_id, girl_id, created_at) VALUES (?,?,?)",
+                (chat_id, girl_id, int(time.time()))
             )
-            exists = cur.fetchone() is not None
-            if not exists:
-                con.execute(
-                    "INSERT INTO interest_once(chat_id, girl_id, created_at) VALUES (?,?,?)",
-                    (chat_id, girl_id, int(time.time()))
-                )
-                con.commit()
-            return exists
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+        return exists
+    return await db_write(_op)
 
 # ─── CAMPAIGN DB OPS ─────────────────────────────────────────────────────────
 async def seed_campaigns_if_empty():
@@ -390,8 +1145,7 @@ async def seed_campaigns_if_empty():
     - не трогает существующие кастомные шаги.
     - сидирует дефолтные settings.
     """
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         now = int(time.time())
 
         for name, steps in CAMPAIGNS.items():
@@ -428,86 +1182,126 @@ async def seed_campaigns_if_empty():
         for k, v in (("COUPON_20", COUPON_20), ("TRIAL_PRICE", TRIAL_PRICE), ("CAMPAIGN_COOLDOWN_HOURS", str(CAMPAIGN_COOLDOWN_HOURS))):
             con.execute("INSERT OR IGNORE INTO settings(key,value) VALUES(?,?)", (k, v))
 
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate()
+    await settings_load()  # дефолтные settings только что могли появиться — снимок не должен их пропустить
+
+# Реестр кампаний: кампания со всеми шагами читается из БД один раз, кнопки
+# распарсены, шаблоны скомпилированы (compile_tpl). Мутаторы db_campaign_*
+# сбрасывают запись своей кампании; поколение защищает от гонки, когда
+# чтение из БД завершилось уже после инвалидации.
+_CAMPAIGN_REGISTRY: Dict[str, Dict[str, Any]] = {}
+_CAMPAIGN_GEN: Dict[str, int] = {}
+
+def _compile_campaign_step(step: Dict[str, Any]) -> Dict[str, Any]:
+    buttons = []
+    for row in step.get("buttons") or []:
+        crow = []
+        for b in row:
+            if "url" in b:
+                crow.append((compile_tpl(b.get("text")), "url", compile_tpl(b["url"])))
+            elif "cb" in b:
+                crow.append((compile_tpl(b.get("text")), "cb", b["cb"]))
+        buttons.append(crow)
+    return {
+        **step,
+        "_text": compile_tpl(step.get("text")),
+        "_caption": compile_tpl(step.get("caption") or step.get("text")),
+        "_image": compile_tpl(step.get("image")),
+        "_buttons": buttons,
+    }
 
-async def load_campaign_steps_from_db(campaign: str) -> Optional[List[Dict[str, Any]]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+def _db_campaign_load(con: sqlite3.Connection, campaign: str) -> Optional[Tuple[int, Optional[int], List[Dict[str, Any]]]]:
+    row = con.execute("SELECT enabled, cooldown_hours FROM campaigns WHERE name=?", (campaign,)).fetchone()
+    if not row:
+        return None
+    cur = con.execute("""
+        SELECT step_idx, kind, delay, text, caption, image, buttons_json
+        FROM campaign_steps
+        WHERE campaign_name=?
+        ORDER BY step_idx ASC
+    """, (campaign,))
+    steps = []
+    for step_idx, kind, delay, text, caption, image, buttons_json in cur.fetchall():
         try:
-            cur = con.execute("SELECT enabled FROM campaigns WHERE name=?", (campaign,))
-            row = cur.fetchone()
-            if not row:
-                # кампании нет в БД → None (значит будем fallback на дефолт)
-                return None
-            enabled = int(row[0] or 0)
-            if not enabled:
-                # выключена → пустой список (ничего слать)
-                return []
-            cur = con.execute("""
-                SELECT step_idx, kind, delay, text, caption, image, buttons_json
-                FROM campaign_steps
-                WHERE campaign_name=?
-                ORDER BY step_idx ASC
-            """, (campaign,))
-            steps = []
-            for step_idx, kind, delay, text, caption, image, buttons_json in cur.fetchall():
-                try:
-                    buttons = json.loads(buttons_json) if buttons_json else []
-                except Exception:
-                    buttons = []
-                steps.append({
-                    "delay": int(delay or 0),
-                    "kind": kind or "text",
-                    "text": text,
-                    "caption": caption,
-                    "image": image,
-                    "buttons": buttons
-                })
-            return steps
-        finally:
-            con.close()
-    steps = await asyncio.to_thread(_op)
-    if steps is None:
+            buttons = json.loads(buttons_json) if buttons_json else []
+        except Exception:
+            buttons = []
+        steps.append({
+            "delay": int(delay or 0),
+            "kind": kind or "text",
+            "text": text,
+            "caption": caption,
+            "image": image,
+            "buttons": buttons
+        })
+    return int(row[0] or 0), (int(row[1]) if row[1] is not None else None), steps
+
+async def campaign_get(campaign: str) -> Dict[str, Any]:
+    """Скомпилированная кампания: {in_db, enabled, cooldown_hours, steps}.
+    in_db=False — кампании нет в БД, steps взяты из дефолтных CAMPAIGNS."""
+    c = _CAMPAIGN_REGISTRY.get(campaign)
+    if c is not None:
+        return c
+    gen = _CAMPAIGN_GEN.get(campaign, 0)
+    loaded = await db_run(lambda con: _db_campaign_load(con, campaign))
+    if loaded is None:
+        steps = CAMPAIGNS.get(campaign) or []
+        c = {"in_db": False, "enabled": True, "cooldown_hours": CAMPAIGN_COOLDOWN_HOURS,
+             "steps": [_compile_campaign_step(st) for st in steps]}
+    else:
+        enabled, cooldown, steps = loaded
+        c = {"in_db": True, "enabled": bool(enabled),
+             "cooldown_hours": cooldown if cooldown is not None else CAMPAIGN_COOLDOWN_HOURS,
+             "steps": [_compile_campaign_step(st) for st in steps]}
+    if _CAMPAIGN_GEN.get(campaign, 0) == gen:
+        _CAMPAIGN_REGISTRY[campaign] = c
+    return c
+
+def campaign_invalidate(campaign: Optional[str] = None):
+    names = [campaign] if campaign is not None else list(set(_CAMPAIGN_REGISTRY) | set(_CAMPAIGN_GEN))
+    for name in names:
+        _CAMPAIGN_REGISTRY.pop(name, None)
+        _CAMPAIGN_GEN[name] = _CAMPAIGN_GEN.get(name, 0) + 1
+
+async def load_campaign_steps_from_db(campaign: str) -> Optional[List[Dict[str, Any]]]:
+    c = await campaign_get(campaign)
+    if not c["in_db"]:
+        # кампании нет в БД → None (значит будем fallback на дефолт)
         log.info("CAMP '%s': not in DB, will use defaults", campaign)
-    elif len(steps) == 0:
+        return None
+    # выключена → пустой список (ничего слать)
+    steps = c["steps"] if c["enabled"] else []
+    if len(steps) == 0:
         log.warning("CAMP '%s': disabled or 0 steps in DB → nothing will be sent", campaign)
     else:
         log.debug("CAMP '%s': loaded %d steps from DB", campaign, len(steps))
     return steps
 
 async def db_campaigns_list() -> List[Tuple[str,str,int,int]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("SELECT name,title,enabled,cooldown_hours FROM campaigns ORDER BY name")
         rows = cur.fetchall()
-        con.close()
         return rows
-    return await asyncio.to_thread(_op)
+    return await db_run(_op)
 
 async def db_campaign_toggle(name: str, enable: Optional[bool]=None):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         if enable is None:
             con.execute("UPDATE campaigns SET enabled=1-enabled, updated_at=? WHERE name=?", (int(time.time()), name))
         else:
             con.execute("UPDATE campaigns SET enabled=?, updated_at=? WHERE name=?", (1 if enable else 0, int(time.time()), name))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 async def db_campaign_set_cooldown(name: str, hours: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("UPDATE campaigns SET cooldown_hours=?, updated_at=? WHERE name=?", (hours, int(time.time()), name))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 async def db_campaign_steps(name: str) -> List[Dict[str, Any]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("""
             SELECT id, step_idx, kind, delay, text, caption, image, buttons_json
             FROM campaign_steps WHERE campaign_name=? ORDER BY step_idx
@@ -519,12 +1313,11 @@ async def db_campaign_steps(name: str) -> List[Dict[str, Any]]:
                 "text": text, "caption": caption, "image": image,
                 "buttons": json.loads(buttons_json) if buttons_json else []
             })
-        con.close()
         return rows
-    return await asyncio.to_thread(_op)
+    return await db_run(_op)
 
 async def db_campaign_step_update(name: str, step_idx: int, fields: Dict[str, Any]):
-    def _op():
+    def _op(con):
         sets, vals = [], []
         if "kind" in fields: sets.append("kind=?"); vals.append(fields["kind"])
         if "delay" in fields: sets.append("delay=?"); vals.append(int(fields["delay"]))
@@ -533,15 +1326,12 @@ async def db_campaign_step_update(name: str, step_idx: int, fields: Dict[str, An
         if "image" in fields: sets.append("image=?"); vals.append(fields["image"])
         if "buttons" in fields: sets.append("buttons_json=?"); vals.append(json.dumps(fields["buttons"], ensure_ascii=False))
         vals.extend([name, step_idx])
-        con = sqlite3.connect(DB_PATH)
         con.execute(f"UPDATE campaign_steps SET {', '.join(sets)} WHERE campaign_name=? AND step_idx=?", vals)
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 async def db_campaign_step_add(name: str):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("SELECT COALESCE(MAX(step_idx),-1) FROM campaign_steps WHERE campaign_name=?", (name,))
         mx = cur.fetchone()[0]
         new_idx = (mx if mx is not None else -1) + 1
@@ -549,66 +1339,110 @@ async def db_campaign_step_add(name: str):
             INSERT INTO campaign_steps(campaign_name, step_idx, kind, delay, text, caption, image, buttons_json)
             VALUES(?,?,?,?,?,?,?,?)
         """, (name, new_idx, "text", 0, "Новый шаг", "", "", "[]"))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 async def db_campaign_step_delete(name: str, step_idx: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("DELETE FROM campaign_steps WHERE campaign_name=? AND step_idx=?", (name, step_idx))
         # переиндексация
         cur = con.execute("SELECT id FROM campaign_steps WHERE campaign_name=? ORDER BY step_idx", (name,))
         ids = [r[0] for r in cur.fetchall()]
         for i, rid in enumerate(ids):
             con.execute("UPDATE campaign_steps SET step_idx=? WHERE id=?", (i, rid))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 async def db_campaign_step_move(name: str, step_idx: int, delta: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("SELECT id, step_idx FROM campaign_steps WHERE campaign_name=? ORDER BY step_idx", (name,))
         rows = cur.fetchall()
         n = len(rows)
         if n == 0 or step_idx < 0 or step_idx >= n:
-            con.close(); return
+            return
         new_idx = max(0, min(n-1, step_idx + delta))
         if new_idx == step_idx:
-            con.close(); return
+            return
         # swap indices
         id_a = rows[step_idx][0]
         id_b = rows[new_idx][0]
         con.execute("UPDATE campaign_steps SET step_idx=? WHERE id=?", (new_idx, id_a))
         con.execute("UPDATE campaign_steps SET step_idx=? WHERE id=?", (step_idx, id_b))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+    campaign_invalidate(name)
 
 # SETTINGS
+# Настройки меняются только из админки, а читаются на каждом /start и
+# показе анкеты — держим их в памяти. Снимок неизменяемый и подменяется
+# целиком, вместе с версией (значение change_counters['settings']). Горячие
+# пути (/start, листание анкет) читают settings_snapshot() — без await и все
+# ключи из одной версии; settings_get() — для админки и редких мест.
+# Несколько процессов на одной БД: SETTINGS_POLL_SEC>0 включает settings_watcher().
+_SETTINGS: Optional[MappingProxyType] = None
+_SETTINGS_VERSION = -1
+
+def db_change_counter(con: sqlite3.Connection, name: str) -> int:
+    r = con.execute("SELECT n FROM change_counters WHERE name=?", (name,)).fetchone()
+    return int(r[0]) if r else 0
+
+async def settings_load():
+    global _SETTINGS, _SETTINGS_VERSION
+    def _op(con):
+        con.execute("BEGIN")  # один read-снимок: версия согласована со значениями
+        try:
+            rows = con.execute("SELECT key, value FROM settings").fetchall()
+            version = db_change_counter(con, "settings")
+        finally:
+            con.commit()
+        return {k: v for k, v in rows if v is not None}, version
+    data, version = await db_run(_op)
+    if version >= _SETTINGS_VERSION:
+        _SETTINGS, _SETTINGS_VERSION = MappingProxyType(data), version
+
+def settings_snapshot() -> Tuple[int, MappingProxyType]:
+    """(версия, снимок) без I/O; до settings_load() — пустой снимок с версией -1."""
+    return _SETTINGS_VERSION, (_SETTINGS if _SETTINGS is not None else MappingProxyType({}))
+
 async def settings_get(key: str, default: str) -> str:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        cur = con.execute("SELECT value FROM settings WHERE key=?", (key,))
-        r = cur.fetchone()
-        con.close()
-        return r[0] if r and r[0] is not None else default
-    return await asyncio.to_thread(_op)
+    if _SETTINGS is None:
+        await settings_load()
+    v = _SETTINGS.get(key)
+    return v if v is not None else default
 
 async def settings_set(key: str, value: str):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    global _SETTINGS, _SETTINGS_VERSION
+    def _op(con):
         con.execute("INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+        return db_change_counter(con, "settings")
+    version = await db_write(_op)
+    if _SETTINGS is not None and version == _SETTINGS_VERSION + 1:
+        _SETTINGS, _SETTINGS_VERSION = MappingProxyType({**_SETTINGS, key: value}), version
+    else:
+        # между нами был чужой апдейт (другой процесс/параллельный set) — перечитываем всё
+        await settings_load()
+
+async def settings_poll() -> bool:
+    """Перечитать настройки, если счётчик в БД ушёл вперёд. True — если перечитали."""
+    version = await db_run(lambda con: db_change_counter(con, "settings"))
+    if version == _SETTINGS_VERSION:
+        return False
+    await settings_load()
+    return True
+
+async def settings_watcher():
+    while True:
+        await asyncio.sleep(max(1, SETTINGS_POLL_SEC))
+        try:
+            if await settings_poll():
+                log.info("SETTINGS: reloaded v%d", _SETTINGS_VERSION)
+        except Exception as e:
+            log.warning("settings poll failed: %s", e)
 
 # USERS STATS / LIST / EXPORT
 async def db_users_stats() -> Dict[str,int]:
+    await last_seen_flush()
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("SELECT COUNT(*) FROM users")
         total = cur.fetchone()[0]
         cur = con.execute("SELECT COUNT(*) FROM users WHERE last_seen>=?", (now-7*86400,))
@@ -617,28 +1451,14 @@ async def db_users_stats() -> Dict[str,int]:
         active30 = cur.fetchone()[0]
         cur = con.execute("SELECT COUNT(*) FROM users WHERE added_at>=?", (now-24*3600,))
         new24 = cur.fetchone()[0]
-        con.close()
-        return {"total": total, "active7": active7, "active30": active30, "new24": new24}
-    return await asyncio.to_thread(_op)
-
-async def db_user_ids(segment: str) -> List[int]:
-    now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        if segment == "all":
-            cur = con.execute("SELECT chat_id FROM users")
-        elif segment == "active7":
-            cur = con.execute("SELECT chat_id FROM users WHERE last_seen>=?", (now-7*86400,))
-        else:  # active30
-            cur = con.execute("SELECT chat_id FROM users WHERE last_seen>=?", (now-30*86400,))
-        ids = [r[0] for r in cur.fetchall()]
-        con.close()
-        return ids
-    return await asyncio.to_thread(_op)
+        cur = con.execute("SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL")
+        blocked = cur.fetchone()[0]
+        return {"total": total, "active7": active7, "active30": active30, "new24": new24, "blocked": blocked}
+    return await db_run(_op)
 
 async def db_users_list(limit: int = 50) -> List[Dict[str,Any]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    await last_seen_flush()
+    def _op(con):
         cur = con.execute("""
             SELECT chat_id, username, first_name, last_name, added_at, last_seen, last_reason, last_coupon
             FROM users ORDER BY last_seen DESC LIMIT ?
@@ -649,26 +1469,21 @@ async def db_users_list(limit: int = 50) -> List[Dict[str,Any]]:
                 "chat_id": r[0], "username": r[1], "first_name": r[2], "last_name": r[3],
                 "added_at": r[4], "last_seen": r[5], "last_reason": r[6], "last_coupon": r[7]
             })
-        con.close()
         return rows
-    return await asyncio.to_thread(_op)
+    return await db_run(_op)
 
 async def db_favorite_add(chat_id: int, girl_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             "INSERT OR IGNORE INTO favorites(chat_id, girl_id, created_at) VALUES (?,?,?)",
             (chat_id, girl_id, int(time.time()))
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_set_pending_action(chat_id: int, action: str, payload: Optional[Dict[str, Any]] = None):
     data = json.dumps(payload or {}, ensure_ascii=False)
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO pending_actions(chat_id, action, payload, updated_at)
@@ -680,34 +1495,24 @@ async def db_set_pending_action(chat_id: int, action: str, payload: Optional[Dic
             """,
             (chat_id, action, data, now)
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_get_pending_action(chat_id: int) -> Optional[str]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute("SELECT action FROM pending_actions WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            return str(row[0]) if row and row[0] else None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute("SELECT action FROM pending_actions WHERE chat_id=?", (chat_id,))
+        row = cur.fetchone()
+        return str(row[0]) if row and row[0] else None
+    return await db_run(_op)
 
 async def db_clear_pending_action(chat_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("DELETE FROM pending_actions WHERE chat_id=?", (chat_id,))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_checkout_state_set(chat_id: int, state: Dict[str, Any]):
     payload = json.dumps(state or {}, ensure_ascii=False)
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO checkout_sessions(chat_id, state_json, updated_at)
@@ -718,39 +1523,29 @@ async def db_checkout_state_set(chat_id: int, state: Dict[str, Any]):
             """,
             (chat_id, payload, now)
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_checkout_state_get(chat_id: int) -> Optional[Dict[str, Any]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
+        cur = con.execute("SELECT state_json FROM checkout_sessions WHERE chat_id=?", (chat_id,))
+        row = cur.fetchone()
+        if not row or not row[0]:
+            return None
         try:
-            cur = con.execute("SELECT state_json FROM checkout_sessions WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            if not row or not row[0]:
-                return None
-            try:
-                data = json.loads(row[0])
-                return data if isinstance(data, dict) else None
-            except Exception:
-                return None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+            data = json.loads(row[0])
+            return data if isinstance(data, dict) else None
+        except Exception:
+            return None
+    return await db_run(_op)
 
 async def db_checkout_state_clear(chat_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("DELETE FROM checkout_sessions WHERE chat_id=?", (chat_id,))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_checkout_order_upsert(order_id: int, chat_id: int, girl_id: int, girl_name: str, amount: float, currency: str):
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO checkout_orders(order_id, chat_id, girl_id, girl_name, amount, currency, status, last_checked_at, post_purchase_sent, created_at, paid_at)
@@ -764,45 +1559,38 @@ async def db_checkout_order_upsert(order_id: int, chat_id: int, girl_id: int, gi
             """,
             (order_id, chat_id, girl_id, girl_name, float(amount), currency, now)
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_checkout_orders_pending(limit: int = 40) -> List[Dict[str, Any]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                """
-                SELECT order_id, chat_id, girl_id, girl_name, amount, currency, status, created_at
-                FROM checkout_orders
-                WHERE post_purchase_sent=0
-                ORDER BY created_at DESC
-                LIMIT ?
-                """,
-                (int(limit),)
-            )
-            out: List[Dict[str, Any]] = []
-            for row in cur.fetchall():
-                out.append({
-                    "order_id": int(row[0]),
-                    "chat_id": int(row[1]),
-                    "girl_id": int(row[2]),
-                    "girl_name": str(row[3] or ""),
-                    "amount": float(row[4] or 0.0),
-                    "currency": str(row[5] or "RUB"),
-                    "status": str(row[6] or "pending"),
-                    "created_at": int(row[7] or 0),
-                })
-            return out
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            """
+            SELECT order_id, chat_id, girl_id, girl_name, amount, currency, status, created_at
+            FROM checkout_orders
+            WHERE post_purchase_sent=0
+            ORDER BY created_at DESC
+            LIMIT ?
+            """,
+            (int(limit),)
+        )
+        out: List[Dict[str, Any]] = []
+        for row in cur.fetchall():
+            out.append({
+                "order_id": int(row[0]),
+                "chat_id": int(row[1]),
+                "girl_id": int(row[2]),
+                "girl_name": str(row[3] or ""),
+                "amount": float(row[4] or 0.0),
+                "currency": str(row[5] or "RUB"),
+                "status": str(row[6] or "pending"),
+                "created_at": int(row[7] or 0),
+            })
+        return out
+    return await db_run(_op)
 
 async def db_checkout_order_status(order_id: int, status: str, paid: bool, mark_post_purchase_sent: bool = False):
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         if mark_post_purchase_sent:
             con.execute(
                 """
@@ -821,58 +1609,44 @@ async def db_checkout_order_status(order_id: int, status: str, paid: bool, mark_
                 """,
                 (status, now, now if paid else None, order_id)
             )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_favorite_remove(chat_id: int, girl_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("DELETE FROM favorites WHERE chat_id=? AND girl_id=?", (chat_id, girl_id))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_favorite_exists(chat_id: int, girl_id: int) -> bool:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute("SELECT 1 FROM favorites WHERE chat_id=? AND girl_id=? LIMIT 1", (chat_id, girl_id))
-            return cur.fetchone() is not None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute("SELECT 1 FROM favorites WHERE chat_id=? AND girl_id=? LIMIT 1", (chat_id, girl_id))
+        return cur.fetchone() is not None
+    return await db_run(_op)
 
 async def db_favorites_list(chat_id: int) -> List[int]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT girl_id FROM favorites WHERE chat_id=? ORDER BY created_at DESC",
-                (chat_id,)
-            )
-            return [int(r[0]) for r in cur.fetchall()]
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            "SELECT girl_id FROM favorites WHERE chat_id=? ORDER BY created_at DESC",
+            (chat_id,)
+        )
+        return [int(r[0]) for r in cur.fetchall()]
+    return await db_run(_op)
 
 async def db_user_last_seen(chat_id: int) -> Optional[int]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute("SELECT last_seen FROM users WHERE chat_id=?", (chat_id,))
-            row = cur.fetchone()
-            if not row or row[0] is None:
-                return None
-            return int(row[0])
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    pending = _LAST_SEEN_PENDING.get(chat_id)
+    def _op(con):
+        cur = con.execute("SELECT last_seen FROM users WHERE chat_id=?", (chat_id,))
+        return cur.fetchone()
+    row = await db_run(_op)
+    if not row:
+        return None  # юзера нет в БД — UPDATE при сбросе тоже ничего бы не записал
+    stored = int(row[0]) if row[0] is not None else None
+    if pending is not None and (stored is None or pending > stored):
+        return pending
+    return stored
 
 async def db_slot_subscribe(chat_id: int, girl_id: int, known_slots: List[str]):
     payload = json.dumps(known_slots, ensure_ascii=False)
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO slot_subscriptions(chat_id, girl_id, known_slots, created_at, last_notified_at)
@@ -882,54 +1656,40 @@ async def db_slot_subscribe(chat_id: int, girl_id: int, known_slots: List[str]):
             """,
             (chat_id, girl_id, payload, int(time.time()))
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_slot_unsubscribe(chat_id: int, girl_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("DELETE FROM slot_subscriptions WHERE chat_id=? AND girl_id=?", (chat_id, girl_id))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_slot_sub_exists(chat_id: int, girl_id: int) -> bool:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT 1 FROM slot_subscriptions WHERE chat_id=? AND girl_id=? LIMIT 1",
-                (chat_id, girl_id)
-            )
-            return cur.fetchone() is not None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            "SELECT 1 FROM slot_subscriptions WHERE chat_id=? AND girl_id=? LIMIT 1",
+            (chat_id, girl_id)
+        )
+        return cur.fetchone() is not None
+    return await db_run(_op)
 
 async def db_slot_subscriptions() -> List[Dict[str, Any]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT chat_id, girl_id, known_slots FROM slot_subscriptions"
-            )
-            rows = []
-            for chat_id, girl_id, known_slots in cur.fetchall():
-                rows.append({
-                    "chat_id": int(chat_id),
-                    "girl_id": int(girl_id),
-                    "known_slots": str(known_slots or "[]")
-                })
-            return rows
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            "SELECT chat_id, girl_id, known_slots FROM slot_subscriptions"
+        )
+        rows = []
+        for chat_id, girl_id, known_slots in cur.fetchall():
+            rows.append({
+                "chat_id": int(chat_id),
+                "girl_id": int(girl_id),
+                "known_slots": str(known_slots or "[]")
+            })
+        return rows
+    return await db_run(_op)
 
 async def db_slot_sub_update_known(chat_id: int, girl_id: int, known_slots: List[str], touched_notify: bool):
     payload = json.dumps(known_slots, ensure_ascii=False)
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         if touched_notify:
             con.execute(
                 "UPDATE slot_subscriptions SET known_slots=?, last_notified_at=? WHERE chat_id=? AND girl_id=?",
@@ -940,15 +1700,31 @@ async def db_slot_sub_update_known(chat_id: int, girl_id: int, known_slots: List
                 "UPDATE slot_subscriptions SET known_slots=? WHERE chat_id=? AND girl_id=?",
                 (payload, chat_id, girl_id)
             )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
-
-async def db_recent_interest_girl_ids(chat_id: int, limit: int = 20, within_sec: int = 7 * 24 * 3600) -> List[int]:
-    cutoff = int(time.time()) - int(within_sec)
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
+    await db_write(_op)
+
+async def db_reco_candidates(
+    chat_ids: List[int], limit: int = 24, within_sec: int = 7 * 24 * 3600, cooldown_sec: int = 6 * 3600,
+) -> Tuple[Dict[int, List[int]], Dict[int, int]]:
+    """Пачка чатов за одно обращение: (chat_id -> последние просмотры, свежие первыми;
+    chat_id -> время последней рекомендации за cooldown_sec). Историю читаем только у тех,
+    кому рекомендацию ещё не слали."""
+    ids = list(dict.fromkeys(int(x) for x in chat_ids))
+    now = int(time.time())
+    def _op(con):
+        sent: Dict[int, int] = {}
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            marks = ",".join("?" * len(part))
+            cur = con.execute(
+                f"SELECT chat_id, MAX(created_at) FROM reco_push_log WHERE chat_id IN ({marks}) AND created_at>=? GROUP BY chat_id",
+                (*part, now - int(cooldown_sec))
+            )
+            for chat_id, ts in cur.fetchall():
+                sent[int(chat_id)] = int(ts)
+        viewed: Dict[int, List[int]] = {}
+        for chat_id in ids:
+            if chat_id in sent:
+                continue
             cur = con.execute(
                 """
                 SELECT girl_id
@@ -957,68 +1733,55 @@ async def db_recent_interest_girl_ids(chat_id: int, limit: int = 20, within_sec:
                 ORDER BY created_at DESC
                 LIMIT ?
                 """,
-                (chat_id, cutoff, int(limit))
-            )
-            out: List[int] = []
-            for (gid,) in cur.fetchall():
-                try:
-                    out.append(int(gid))
-                except Exception:
-                    pass
-            return out
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
-
-async def db_recent_reco_sent(chat_id: int, within_sec: int = 6 * 3600) -> bool:
-    cutoff = int(time.time()) - int(within_sec)
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT 1 FROM reco_push_log WHERE chat_id=? AND created_at>=? LIMIT 1",
-                (chat_id, cutoff)
+                (chat_id, now - int(within_sec), int(limit))
             )
-            return cur.fetchone() is not None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+            viewed[chat_id] = [int(gid) for (gid,) in cur.fetchall() if gid is not None]
+        return viewed, sent
+    return await db_run(_op)
 
 async def db_mark_reco_sent(chat_id: int):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             "INSERT INTO reco_push_log(chat_id, created_at) VALUES (?,?)",
             (chat_id, int(time.time()))
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
+
+async def db_coview_topk(girl_ids: List[int]) -> Dict[int, List[Tuple[int, int]]]:
+    ids = list(dict.fromkeys(int(x) for x in girl_ids))
+    if not ids:
+        return {}
+    def _op(con):
+        cur = con.execute(
+            f"SELECT girl_id, neighbours FROM coview_topk WHERE girl_id IN ({','.join('?' * len(ids))})",
+            ids
+        )
+        out: Dict[int, List[Tuple[int, int]]] = {}
+        for gid, raw in cur.fetchall():
+            with suppress(Exception):
+                out[int(gid)] = [(int(o), int(c)) for o, c in json.loads(raw)]
+        return out
+    return await db_run(_op)
 
 async def db_channel_state_get(girl_id: int) -> Optional[List[str]]:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
+        cur = con.execute("SELECT known_slots FROM slot_channel_state WHERE girl_id=?", (girl_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
         try:
-            cur = con.execute("SELECT known_slots FROM slot_channel_state WHERE girl_id=?", (girl_id,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            try:
-                data = json.loads(row[0] or "[]")
-                if isinstance(data, list):
-                    return [str(x) for x in data]
-                return []
-            except Exception:
-                return []
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+            data = json.loads(row[0] or "[]")
+            if isinstance(data, list):
+                return [str(x) for x in data]
+            return []
+        except Exception:
+            return []
+    return await db_run(_op)
 
 async def db_channel_state_set(girl_id: int, known_slots: List[str], posted_now: bool = False):
     payload = json.dumps(known_slots, ensure_ascii=False)
     ts = int(time.time()) if posted_now else None
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         if ts is None:
             con.execute(
                 """
@@ -1040,30 +1803,21 @@ async def db_channel_state_set(girl_id: int, known_slots: List[str], posted_now:
                 """,
                 (girl_id, payload, ts)
             )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_sub_reward_exists(chat_id: int) -> bool:
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute("SELECT 1 FROM subscribe_rewards WHERE chat_id=? LIMIT 1", (chat_id,))
-            return cur.fetchone() is not None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute("SELECT 1 FROM subscribe_rewards WHERE chat_id=? LIMIT 1", (chat_id,))
+        return cur.fetchone() is not None
+    return await db_run(_op)
 
 async def db_mark_sub_reward(chat_id: int, coupon: str):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             "INSERT OR IGNORE INTO subscribe_rewards(chat_id, coupon, created_at) VALUES (?,?,?)",
             (chat_id, coupon, int(time.time()))
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def is_user_subscribed(user_id: int) -> bool:
     if not SUBSCRIBE_CHANNEL_ID:
@@ -1079,8 +1833,7 @@ def platega_enabled() -> bool:
     return bool(PLATEGA_MERCHANT_ID and PLATEGA_SECRET)
 
 async def db_add_vip_payment(chat_id: int, transaction_id: str | None, amount: float, currency: str, status: str | None, redirect_url: str | None):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO vip_payments(chat_id, transaction_id, amount, currency, status, redirect_url, created_at)
@@ -1088,15 +1841,12 @@ async def db_add_vip_payment(chat_id: int, transaction_id: str | None, amount: f
             """,
             (chat_id, transaction_id, float(amount), currency, status, redirect_url, int(time.time()))
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_set_vip_flash_offer(chat_id: int, discount_pct: int, valid_hours: int):
     now = int(time.time())
     valid_until = now + max(1, int(valid_hours)) * 3600
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute(
             """
             INSERT INTO vip_flash_offers(chat_id, discount_pct, valid_until, created_at, used_at)
@@ -1109,40 +1859,31 @@ async def db_set_vip_flash_offer(chat_id: int, discount_pct: int, valid_hours: i
             """,
             (chat_id, int(discount_pct), valid_until, now)
         )
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def db_get_vip_flash_offer(chat_id: int) -> Optional[Dict[str, Any]]:
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute(
-                "SELECT discount_pct, valid_until, used_at FROM vip_flash_offers WHERE chat_id=?",
-                (chat_id,)
-            )
-            row = cur.fetchone()
-            if not row:
-                return None
-            discount_pct = int(row[0] or 0)
-            valid_until = int(row[1] or 0)
-            used_at = row[2]
-            if discount_pct <= 0 or valid_until <= now or used_at is not None:
-                return None
-            return {"discount_pct": discount_pct, "valid_until": valid_until}
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        cur = con.execute(
+            "SELECT discount_pct, valid_until, used_at FROM vip_flash_offers WHERE chat_id=?",
+            (chat_id,)
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        discount_pct = int(row[0] or 0)
+        valid_until = int(row[1] or 0)
+        used_at = row[2]
+        if discount_pct <= 0 or valid_until <= now or used_at is not None:
+            return None
+        return {"discount_pct": discount_pct, "valid_until": valid_until}
+    return await db_run(_op)
 
 async def db_mark_vip_flash_offer_used(chat_id: int):
     now = int(time.time())
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         con.execute("UPDATE vip_flash_offers SET used_at=? WHERE chat_id=? AND used_at IS NULL", (now, chat_id))
-        con.commit()
-        con.close()
-    await asyncio.to_thread(_op)
+    await db_write(_op)
 
 async def platega_create_vip_payment(user, amount: Optional[float] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
@@ -1177,7 +1918,7 @@ async def platega_create_vip_payment(user, amount: Optional[float] = None) -> Tu
     }
     url = f"{PLATEGA_BASE_URL}/transaction/process"
     try:
-        async with aiohttp.ClientSession(connector=build_http_connector()) as s:
+        async with http_session("platega") as s:
             async with s.post(url, json=body, headers=headers, timeout=25) as r:
                 txt = await r.text()
                 if r.status >= 400:
@@ -1250,7 +1991,7 @@ def checkout_api_url(path: str) -> str:
 async def checkout_get(path: str, params: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
     url = checkout_api_url(path)
     try:
-        async with aiohttp.ClientSession(connector=build_http_connector()) as s:
+        async with http_session("checkout") as s:
             async with s.get(url, params=params or {}, timeout=25) as r:
                 txt = await r.text()
                 if r.status >= 400:
@@ -1262,7 +2003,7 @@ async def checkout_get(path: str, params: Optional[Dict[str, Any]] = None) -> Tu
 async def checkout_post(path: str, payload: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
     url = checkout_api_url(path)
     try:
-        async with aiohttp.ClientSession(connector=build_http_connector()) as s:
+        async with http_session("checkout") as s:
             async with s.post(url, json=payload, timeout=25) as r:
                 txt = await r.text()
                 if r.status >= 400:
@@ -1515,8 +2256,7 @@ async def wc_create_order_for_girl(user, g: Dict[str, Any], checkout: Optional[D
             }]
 
     try:
-        auth = aiohttp.BasicAuth(WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-        async with aiohttp.ClientSession(auth=auth, connector=build_http_connector()) as s:
+        async with http_session("woo") as s:
             async with s.post(f"{WC_API_URL.rstrip('/')}/orders", json=payload, timeout=25) as r:
                 txt = await r.text()
                 if r.status >= 400:
@@ -1540,8 +2280,7 @@ async def wc_get_order_status(order_id: int) -> Tuple[Optional[str], Optional[st
     if not wc_enabled() or order_id <= 0:
         return None, "woo disabled"
     try:
-        auth = aiohttp.BasicAuth(WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-        async with aiohttp.ClientSession(auth=auth, connector=build_http_connector()) as s:
+        async with http_session("woo") as s:
             async with s.get(f"{WC_API_URL.rstrip('/')}/orders/{int(order_id)}", timeout=20) as r:
                 txt = await r.text()
                 if r.status >= 400:
@@ -1575,77 +2314,612 @@ def tg_user_link(u) -> str:
 # ─── CACHE & HTTP ────────────────────────────────────────────────────────────
 _manifest_cache: Dict[str, Any] = {}
 _manifest_ts = 0.0
+_manifest_version = 0  # растёт только при изменении содержимого
+_manifest_fails = 0
+_manifest_retry_at = 0.0
+_manifest_inflight: Optional[asyncio.Task] = None
 _slots_cache: Dict[str, Any] = {}
 _slots_ts: Dict[str, float] = {}
+_slots_version: Dict[str, int] = {}  # растёт только при изменении содержимого
+# url -> {"etag", "last_modified", "digest"} для условных GET
+_HTTP_VALIDATORS: Dict[str, Dict[str, str]] = {}
 TTL = 60  # сек
 
 def girls_list(mf: Dict[str, Any]) -> List[Dict[str, Any]]:
     return list(mf.get("girls", []))
 
-def girl_by_id(mf: Dict[str, Any], gid: int) -> Optional[Dict[str, Any]]:
+# Индекс снимка манифеста: строится один раз на версию, дальше все выборки — O(1).
+# Анкеты отдаются как MappingProxyType (с _index/_total), без копирования на каждый вызов.
+# Индекс живёт вместе со снимком: держим индексы MANIFEST_INDEX_KEEP последних
+# снимков (текущий всегда), так что вызов, доживший со старым mf через await
+# до обновления, не перестраивает индекс и не вытесняет текущий.
+MANIFEST_INDEX_KEEP = 2
+_mf_indexes: Dict[int, Mapping[str, Any]] = {}  # id(mf) -> индекс; индекс держит сам mf, id не переиспользуется
+
+@dataclass(frozen=True, slots=True)
+class SlotIndex:
+    """Слоты анкеты (ops_calendar + slot_json), разобранные за один проход и отсортированные по dt.
+    Хранит три вида дедупликации, как у прежних парсеров: подписи — по (dt, подпись),
+    ключи — по "date|start|end", сегодняшние — по (start, end) внутри дня календаря."""
+    label_dts: Tuple[datetime, ...]
+    labels: Tuple[str, ...]
+    key_dts: Tuple[datetime, ...]
+    keys: Tuple[str, ...]
+    # день календаря -> (начала, "start - end", концы); конец после полуночи — уже следующим днём
+    days: Mapping[str, Tuple[Tuple[datetime, ...], Tuple[str, ...], Tuple[datetime, ...]]]
+
+    def future(self, now: datetime) -> List[str]:
+        return list(self.labels[bisect.bisect_left(self.label_dts, now):])
+
+    def future_keys(self, now: datetime) -> List[str]:
+        return list(self.keys[bisect.bisect_left(self.key_dts, now):])
+
+    def first(self, now: datetime) -> Optional[Tuple[datetime, str]]:
+        i = bisect.bisect_left(self.label_dts, now)
+        return (self.label_dts[i], self.labels[i]) if i < len(self.labels) else None
+
+    def today(self, now: datetime) -> List[Tuple[datetime, str]]:
+        day = self.days.get(now.strftime("%Y-%m-%d"))
+        if not day:
+            return []
+        dts, labels, _ = day
+        i = bisect.bisect_left(dts, now)
+        return list(zip(dts[i:], labels[i:]))
+
+def _slot_end_dt(day_s: str, start_dt: datetime, end: str) -> datetime:
+    end_dt = _parse_slot_dt(day_s, end)
+    if end_dt is None and end.startswith("24:"):
+        end_dt = _parse_slot_dt(day_s, "00" + end[2:])
+    if end_dt is None:
+        return start_dt + timedelta(hours=1)
+    if end_dt <= start_dt:
+        end_dt += timedelta(days=1)
+    return end_dt
+
+def _build_slot_index(g: Mapping[str, Any], slots: Mapping[str, Any]) -> SlotIndex:
+    labels: Dict[Tuple[datetime, str], None] = {}
+    keys: Dict[str, datetime] = {}
+    days: Dict[str, Dict[Tuple[str, str], datetime]] = {}
+
+    def _push(date_s: Any, start: Any, end: Any, label: Any, available: Any, day_s: Optional[str]):
+        if available is False:
+            return
+        start = (start or "").strip()
+        end = (end or "").strip()
+        if not start or not end or start == end:
+            return
+        date_s = str(date_s) if date_s else None
+        if day_s is not None:
+            day_dt = _parse_slot_dt(day_s, start)
+            if day_dt:
+                days.setdefault(day_s, {}).setdefault((start, end), day_dt)
+        dt = _parse_slot_dt(date_s, start)
+        if not dt:
+            return
+        label_core = (label or f"{start} - {end}").strip()
+        labels.setdefault((dt, f"{dt:%d.%m} {label_core}"), None)
+        keys.setdefault(f"{date_s}|{start}|{end}", dt)
+
+    # New format from girls.json
+    for day in (g.get("ops_calendar") or []):
+        day_s = str(day.get("date"))
+        for sl in (day.get("slots") or []):
+            _push(sl.get("date") or day.get("date"), sl.get("start"), sl.get("end"),
+                  sl.get("label"), sl.get("available", True), day_s)
+    # Backward-compatible format from slot_json
+    for sl in (slots.get("slots") or []):
+        _push(sl.get("date"), sl.get("start"), sl.get("end"), sl.get("label"), sl.get("available", True), None)
+
+    # sorted() стабилен: при равном dt порядок как у прежних парсеров (календарь, затем slot_json)
+    by_label = sorted(labels, key=lambda x: x[0])
+    by_key = sorted(keys.items(), key=lambda x: x[1])
+    by_day = {}
+    for day_s, entries in days.items():
+        items = sorted(entries.items(), key=lambda x: x[1])
+        by_day[day_s] = (
+            tuple(dt for _, dt in items),
+            tuple(f"{st} - {en}" for (st, en), _ in items),
+            tuple(_slot_end_dt(day_s, dt, en) for (_, en), dt in items),
+        )
+    return SlotIndex(
+        label_dts=tuple(dt for dt, _ in by_label),
+        labels=tuple(lbl for _, lbl in by_label),
+        key_dts=tuple(dt for _, dt in by_key),
+        keys=tuple(k for k, _ in by_key),
+        days=MappingProxyType(by_day),
+    )
+
+def slot_index(g: Mapping[str, Any], slots: Optional[Mapping[str, Any]] = None) -> SlotIndex:
+    """SlotIndex на (анкету, версию манифеста, версию slot_json); чужие dict'ы разбираются без кэша."""
+    slots = slots or {}
+    ix, rec = None, None
+    for cand in reversed(list(_mf_indexes.values())):
+        with suppress(Exception):
+            rec = cand["rec_by_id"].get(int(g.get("id")))
+        if rec is not None and (g is rec.view or g is rec.raw):
+            ix = cand
+            break
+        rec = None
+    if rec is None:
+        return _build_slot_index(g, slots)
+    if not slots:
+        return rec.slots
+    url = str(g.get("slot_json") or "")
+    if slots is not _slots_cache.get(url):
+        return _build_slot_index(g, slots)
+    ver = slots_version(url)
+    hit = ix["slot_cache"].get((rec.gid, url))
+    if hit is None or hit[0] != ver:
+        try:
+            built = _build_slot_index(g, slots)
+        except Exception as e:
+            log.warning("slot_json of girl id=%s not indexed: %r", rec.gid, e)
+            built = rec.slots  # остаётся хотя бы ops_calendar
+        hit = ix["slot_cache"][(rec.gid, url)] = (ver, built)
+    return hit[1]
+
+@dataclass(frozen=True, slots=True)
+class AvailTimeline:
+    """Все слоты ops_calendar каталога одним массивом по возрастанию начала (при равном —
+    в порядке анкет). Окна по началу — bisect; "свободна в момент T" — bisect по началам
+    в (T - самый длинный слот, T] и проверка конца."""
+    starts: Tuple[datetime, ...]
+    ends: Tuple[datetime, ...]
+    gids: Tuple[int, ...]
+    labels: Tuple[str, ...]
+    max_len: timedelta
+
+    def starting(self, t_from: datetime, t_to: datetime, limit: int = 0) -> Dict[int, Tuple[datetime, str]]:
+        """gid -> первый слот с началом в [t_from, t_to), по возрастанию начала."""
+        out: Dict[int, Tuple[datetime, str]] = {}
+        hi = bisect.bisect_left(self.starts, t_to)
+        for i in range(bisect.bisect_left(self.starts, t_from), hi):
+            gid = self.gids[i]
+            if gid not in out:
+                out[gid] = (self.starts[i], self.labels[i])
+                if limit and len(out) >= limit:
+                    break
+        return out
+
+    def free_today(self, now: datetime, limit: int = 0) -> Dict[int, Tuple[datetime, str]]:
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return self.starting(now, midnight, limit)
+
+    def free_at(self, t: datetime) -> Dict[int, Tuple[datetime, str]]:
+        """gid -> (конец, "start - end") слота, который идёт в момент t."""
+        out: Dict[int, Tuple[datetime, str]] = {}
+        hi = bisect.bisect_right(self.starts, t)
+        for i in range(bisect.bisect_right(self.starts, t - self.max_len), hi):
+            if self.ends[i] > t and self.gids[i] not in out:
+                out[self.gids[i]] = (self.ends[i], self.labels[i])
+        return out
+
+def _build_timeline(recs: Tuple["GirlRec", ...]) -> AvailTimeline:
+    rows: List[Tuple[datetime, int, datetime, int, str]] = []
+    for n, rec in enumerate(recs):
+        for dts, labels, ends in rec.slots.days.values():
+            rows.extend(zip(dts, [n] * len(dts), ends, [rec.gid] * len(dts), labels))
+    rows.sort(key=lambda r: (r[0], r[1]))
+    return AvailTimeline(
+        starts=tuple(r[0] for r in rows),
+        ends=tuple(r[2] for r in rows),
+        gids=tuple(r[3] for r in rows),
+        labels=tuple(r[4] for r in rows),
+        max_len=max((r[2] - r[0] for r in rows), default=timedelta(0)),
+    )
+
+def _bits(mask: int) -> List[int]:
+    """Позиции единичных битов по возрастанию."""
+    s = bin(mask)[:1:-1]
+    out: List[int] = []
+    i = s.find("1")
+    while i >= 0:
+        out.append(i)
+        i = s.find("1", i + 1)
+    return out
+
+@dataclass(slots=True)
+class FilterEngine:
+    """Фасеты мастера find: как битсеты по позициям в recs (бит i — recs[i]).
+    Статичные фасеты считаются на версию манифеста; "есть окна" и "сегодня" зависят от
+    времени и досчитываются инкрементально, пока не прошёл ближайший слот."""
+    recs: Tuple["GirlRec", ...]
+    timeline: AvailTimeline
+    facets: Dict[str, int]
+    rating: Dict[str, Tuple[float, ...]]
+    price_part: Tuple[Optional[float], ...]
+    pos: Dict[int, int]
+    last_dts: Tuple[datetime, ...]  # последний слот каждой анкеты со слотами, по возрастанию
+    last_pos: Tuple[int, ...]
+    future_i: int = 0
+    future_mask: int = 0
+    future_flags: Optional[bytearray] = None  # тот же future_mask побайтно — для проверки в цикле оценки
+    today_until: Optional[datetime] = None
+    today: Optional[Dict[int, Tuple[datetime, str]]] = None
+    today_mask: int = 0
+    today_first: Optional[Dict[int, datetime]] = None  # позиция -> первый слот сегодня
+
+    def future(self, now: datetime) -> int:
+        i = bisect.bisect_left(self.last_dts, now)
+        if i < self.future_i or self.future_flags is None:
+            self.future_i, self.future_mask = 0, sum(1 << p for p in self.last_pos)
+            self.future_flags = bytearray(len(self.recs))
+            for p in self.last_pos:
+                self.future_flags[p] = 1
+        for p in self.last_pos[self.future_i:i]:
+            self.future_mask &= ~(1 << p)
+            self.future_flags[p] = 0
+        self.future_i = i
+        return self.future_mask
+
+    def free_today(self, now: datetime) -> Tuple[Dict[int, datetime], int]:
+        # первые сегодняшние слоты не меняются, пока не начался самый ранний из них
+        if self.today is None or now > self.today_until or now.date() != self.today_until.date():
+            self.today = self.timeline.free_today(now)
+            self.today_first = {self.pos[gid]: dt for gid, (dt, _) in self.today.items()}
+            self.today_mask = sum(1 << p for p in self.today_first)
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            self.today_until = min((dt for dt, _ in self.today.values()), default=midnight - timedelta(microseconds=1))
+        return self.today_first, self.today_mask
+
+def _build_filter_engine(recs: Tuple["GirlRec", ...], timeline: AvailTimeline) -> FilterEngine:
+    facets = {k: 0 for k in ("low", "mid", "high", "popular", "gamer", "new")}
+    top: List[float] = []
+    safe: List[float] = []
+    price_part: List[Optional[float]] = []
+    lasts: List[Tuple[datetime, int]] = []
+    for i, rec in enumerate(recs):
+        bit = 1 << i
+        p = rec.price
+        if p is not None:
+            if p <= 500:
+                facets["low"] |= bit
+            if 500 <= p <= 1000:
+                facets["mid"] |= bit
+            if p >= 1000:
+                facets["high"] |= bit
+        if {"bestseller", "main"} & rec.cats:
+            facets["popular"] |= bit
+        if rec.has_games:
+            facets["gamer"] |= bit
+        if rec.has_achievements:
+            facets["new"] |= bit
+        bs, main = "bestseller" in rec.cats, "main" in rec.cats
+        top.append(0.0 + (3.0 if bs else 0.0) + (2.0 if main else 0.0))
+        safe.append(0.0 + (2.0 if main else 0.0) + (1.0 if bs else 0.0))
+        price_part.append(max(0.0, 1.0 - min(1.0, p / 2500.0)) if p is not None else None)
+        if rec.slots.label_dts:
+            lasts.append((rec.slots.label_dts[-1], i))
+    lasts.sort()
+    return FilterEngine(
+        recs=recs,
+        timeline=timeline,
+        facets=facets,
+        rating={"top": tuple(top), "safe": tuple(safe)},
+        price_part=tuple(price_part),
+        pos={rec.gid: i for i, rec in enumerate(recs)},
+        last_dts=tuple(dt for dt, _ in lasts),
+        last_pos=tuple(i for _, i in lasts),
+    )
+
+@dataclass(frozen=True, slots=True)
+class GirlRec:
+    """Анкета, нормализованная один раз на версию манифеста: всё, что читает ранжирование."""
+    gid: int
+    view: Mapping[str, Any]
+    raw: Mapping[str, Any]
+    price: Optional[float]
+    cats: frozenset[str]
+    style: frozenset[str]
+    order: int
+    has_games: bool
+    has_achievements: bool
+    slots: SlotIndex  # только ops_calendar; со slot_json — через slot_index()
+
+def _ingest_girl(gid: int, raw: Dict[str, Any], view: Mapping[str, Any]) -> GirlRec:
+    acf = raw.get("acf") or {}
+    games = acf.get("favorite_games") or []
+    ach = acf.get("achievements") or []
+    return GirlRec(
+        gid=gid,
+        view=view,
+        raw=raw,
+        price=_girl_price_num(raw),
+        cats=frozenset(_cat_slugs(raw)),
+        style=frozenset(_girl_style_tokens(raw)),
+        order=_girl_order(raw),
+        has_games=isinstance(games, list) and len(games) > 0,
+        has_achievements=isinstance(ach, list) and len(ach) > 0,
+        slots=_build_slot_index(raw, {}),
+    )
+
+def _build_manifest_index(mf: Dict[str, Any]) -> Mapping[str, Any]:
     arr = girls_list(mf)
     total = len(arr)
+    views: List[Mapping[str, Any]] = []
+    by_id: Dict[int, Mapping[str, Any]] = {}
+    recs: List[GirlRec] = []
+    by_cat: Dict[str, List[int]] = {}
     for i, x in enumerate(arr):
+        view = MappingProxyType({**x, "_index": i, "_total": total}) if isinstance(x, dict) else x
+        views.append(view)
         try:
-            if int(x.get("id")) == int(gid):
-                y = x.copy()
-                y["_index"] = i
-                y["_total"] = total
-                return y
+            gid = int(x.get("id"))
         except Exception:
             continue
-    return None
+        if gid in by_id:
+            continue
+        by_id[gid] = view
+        # битая анкета остаётся в каталоге как есть, но не роняет индекс остальных
+        try:
+            rec = _ingest_girl(gid, x, view)
+        except Exception as e:
+            log.warning("MANIFEST: girl id=%s not indexed: %r", gid, e)
+            continue
+        recs.append(rec)
+        for slug in rec.cats:
+            by_cat.setdefault(slug, []).append(gid)
+    timeline = _build_timeline(tuple(recs))
+    return MappingProxyType({
+        "mf": mf,
+        "views": tuple(views),
+        "by_id": MappingProxyType(by_id),
+        "recs": tuple(recs),
+        "rec_by_id": MappingProxyType({r.gid: r for r in recs}),
+        "slot_cache": {},  # (gid, slot_json) -> (версия slot_json, SlotIndex)
+        "timeline": timeline,
+        "filters": _build_filter_engine(tuple(recs), timeline),
+        "reco": _build_reco_index(tuple(recs)),
+        "search": _build_search_index(tuple(recs)),
+        "by_cat": MappingProxyType({k: tuple(v) for k, v in by_cat.items()}),
+    })
 
-def girl_by_index(mf: Dict[str, Any], idx: int) -> Optional[Dict[str, Any]]:
-    arr = girls_list(mf)
-    if not arr: return None
-    idx = idx % len(arr)
-    g = arr[idx].copy()
-    g["_index"] = idx
-    g["_total"] = len(arr)
-    return g
+def _manifest_index_keep(ix: Mapping[str, Any]):
+    _mf_indexes[id(ix["mf"])] = ix
+    for key in list(_mf_indexes):
+        if len(_mf_indexes) <= MANIFEST_INDEX_KEEP:
+            break
+        if _mf_indexes[key]["mf"] is not _manifest_cache:
+            del _mf_indexes[key]
+
+def manifest_index(mf: Dict[str, Any]) -> Mapping[str, Any]:
+    ix = _mf_indexes.get(id(mf))
+    if ix is None:
+        ix = _build_manifest_index(mf)
+        _manifest_index_keep(ix)
+    return ix
+
+def girl_by_id(mf: Dict[str, Any], gid: int) -> Optional[Mapping[str, Any]]:
+    try:
+        return manifest_index(mf)["by_id"].get(int(gid))
+    except Exception:
+        return None
+
+def girl_by_index(mf: Dict[str, Any], idx: int) -> Optional[Mapping[str, Any]]:
+    views = manifest_index(mf)["views"]
+    if not views: return None
+    return views[idx % len(views)]
+
+def availability(mf: Dict[str, Any]) -> AvailTimeline:
+    return manifest_index(mf)["timeline"]
+
+def girl_recs(mf: Dict[str, Any]) -> Tuple[GirlRec, ...]:
+    return manifest_index(mf)["recs"]
+
+def girl_rec(mf: Dict[str, Any], gid: int) -> Optional[GirlRec]:
+    try:
+        return manifest_index(mf)["rec_by_id"].get(int(gid))
+    except Exception:
+        return None
+
+def girls_in_category(mf: Dict[str, Any], slug: str) -> Tuple[int, ...]:
+    return manifest_index(mf)["by_cat"].get(slug.strip().lower(), ())
 
 async def http_get_json(url: str) -> Any:
-    connector = build_http_connector()
-    async with aiohttp.ClientSession(connector=connector) as s:
+    async with http_session("manifest") as s:
         async with s.get(url, timeout=20) as r:
             r.raise_for_status()
             return await r.json()
 
-def build_http_connector() -> aiohttp.TCPConnector:
-    ssl_no_verify = str(os.getenv("SSL_NO_VERIFY", "0")).strip().lower() in {"1", "true", "yes", "on"}
-    ssl_ctx: ssl.SSLContext | bool = True
-    if ssl_no_verify:
-        ssl_ctx = False
-    elif certifi is not None:
-        # Prefer certifi CA bundle on macOS/Python builds with broken system trust store.
-        ssl_ctx = ssl.create_default_context(cafile=certifi.where())
-    return aiohttp.TCPConnector(ssl=ssl_ctx)
+async def http_get_json_if_changed(url: str, cached: bool) -> Tuple[Any, bool]:
+    """Условный GET: (данные, True) при новом содержимом, (None, False) — если не изменилось.
+    304 и 200 с тем же sha1 тела не декодируются. cached=False — у вызывающего нет копии,
+    валидаторы не шлём. Валидаторы запоминаются только после успешного декода; если
+    вызывающий данные не принял — http_validators_forget(url), иначе тот же битый ответ
+    дальше будет выглядеть как "не изменилось"."""
+    v = _HTTP_VALIDATORS.get(url) if cached else None
+    headers = {}
+    if v:
+        if v.get("etag"):
+            headers["If-None-Match"] = v["etag"]
+        if v.get("last_modified"):
+            headers["If-Modified-Since"] = v["last_modified"]
+    async with http_session("manifest") as s:
+        async with s.get(url, headers=headers, timeout=20) as r:
+            if r.status == 304:
+                if v:
+                    return None, False
+                # условных заголовков не слали — сравнивать не с чем, это не "не изменилось"
+                raise RuntimeError(f"unexpected 304 without validators for {url}")
+            r.raise_for_status()
+            body = await r.read()
+            etag, last_modified = r.headers.get("ETag", ""), r.headers.get("Last-Modified", "")
+    digest = hashlib.sha1(body).hexdigest()
+    if v and v.get("digest") == digest:
+        return None, False
+    data = json.loads(body)
+    _HTTP_VALIDATORS[url] = {"etag": etag, "last_modified": last_modified, "digest": digest}
+    return data, True
+
+def http_validators_forget(url: str) -> None:
+    _HTTP_VALIDATORS.pop(url, None)
+
+# Один ClientSession на апстрим: keep-alive пул, DNS-кэш и TLS-сессии живут
+# между вызовами, а не создаются заново на каждый запрос.
+# upstream -> (таймаут по умолчанию, лимит на хост)
+HTTP_UPSTREAMS: Dict[str, Tuple[float, int]] = {
+    "manifest": (20, HTTP_PER_HOST),  # манифест, слоты, картинки анкет
+    "checkout": (25, HTTP_PER_HOST),
+    "woo": (25, max(2, HTTP_PER_HOST // 2)),
+    "platega": (25, max(2, HTTP_PER_HOST // 2)),
+    "ops": (10, max(2, HTTP_PER_HOST // 2)),
+}
+_HTTP_SESSIONS: Dict[str, aiohttp.ClientSession] = {}
+_HTTP_SSL_CTX: Any = None  # ssl.SSLContext | bool, создаётся один раз
+
+def http_ssl_context() -> ssl.SSLContext | bool:
+    global _HTTP_SSL_CTX
+    if _HTTP_SSL_CTX is None:
+        ssl_no_verify = str(os.getenv("SSL_NO_VERIFY", "0")).strip().lower() in {"1", "true", "yes", "on"}
+        ssl_ctx: ssl.SSLContext | bool = True
+        if ssl_no_verify:
+            ssl_ctx = False
+        elif certifi is not None:
+            # Prefer certifi CA bundle on macOS/Python builds with broken system trust store.
+            ssl_ctx = ssl.create_default_context(cafile=certifi.where())
+        _HTTP_SSL_CTX = ssl_ctx
+    return _HTTP_SSL_CTX
+
+def build_http_connector(limit_per_host: int = HTTP_PER_HOST) -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        ssl=http_ssl_context(),
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_SEC,
+    )
+
+def http_client(upstream: str) -> aiohttp.ClientSession:
+    s = _HTTP_SESSIONS.get(upstream)
+    if s is None or s.closed:
+        timeout, per_host = HTTP_UPSTREAMS[upstream]
+        auth = None
+        if upstream == "woo" and WC_CONSUMER_KEY:
+            auth = aiohttp.BasicAuth(WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
+        s = aiohttp.ClientSession(
+            connector=build_http_connector(per_host),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            auth=auth,
+        )
+        _HTTP_SESSIONS[upstream] = s
+    return s
 
-async def get_manifest(force=False) -> Dict[str, Any]:
-    global _manifest_cache, _manifest_ts
-    now = time.time()
-    if not force and _manifest_cache and now - _manifest_ts < TTL:
-        return _manifest_cache
+@asynccontextmanager
+async def http_session(upstream: str):
+    """Общий клиент апстрима; в отличие от `async with ClientSession()` не закрывается на выходе."""
+    yield http_client(upstream)
+
+def http_init() -> None:
+    for upstream in HTTP_UPSTREAMS:
+        http_client(upstream)
+
+async def http_close() -> None:
+    sessions = list(_HTTP_SESSIONS.values())
+    _HTTP_SESSIONS.clear()
+    for s in sessions:
+        with suppress(Exception):
+            await s.close()
+
+async def _manifest_fetch() -> bool:
+    global _manifest_cache, _manifest_ts, _manifest_version, _manifest_fails, _manifest_retry_at
     try:
-        data = await http_get_json(GIRLS_MANIFEST_URL)
-        _manifest_cache = data or {}
-        _manifest_ts = now
-        log.info("MANIFEST: fetched %d girls", len(girls_list(_manifest_cache)))
-        return _manifest_cache
+        data, changed = await http_get_json_if_changed(GIRLS_MANIFEST_URL, bool(_manifest_cache))
     except Exception as e:
-        log.exception("MANIFEST fetch failed: %s", e)
-        return _manifest_cache or {}
+        _manifest_fails += 1
+        delay = min(MANIFEST_BACKOFF_MAX, 5 * 2 ** min(_manifest_fails - 1, 10))
+        _manifest_retry_at = time.time() + delay
+        log.warning(
+            "MANIFEST fetch failed (%d in a row, retry in %ds, serving v%d age=%.0fs): %s",
+            _manifest_fails, delay, _manifest_version, manifest_age(), e,
+        )
+        return False
+    _manifest_ts = time.time()
+    _manifest_fails = 0
+    _manifest_retry_at = 0.0
+    if not changed:
+        log.debug("MANIFEST: not modified (v%d)", _manifest_version)
+        return True
+    # индекс — до подмены: если новый снимок не индексируется, продолжаем отдавать прежний
+    fresh = data or {}
+    try:
+        ix = _build_manifest_index(fresh)
+    except Exception as e:
+        log.exception("MANIFEST: new copy not indexable, serving v%d: %s", _manifest_version, e)
+        http_validators_forget(GIRLS_MANIFEST_URL)  # следующий опрос снова скачает и проверит
+        return False
+    _manifest_cache = fresh
+    _manifest_version += 1
+    _manifest_index_keep(ix)
+    free_today_invalidate()
+    log.info("MANIFEST: fetched %d girls (v%d)", len(girls_list(_manifest_cache)), _manifest_version)
+    return True
+
+def _manifest_kick() -> asyncio.Task:
+    global _manifest_inflight
+    if _manifest_inflight is None or _manifest_inflight.done():
+        _manifest_inflight = asyncio.create_task(_manifest_fetch())
+    return _manifest_inflight
+
+async def manifest_refresh() -> bool:
+    """Один запрос к апстриму на всех: параллельные вызовы ждут уже летящий."""
+    return await asyncio.shield(_manifest_kick())
+
+def manifest_version() -> int:
+    return _manifest_version
+
+def slots_version(slot_json_url: str) -> int:
+    return _slots_version.get(slot_json_url, 0)
+
+def manifest_age() -> float:
+    return time.time() - _manifest_ts if _manifest_ts else float("inf")
+
+def manifest_info() -> Dict[str, Any]:
+    return {
+        "version": _manifest_version,
+        "age": manifest_age(),
+        "girls": len(girls_list(_manifest_cache)),
+        "fails": _manifest_fails,
+        "refreshing": bool(_manifest_inflight and not _manifest_inflight.done()),
+    }
+
+async def get_manifest(force=False) -> Dict[str, Any]:
+    """Текущий снимок манифеста сразу; протухший обновляется в фоне (stale-while-revalidate).
+    Ждём апстрим только при force или если снимка ещё нет."""
+    now = time.time()
+    if force or (not _manifest_cache and now >= _manifest_retry_at):
+        await manifest_refresh()
+    elif manifest_age() >= TTL and now >= _manifest_retry_at:
+        _manifest_kick()
+    return _manifest_cache
+
+async def manifest_refresher():
+    """Обновляет манифест заранее, до истечения TTL; при ошибках — по backoff."""
+    while True:
+        try:
+            wait = max(0.0, TTL * MANIFEST_REFRESH_AHEAD - manifest_age())
+            if _manifest_fails:
+                wait = max(0.0, _manifest_retry_at - time.time())
+            if wait:
+                await asyncio.sleep(min(wait, TTL))
+                continue
+            await manifest_refresh()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("MANIFEST refresher error: %s", e)
+            await asyncio.sleep(5)
 
 async def get_slots(slot_json_url: str) -> Dict[str, Any]:
     now = time.time()
     if slot_json_url in _slots_cache and now - _slots_ts.get(slot_json_url, 0) < TTL:
         return _slots_cache[slot_json_url]
     try:
-        data = await http_get_json(slot_json_url)
-        _slots_cache[slot_json_url] = data or {}
+        data, changed = await http_get_json_if_changed(slot_json_url, slot_json_url in _slots_cache)
         _slots_ts[slot_json_url] = now
-        log.debug("SLOTS: fetched '%s'", slot_json_url)
+        if changed:
+            _slots_cache[slot_json_url] = data or {}
+            _slots_version[slot_json_url] = _slots_version.get(slot_json_url, 0) + 1
+            log.debug("SLOTS: fetched '%s' (v%d)", slot_json_url, _slots_version[slot_json_url])
         return _slots_cache[slot_json_url]
     except Exception as e:
         log.warning("SLOTS fetch failed for '%s': %s", slot_json_url, e)
@@ -1688,6 +2962,7 @@ def profile_text(g: Dict[str, Any], slots: Dict[str, Any]) -> str:
 def build_social_proof(g: Dict[str, Any]) -> List[str]:
     return []
 
+@lru_cache(maxsize=65536)
 def _parse_slot_dt(date_s: str | None, time_s: str | None) -> Optional[datetime]:
     if not date_s or not time_s:
         return None
@@ -1700,213 +2975,73 @@ def _msk_now_naive() -> datetime:
     return datetime.utcnow() + timedelta(hours=3)
 
 def _today_slots_from_ops_calendar(g: Dict[str, Any]) -> List[Tuple[datetime, str]]:
-    now = _msk_now_naive()
-    today_s = now.strftime("%Y-%m-%d")
-    out: List[Tuple[datetime, str]] = []
-    seen: set[str] = set()
-    for day in (g.get("ops_calendar") or []):
-        if str(day.get("date")) != today_s:
-            continue
-        for s in (day.get("slots") or []):
-            if s.get("available", True) is False:
-                continue
-            start = str(s.get("start") or "").strip()
-            end = str(s.get("end") or "").strip()
-            if not start or not end or start == end:
-                continue
-            dt = _parse_slot_dt(today_s, start)
-            if not dt or dt < now:
-                continue
-            key = f"{today_s}|{start}|{end}"
-            if key in seen:
-                continue
-            seen.add(key)
-            out.append((dt, f"{start} - {end}"))
-    out.sort(key=lambda x: x[0])
-    return out
+    return slot_index(g).today(_msk_now_naive())
 
 def pick_free_today(mf: Dict[str, Any], limit: int = 5) -> List[Dict[str, Any]]:
-    arr = girls_list(mf) or []
-    ranked: List[Tuple[datetime, Dict[str, Any], str]] = []
-    for g in arr:
-        slots_today = _today_slots_from_ops_calendar(g)
-        if not slots_today:
-            continue
-        first_dt, first_label = slots_today[0]
-        ranked.append((first_dt, g, first_label))
-    ranked.sort(key=lambda x: x[0])
+    first = availability(mf).free_today(_msk_now_naive(), limit)
     out: List[Dict[str, Any]] = []
-    for first_dt, g, first_label in ranked[:limit]:
-        item = g.copy()
+    for gid, (first_dt, first_label) in first.items():
+        item = girl_by_id(mf, gid).copy()
         item["_first_today_slot"] = first_label
-        item["_first_today_dt"] = first_dt
-        out.append(item)
-    return out
-
-def _has_future_slots(g: Dict[str, Any]) -> bool:
-    return len(collect_available_slots(g, {})) > 0
-
-def _filter_pick_girls(
-    mf: Dict[str, Any],
-    budget: str = "any",
-    style: str = "any",
-    date_pref: str = "any",
-    rating_pref: str = "any",
-    limit: int = 7
-) -> List[Dict[str, Any]]:
-    arr = girls_list(mf) or []
-    out: List[Tuple[float, Dict[str, Any]]] = []
-    now = _msk_now_naive()
-    today_s = now.strftime("%Y-%m-%d")
-
-    for g in arr:
-        p = _girl_price_num(g)
-        if budget == "low" and (p is None or p > 500):
-            continue
-        if budget == "mid" and (p is None or p < 500 or p > 1000):
-            continue
-        if budget == "high" and (p is None or p < 1000):
-            continue
-
-        cats = set(_cat_slugs(g))
-        if style == "popular" and not ({"bestseller", "main"} & cats):
-            continue
-        if style == "gamer":
-            games = (g.get("acf") or {}).get("favorite_games") or []
-            if not isinstance(games, list) or len(games) == 0:
-                continue
-        if style == "new":
-            ach = (g.get("acf") or {}).get("achievements") or []
-            if not isinstance(ach, list) or len(ach) == 0:
-                continue
-
-        today_slots = _today_slots_from_ops_calendar(g)
-        has_today = len(today_slots) > 0
-        has_any = _has_future_slots(g)
-        if date_pref == "today" and not has_today:
-            continue
-        if date_pref == "soon" and not has_any:
-            continue
-
-        score = 0.0
-        if rating_pref == "top":
-            if "bestseller" in cats:
-                score += 3.0
-            if "main" in cats:
-                score += 2.0
-        elif rating_pref == "safe":
-            if "main" in cats:
-                score += 2.0
-            if "bestseller" in cats:
-                score += 1.0
-
-        if has_today:
-            score += 1.5
-            score += max(0.0, 0.6 - min(0.6, (today_slots[0][0] - now).total_seconds() / 36000.0))
-        elif has_any:
-            score += 0.4
-
-        if p is not None:
-            score += max(0.0, 1.0 - min(1.0, p / 2500.0))
-
-        out.append((score, g))
-
-    out.sort(key=lambda x: x[0], reverse=True)
-    return [g for _, g in out[:limit]]
-
-def collect_available_slots(g: Dict[str, Any], slots: Dict[str, Any]) -> List[str]:
-    now = _msk_now_naive()
-    items: List[Tuple[datetime, str]] = []
-    seen: set[str] = set()
-
-    def _push(date_s: str | None, start: str | None, end: str | None, label: str | None, available: Any = True):
-        if available is False:
-            return
-        start = (start or "").strip()
-        end = (end or "").strip()
-        if not start or not end or start == end:
-            return
-        dt = _parse_slot_dt(date_s, start)
-        if not dt or dt < now:
-            return
-        label_core = (label or f"{start} - {end}").strip()
-        try:
-            day = datetime.strptime(date_s or "", "%Y-%m-%d").strftime("%d.%m")
-            pretty = f"{day} {label_core}"
-        except Exception:
-            pretty = label_core
-        key = f"{dt.isoformat()}::{pretty}"
-        if key in seen:
-            return
-        seen.add(key)
-        items.append((dt, pretty))
-
-    # New format from girls.json
-    for day in (g.get("ops_calendar") or []):
-        date_s = day.get("date")
-        for s in (day.get("slots") or []):
-            _push(
-                date_s=s.get("date") or date_s,
-                start=s.get("start"),
-                end=s.get("end"),
-                label=s.get("label"),
-                available=s.get("available", True)
-            )
-
-    # Backward-compatible format from slot_json
-    for s in (slots.get("slots") or []):
-        _push(
-            date_s=s.get("date"),
-            start=s.get("start"),
-            end=s.get("end"),
-            label=s.get("label"),
-            available=s.get("available", True)
-        )
+        item["_first_today_dt"] = first_dt
+        out.append(item)
+    return out
 
-    items.sort(key=lambda x: x[0])
-    return [lbl for _, lbl in items]
+def _has_future_slots(g: Dict[str, Any]) -> bool:
+    return slot_index(g).first(_msk_now_naive()) is not None
 
-def collect_available_slot_keys(g: Dict[str, Any], slots: Dict[str, Any]) -> List[str]:
+def _filter_pick_girls(
+    mf: Dict[str, Any],
+    budget: str = "any",
+    style: str = "any",
+    date_pref: str = "any",
+    rating_pref: str = "any",
+    limit: int = 7
+) -> List[Dict[str, Any]]:
+    fe: FilterEngine = manifest_index(mf)["filters"]
     now = _msk_now_naive()
-    keys: List[Tuple[datetime, str]] = []
-    seen: set[str] = set()
-
-    def _push(date_s: str | None, start: str | None, end: str | None, available: Any = True):
-        if available is False:
-            return
-        start = (start or "").strip()
-        end = (end or "").strip()
-        if not start or not end or start == end:
-            return
-        dt = _parse_slot_dt(date_s, start)
-        if not dt or dt < now:
-            return
-        key = f"{date_s}|{start}|{end}"
-        if key in seen:
-            return
-        seen.add(key)
-        keys.append((dt, key))
+    today, today_mask = fe.free_today(now)
+    future_mask = fe.future(now)
+    future_flags = fe.future_flags
+
+    mask = (1 << len(fe.recs)) - 1
+    if budget in ("low", "mid", "high"):
+        mask &= fe.facets[budget]
+    if style in ("popular", "gamer", "new"):
+        mask &= fe.facets[style]
+    if date_pref == "today":
+        mask &= today_mask
+    elif date_pref == "soon":
+        mask &= future_mask
+    elif date_pref == "now":
+        free_now = fe.timeline.free_at(now)
+        mask &= sum(1 << fe.pos[gid] for gid in free_now)
+
+    rating = fe.rating.get(rating_pref)
+    price_part = fe.price_part
+
+    def _score(i: int) -> float:
+        # тот же порядок сложений, что и раньше, — равные баллы остаются равными
+        score = rating[i] if rating else 0.0
+        first_today = today.get(i)
+        if first_today is not None:
+            score += 1.5
+            score += max(0.0, 0.6 - min(0.6, (first_today - now).total_seconds() / 36000.0))
+        elif future_flags[i]:
+            score += 0.4
+        pp = price_part[i]
+        if pp is not None:
+            score += pp
+        return score
 
-    for day in (g.get("ops_calendar") or []):
-        date_s = day.get("date")
-        for s in (day.get("slots") or []):
-            _push(
-                date_s=s.get("date") or date_s,
-                start=s.get("start"),
-                end=s.get("end"),
-                available=s.get("available", True)
-            )
+    # nlargest устойчив, как sorted(reverse=True)[:limit]: при равных баллах — порядок каталога
+    return [fe.recs[i].view for i in heapq.nlargest(limit, _bits(mask), key=_score)]
 
-    for s in (slots.get("slots") or []):
-        _push(
-            date_s=s.get("date"),
-            start=s.get("start"),
-            end=s.get("end"),
-            available=s.get("available", True)
-        )
+def collect_available_slots(g: Dict[str, Any], slots: Dict[str, Any]) -> List[str]:
+    return slot_index(g, slots).future(_msk_now_naive())
 
-    keys.sort(key=lambda x: x[0])
-    return [k for _, k in keys]
+def collect_available_slot_keys(g: Dict[str, Any], slots: Dict[str, Any]) -> List[str]:
+    return slot_index(g, slots).future_keys(_msk_now_naive())
 
 def all_slots_text(g: Dict[str, Any], slots: Dict[str, Any]) -> str:
     name = html.escape(str(g.get("name", "")))
@@ -1937,9 +3072,159 @@ def _girl_style_tokens(g: Dict[str, Any]) -> set[str]:
             tokens.add(f"game:{gimg.split('/')[-1].lower()}")
     return tokens
 
-def _pick_recommendations(mf: Dict[str, Any], viewed_ids: List[int], limit: int = 3) -> List[Dict[str, Any]]:
-    arr = girls_list(mf) or []
-    if not arr:
+def _price_proximity(diff: float) -> float:
+    if diff <= 100:
+        return 3.0
+    if diff <= 300:
+        return 2.0
+    if diff <= 600:
+        return 1.0
+    return 0.0
+
+@dataclass(slots=True)
+class RecoIndex:
+    """Item-item сходство для персональных рекомендаций. Токенная часть балла кандидата —
+    сумма по просмотренным 1.5 × |общие стиль-токены|, т.е. строки разреженной матрицы
+    сходства. Анкеты с одинаковым набором токенов собраны в сигнатуру, матрица хранится
+    между сигнатурами и заполняется построчно при первом обращении (до смены версии манифеста)."""
+    recs: Tuple["GirlRec", ...]
+    pos: Dict[int, int]
+    sig_of: Tuple[int, ...]
+    sigs: Tuple[frozenset[str], ...]
+    priced: Tuple[Tuple[Tuple[float, int], ...], ...]  # сигнатура -> (цена, позиция) по возрастанию цены
+    unpriced: Tuple[Tuple[int, ...], ...]
+    all_priced: Tuple[Tuple[float, int], ...]
+    all_unpriced: Tuple[int, ...]
+    by_token: Dict[str, Tuple[int, ...]]
+    rows: Dict[int, List[Tuple[int, int]]]
+
+    def overlaps(self, sig: int) -> List[Tuple[int, int]]:
+        """Строка матрицы: (число общих токенов, сигнатура), только ненулевые."""
+        row = self.rows.get(sig)
+        if row is None:
+            cnt: Dict[int, int] = {}
+            for t in self.sigs[sig]:
+                for s2 in self.by_token.get(t, ()):
+                    cnt[s2] = cnt.get(s2, 0) + 1
+            row = self.rows[sig] = [(ov, s2) for s2, ov in cnt.items()]
+        return row
+
+    def recommend(
+        self, viewed: List["GirlRec"], pref_tokens: Dict[str, int], target_price: Optional[float],
+        now: datetime, exclude: set[int], limit: int, boost: Optional[Dict[int, float]] = None,
+    ) -> List[int]:
+        """Позиции top-`limit` по баллу _reco_score (при равенстве — порядок каталога).
+        Сигнатуры идут по убыванию токенной части, внутри — по ценовым окнам; перебор
+        обрывается, как только верхняя граница балла не дотягивает до худшего из найденных.
+        boost — прибавки (co-view) по позициям: такие анкеты оцениваются заранее и из обхода
+        исключаются, так что границы для остальных остаются верными."""
+        ts: Dict[int, float] = {}
+        for vg in viewed:
+            for ov, s2 in self.overlaps(self.sig_of[self.pos[vg.gid]]):
+                ts[s2] = ts.get(s2, 0.0) + 1.5 * ov
+        top: List[Tuple[float, int]] = []  # min-heap (балл, -позиция)
+
+        def _open(bound: float) -> bool:
+            return len(top) < limit or bound >= top[0][0]
+
+        def _offer(score: float, j: int):
+            if score <= 0:
+                return
+            item = (score, -j)
+            if len(top) < limit:
+                heapq.heappush(top, item)
+            elif item > top[0]:
+                heapq.heapreplace(top, item)
+
+        if boost:
+            for j, extra in boost.items():
+                if j not in exclude:
+                    _offer(_reco_score(self.recs[j], pref_tokens, target_price, now) + extra, j)
+            exclude = exclude | boost.keys()
+
+        def _scan(base: float, priced, unpriced, only_zero: bool):
+            if target_price is None:
+                tiers = [(0.0, [j for _, j in priced] + list(unpriced))]
+            else:
+                eps = 1e-6  # окна чуть шире — точный балл всё равно считает _reco_score
+                cut = [bisect.bisect_left(priced, (target_price - d - eps, -1)) for d in (600, 300, 100)]
+                cut += [bisect.bisect_right(priced, (target_price + d + eps, len(self.recs))) for d in (100, 300, 600)]
+                a3, a2, a1, b1, b2, b3 = cut
+                tiers = [
+                    (3.0, priced[a1:b1]),
+                    (2.0, priced[a2:a1] + priced[b1:b2]),
+                    (1.0, priced[a3:a2] + priced[b2:b3]),
+                    (0.0, priced[:a3] + priced[b3:] + tuple((None, j) for j in unpriced)),
+                ]
+                tiers = [(v, [j for _, j in items]) for v, items in tiers]
+            for tier, members in tiers:
+                if not _open(base + tier + 0.5):
+                    break
+                for j in members:
+                    if j in exclude or (only_zero and self.sig_of[j] in ts):
+                        continue
+                    _offer(_reco_score(self.recs[j], pref_tokens, target_price, now), j)
+
+        for sig, base in sorted(ts.items(), key=lambda x: -x[1]):
+            if not _open(base + 3.5):
+                break
+            _scan(base, self.priced[sig], self.unpriced[sig], False)
+        # анкеты без общих токенов набирают только цену и доступность
+        if _open(3.5):
+            _scan(0.0, self.all_priced, self.all_unpriced, True)
+        return [-j for _, j in sorted(top, reverse=True)]
+
+def _build_reco_index(recs: Tuple["GirlRec", ...]) -> RecoIndex:
+    sig_ids: Dict[frozenset[str], int] = {}
+    sig_of: List[int] = []
+    priced: List[List[Tuple[float, int]]] = []
+    unpriced: List[List[int]] = []
+    for i, rec in enumerate(recs):
+        sig = sig_ids.get(rec.style)
+        if sig is None:
+            sig = sig_ids[rec.style] = len(sig_ids)
+            priced.append([])
+            unpriced.append([])
+        sig_of.append(sig)
+        if rec.price is not None:
+            priced[sig].append((rec.price, i))
+        else:
+            unpriced[sig].append(i)
+    by_token: Dict[str, List[int]] = {}
+    for tokens, sig in sig_ids.items():
+        for t in tokens:
+            by_token.setdefault(t, []).append(sig)
+    return RecoIndex(
+        recs=recs,
+        pos={rec.gid: i for i, rec in enumerate(recs)},
+        sig_of=tuple(sig_of),
+        sigs=tuple(sig_ids),
+        priced=tuple(tuple(sorted(x)) for x in priced),
+        unpriced=tuple(tuple(x) for x in unpriced),
+        all_priced=tuple(sorted(x for lst in priced for x in lst)),
+        all_unpriced=tuple(j for lst in unpriced for j in lst),
+        by_token={t: tuple(v) for t, v in by_token.items()},
+        rows={},
+    )
+
+def _reco_score(rec: "GirlRec", pref_tokens: Dict[str, int], target_price: Optional[float], now: datetime) -> float:
+    score = 0.0
+    for t in rec.style:
+        score += pref_tokens.get(t, 0) * 1.5
+
+    if target_price is not None and rec.price is not None:
+        score += _price_proximity(abs(rec.price - target_price))
+
+    # Small boost for availability today.
+    if rec.slots.first(now) is not None:
+        score += 0.5
+    return score
+
+def _pick_recommendations(
+    mf: Dict[str, Any], viewed_ids: List[int], limit: int = 3, coview: Optional[Dict[int, float]] = None,
+) -> List[Dict[str, Any]]:
+    recs = girl_recs(mf)
+    if not recs:
         return []
 
     # Keep unique order by recency.
@@ -1952,7 +3237,7 @@ def _pick_recommendations(mf: Dict[str, Any], viewed_ids: List[int], limit: int
     if len(uniq_viewed) < 2:
         return []
 
-    viewed_girls = [girl_by_id(mf, gid) for gid in uniq_viewed]
+    viewed_girls = [girl_rec(mf, gid) for gid in uniq_viewed]
     viewed_girls = [g for g in viewed_girls if g]
     if len(viewed_girls) < 2:
         return []
@@ -1960,84 +3245,245 @@ def _pick_recommendations(mf: Dict[str, Any], viewed_ids: List[int], limit: int
     pref_tokens: Dict[str, int] = {}
     prices: List[float] = []
     for vg in viewed_girls:
-        for t in _girl_style_tokens(vg):
+        for t in vg.style:
             pref_tokens[t] = pref_tokens.get(t, 0) + 1
-        p = _girl_price_num(vg)
-        if p is not None:
-            prices.append(p)
+        if vg.price is not None:
+            prices.append(vg.price)
 
     target_price = (sum(prices) / len(prices)) if prices else None
     viewed_set = set(uniq_viewed)
 
-    scored: List[Tuple[float, Dict[str, Any]]] = []
-    for cand in arr:
+    ri: RecoIndex = manifest_index(mf)["reco"]
+    exclude = {ri.pos[gid] for gid in viewed_set if gid in ri.pos}
+    boost = {ri.pos[gid]: b for gid, b in (coview or {}).items() if gid in ri.pos}
+    top = ri.recommend(viewed_girls, pref_tokens, target_price, _msk_now_naive(), exclude, limit, boost)
+    return [recs[j].view for j in top]
+
+# ─── PERSONAL RECO QUEUE ─────────────────────────────────────────────────────
+# Клик по анкете только отмечает чат (reco_touch): срок оценки сдвигается на
+# RECO_DEBOUNCE_SEC с каждым кликом, быстрое листание даёт одну оценку после
+# паузы. Один диспетчер забирает созревшие чаты пачкой до RECO_EVAL_BATCH:
+# история и отметки об отправке — одно обращение к БД, co-view — один запрос,
+# манифест — один снимок на пачку. Отправок одновременно не больше
+# RECO_EVAL_CONCURRENCY. Кому рекомендацию недавно уже слали — помним в памяти,
+# такие клики в очередь не попадают.
+RECO_WINDOW_SEC = 7 * 24 * 3600  # какие просмотры учитываем
+RECO_COOLDOWN_SEC = 6 * 3600  # не чаще одной рекомендации на чат
+_RECO_DUE: Dict[int, float] = {}  # chat_id -> monotonic срок оценки
+_RECO_HEAP: List[Tuple[float, int]] = []  # (срок, chat_id); записи со сдвинутым сроком отсекаются по _RECO_DUE
+_RECO_QUIET: Dict[int, int] = {}  # chat_id -> unix ts, до которого рекомендацию не шлём
+_RECO_WAKE: Optional[asyncio.Event] = None
+_RECO_SEM: Optional[asyncio.Semaphore] = None
+_RECO_STATS: Dict[str, int] = {"touches": 0, "evals": 0, "batches": 0, "sent": 0}
+
+def reco_touch(chat_id: int):
+    _RECO_STATS["touches"] += 1
+    until = _RECO_QUIET.get(chat_id)
+    if until is not None:
+        if until > time.time():
+            return
+        del _RECO_QUIET[chat_id]
+    due = time.monotonic() + max(0.0, RECO_DEBOUNCE_SEC)
+    _RECO_DUE[chat_id] = due
+    heapq.heappush(_RECO_HEAP, (due, chat_id))
+    # сроки растут монотонно: будить диспетчер нужно, только если очередь была пуста
+    if _RECO_HEAP[0] == (due, chat_id) and _RECO_WAKE is not None:
+        _RECO_WAKE.set()
+
+def reco_info() -> Dict[str, int]:
+    return {**_RECO_STATS, "pending": len(_RECO_DUE), "quiet": len(_RECO_QUIET)}
+
+async def _reco_send(chat_id: int, recs: List[Dict[str, Any]]):
+    try:
+        rows = []
+        for g in recs:
+            name = str(g.get("name", f"#{g.get('id')}"))
+            url = g.get("bot_deeplink") or g.get("url") or SHOP_URL
+            rows.append([link_button(f"💜 {name}", url)])
+        rows.append([InlineKeyboardButton(text="👩 Смотреть всех", callback_data="girls:0")])
+
+        text = (
+            "💎 Похоже, тебе заходит похожий стиль.\n"
+            "Вот ещё 3 девушки, которые могут понравиться:"
+        )
         try:
-            cid = int(cand.get("id"))
+            with tg_lane("campaign"):
+                await bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
         except Exception:
-            continue
-        if cid in viewed_set:
-            continue
-
-        score = 0.0
-        cand_tokens = _girl_style_tokens(cand)
-        for t in cand_tokens:
-            score += pref_tokens.get(t, 0) * 1.5
-
-        if target_price is not None:
-            cp = _girl_price_num(cand)
-            if cp is not None:
-                diff = abs(cp - target_price)
-                if diff <= 100:
-                    score += 3.0
-                elif diff <= 300:
-                    score += 2.0
-                elif diff <= 600:
-                    score += 1.0
-
-        # Small boost for availability today.
-        if collect_available_slots(cand, {}):
-            score += 0.5
-
-        scored.append((score, cand))
-
-    scored.sort(key=lambda x: x[0], reverse=True)
-    out: List[Dict[str, Any]] = []
-    for score, cand in scored:
-        if score <= 0:
-            continue
-        out.append(cand)
-        if len(out) >= limit:
-            break
-    return out
-
-async def maybe_send_personal_reco(chat_id: int):
-    viewed = await db_recent_interest_girl_ids(chat_id, limit=24, within_sec=7 * 24 * 3600)
+            _RECO_QUIET.pop(chat_id, None)  # не ушло — следующий клик попробует снова
+            return
+        _RECO_STATS["sent"] += 1
+        with suppress(Exception):
+            await db_mark_reco_sent(chat_id)
+    finally:
+        _RECO_SEM.release()
+
+async def reco_evaluate(chat_ids: List[int]):
+    _RECO_STATS["batches"] += 1
+    _RECO_STATS["evals"] += len(chat_ids)
+    viewed, sent = await db_reco_candidates(chat_ids, limit=24, within_sec=RECO_WINDOW_SEC, cooldown_sec=RECO_COOLDOWN_SEC)
+    for chat_id, ts in sent.items():
+        _RECO_QUIET[chat_id] = ts + RECO_COOLDOWN_SEC
     # Trigger after browsing at least 2-3 profiles.
-    uniq_count = len(set(viewed))
-    if uniq_count < 2:
-        return
-    if await db_recent_reco_sent(chat_id, within_sec=6 * 3600):
+    ready = {chat_id: v for chat_id, v in viewed.items() if len(set(v)) >= 2}
+    if not ready:
         return
 
     mf = await get_manifest()
-    recs = _pick_recommendations(mf, viewed, limit=3)
-    if not recs:
-        return
+    topk: Dict[int, List[Tuple[int, int]]] = {}
+    if RECO_COVIEW_WEIGHT > 0 and COVIEW_SEC > 0:
+        with suppress(Exception):
+            topk = await db_coview_topk([gid for v in ready.values() for gid in v])
+    for chat_id, v in ready.items():
+        recs = _pick_recommendations(mf, v, limit=3, coview=coview_boosts(topk, v))
+        if recs:
+            _RECO_QUIET[chat_id] = int(time.time()) + RECO_COOLDOWN_SEC
+            await _RECO_SEM.acquire()
+            asyncio.create_task(_reco_send(chat_id, recs))
+        await asyncio.sleep(0)  # подбор — чистый CPU, между чатами отдаём цикл
+
+async def reco_dispatcher():
+    global _RECO_WAKE, _RECO_SEM
+    _RECO_WAKE = asyncio.Event()
+    _RECO_SEM = asyncio.Semaphore(max(1, RECO_EVAL_CONCURRENCY))
+    pruned_at = time.monotonic()
+    while True:
+        try:
+            now = time.monotonic()
+            due: List[int] = []
+            while _RECO_HEAP and _RECO_HEAP[0][0] <= now and len(due) < max(1, RECO_EVAL_BATCH):
+                t, chat_id = heapq.heappop(_RECO_HEAP)
+                if _RECO_DUE.get(chat_id) == t:
+                    del _RECO_DUE[chat_id]
+                    due.append(chat_id)
+            if due:
+                await reco_evaluate(due)
+                continue
+            if now - pruned_at >= 600:
+                pruned_at = now
+                ts = time.time()
+                for chat_id in [c for c, until in _RECO_QUIET.items() if until <= ts]:
+                    del _RECO_QUIET[chat_id]
+            timeout = _RECO_HEAP[0][0] - now if _RECO_HEAP else 60
+            _RECO_WAKE.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_RECO_WAKE.wait(), timeout=max(0.05, min(60, timeout)))
+        except Exception as e:
+            log.warning("reco_dispatcher loop failed: %s", e)
+            await asyncio.sleep(1)
+
+# ─── CATALOG SEARCH ──────────────────────────────────────────────────────────
+# Поиск по имени, категориям, любимым играм и описанию. Индекс строится вместе
+# с остальным индексом манифеста: словарь токенов (отсортирован — префиксы
+# бисекцией), у токена — анкеты с весом лучшего поля, плюс триграммы токенов
+# для опечаток. Слово запроса раскрывается в токены словаря (точно 1.0,
+# префикс 0.8, похожие по триграммам — 0.6 × Dice), балл анкеты — сумма
+# лучших совпадений по словам; выше те, где совпало больше слов запроса.
+SEARCH_FIELD_WEIGHTS = {"name": 3.0, "cats": 2.0, "games": 1.5, "desc": 1.0}
+SEARCH_FUZZY_MIN = 0.5  # порог Dice по триграммам
+SEARCH_PREFIX_MAX = 50  # токенов словаря на один префикс
+SEARCH_QUERY_WORDS = 8
+
+def _search_tokens(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower().replace("ё", "е"))
+
+def _trigrams(token: str) -> set[str]:
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _girl_search_fields(raw: Mapping[str, Any]) -> Dict[str, str]:
+    acf = raw.get("acf") or {}
+    games: List[str] = []
+    raw_games = acf.get("favorite_games")
+    for x in raw_games if isinstance(raw_games, list) else []:
+        if isinstance(x, dict):
+            x = x.get("title") or x.get("name") or x.get("url") or ""
+        if isinstance(x, str) and x:
+            games.append(x.rsplit("/", 1)[-1].rsplit(".", 1)[0])  # ссылка на картинку -> имя файла
+    return {
+        "name": str(raw.get("name") or ""),
+        "cats": " ".join(_cat_slugs(raw)),
+        "games": " ".join(games),
+        "desc": str(acf.get("description") or ""),
+    }
 
-    rows = []
-    for g in recs:
-        name = str(g.get("name", f"#{g.get('id')}"))
-        url = g.get("bot_deeplink") or g.get("url") or SHOP_URL
-        rows.append([link_button(f"💜 {name}", url)])
-    rows.append([InlineKeyboardButton(text="👩 Смотреть всех", callback_data="girls:0")])
+@dataclass(frozen=True, slots=True)
+class SearchIndex:
+    """Полнотекстовый индекс каталога на одну версию манифеста."""
+    recs: Tuple["GirlRec", ...]
+    vocab: Tuple[str, ...]  # по алфавиту
+    postings: Tuple[Tuple[Tuple[int, float], ...], ...]  # токен -> (позиция анкеты, вес поля)
+    grams: Mapping[str, Tuple[int, ...]]  # триграмма -> токены
+    gram_n: Tuple[int, ...]
+
+    def _expand(self, word: str) -> Dict[int, float]:
+        """Токены словаря, которыми можно считать слово запроса, с качеством совпадения."""
+        out: Dict[int, float] = {}
+        i = bisect.bisect_left(self.vocab, word)
+        if i < len(self.vocab) and self.vocab[i] == word:
+            out[i] = 1.0
+        if len(word) >= 2:
+            for j in range(i, min(len(self.vocab), i + SEARCH_PREFIX_MAX)):
+                if not self.vocab[j].startswith(word):
+                    break
+                out.setdefault(j, 0.8)
+        if len(word) >= 3:
+            wg = _trigrams(word)
+            shared: Dict[int, int] = {}
+            for g in wg:
+                for t in self.grams.get(g, ()):
+                    shared[t] = shared.get(t, 0) + 1
+            for t, n in shared.items():
+                dice = 2.0 * n / (len(wg) + self.gram_n[t])
+                if dice >= SEARCH_FUZZY_MIN and 0.6 * dice > out.get(t, 0.0):
+                    out[t] = 0.6 * dice
+        return out
 
-    text = (
-        "💎 Похоже, тебе заходит похожий стиль.\n"
-        "Вот ещё 3 девушки, которые могут понравиться:"
+    def search(self, query: str, limit: int) -> List[Tuple[int, float]]:
+        """(позиция, балл) лучших `limit`: сначала по числу совпавших слов, затем по баллу,
+        при равенстве — порядок каталога."""
+        words = list(dict.fromkeys(_search_tokens(query)))[:SEARCH_QUERY_WORDS]
+        # позиция -> 1000 × совпавших слов + балл (балл слова не больше 3, так что сумма < 1000)
+        hits: Dict[int, float] = {}
+        for word in words:
+            best: Dict[int, float] = {}
+            for t, quality in self._expand(word).items():
+                for j, w in self.postings[t]:
+                    if quality * w > best.get(j, 0.0):
+                        best[j] = quality * w
+            for j, score in best.items():
+                hits[j] = hits.get(j, 0.0) + 1000.0 + score
+        top = heapq.nlargest(limit, hits.items(), key=lambda x: (x[1], -x[0]))
+        return [(j, v % 1000.0) for j, v in top]
+
+def _build_search_index(recs: Tuple["GirlRec", ...]) -> SearchIndex:
+    by_token: Dict[str, Dict[int, float]] = {}
+    for i, rec in enumerate(recs):
+        for field, text in _girl_search_fields(rec.raw).items():
+            w = SEARCH_FIELD_WEIGHTS[field]
+            for t in _search_tokens(text):
+                d = by_token.setdefault(t, {})
+                if w > d.get(i, 0.0):
+                    d[i] = w
+    vocab = tuple(sorted(by_token))
+    grams: Dict[str, List[int]] = {}
+    gram_n: List[int] = []
+    for t, token in enumerate(vocab):
+        tg = _trigrams(token)
+        gram_n.append(len(tg))
+        for g in tg:
+            grams.setdefault(g, []).append(t)
+    return SearchIndex(
+        recs=recs,
+        vocab=vocab,
+        postings=tuple(tuple(by_token[token].items()) for token in vocab),
+        grams=MappingProxyType({g: tuple(v) for g, v in grams.items()}),
+        gram_n=tuple(gram_n),
     )
-    with suppress(Exception):
-        await bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
-        await db_mark_reco_sent(chat_id)
+
+def search_girls(mf: Dict[str, Any], query: str, limit: int = 8) -> List[Mapping[str, Any]]:
+    si: SearchIndex = manifest_index(mf)["search"]
+    return [si.recs[j].view for j, _ in si.search(query, limit)]
 
 # ─── BUTTON/KB HELPERS ───────────────────────────────────────────────────────
 def btn_url(text: str, url: str) -> Dict[str, str]:
@@ -2089,6 +3535,41 @@ def render(tpl: str, ctx: Dict[str, Any]) -> str:
         return tpl.format_map(safe)
     except Exception:
         return tpl
+# Скомпилированный шаблон: (исходник, части) — части это [(литерал, имя поля|None)].
+# Разбор через string.Formatter делается один раз; при рендере только склейка.
+# Шаблоны с атрибутами/индексами/спецификаторами ({a.b}, {x:>3}, {0}) не
+# компилируются (части=None) и идут через обычный format_map.
+_TPL_FORMATTER = string.Formatter()
+
+def compile_tpl(tpl: str | None) -> Tuple[str, Optional[List[Tuple[str, Optional[str]]]]]:
+    tpl = tpl or ""
+    try:
+        parsed = list(_TPL_FORMATTER.parse(tpl))
+    except ValueError:
+        return tpl, None
+    parts: List[Tuple[str, Optional[str]]] = []
+    for literal, field, spec, conv in parsed:
+        if field is not None and (not field.isidentifier() or spec or conv):
+            return tpl, None
+        parts.append((literal, field))
+    return tpl, parts
+
+def render_compiled(ct: Tuple[str, Optional[List[Tuple[str, Optional[str]]]]], ctx: Dict[str, Any], escape: bool = True) -> str:
+    """То же, что render_html/render_raw, но по заранее разобранному шаблону."""
+    tpl, parts = ct
+    if parts is None:
+        return render_html(tpl, ctx) if escape else render_raw(tpl, ctx)
+    out = []
+    for literal, field in parts:
+        out.append(literal)
+        if field is not None:
+            if field not in ctx:
+                return tpl  # как format_map: KeyError → шаблон как есть
+            v = ctx[field]
+            v = "" if v is None else str(v)
+            out.append(html.escape(v) if escape else v)
+    return "".join(out)
+
 def _parse_id_list(s: str | None) -> List[int]:
     if not s:
         return []
@@ -2154,10 +3635,9 @@ async def find_bestseller(mf: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 
     # 1) Категории: bestseller → main
     for slug in ("bestseller", "main"):
-        cand = [x for x in arr if slug in set(_cat_slugs(x))]
+        cand = [girl_rec(mf, gid) for gid in girls_in_category(mf, slug)]
         if cand:
-            cand.sort(key=_girl_order)
-            chosen = cand[0]
+            chosen = min(cand, key=lambda r: r.order).view
             log.info("BESTSELLER: chosen by category '%s' id=%s name=%s", slug, chosen.get("id"), chosen.get("name"))
             return chosen
 
@@ -2173,39 +3653,33 @@ async def find_bestseller(mf: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     log.info("BESTSELLER: fallback first id=%s name=%s", arr[0].get("id"), arr[0].get("name"))
     return arr[0]
 
-def _log_campaign_step(chat_id: int, campaign: str, step_idx: int, reason: str|None, girl_id: int|None, payload_hash: str|None):
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+async def _log_campaign_step(chat_id: int, campaign: str, step_idx: int, reason: str|None, girl_id: int|None, payload_hash: str|None):
+    now = int(time.time())
+    def _op(con):
         con.execute(
             "INSERT INTO campaign_log (chat_id,campaign,step_idx,reason,girl_id,payload_hash,sent_at) VALUES (?,?,?,?,?,?,?)",
-            (chat_id, campaign, step_idx, reason, girl_id, payload_hash, int(time.time()))
+            (chat_id, campaign, step_idx, reason, girl_id, payload_hash, now)
         )
-        con.commit()
-        con.close()
-    return asyncio.to_thread(_op)
+    db_write_nowait(_op)
 
 async def _campaign_throttled(chat_id: int, campaign: str, cooldown_hours: int, payload_hash: str | None = None) -> bool:
     cutoff = int(time.time()) - cooldown_hours*3600
-    def _op():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            if payload_hash is not None:
-                cur = con.execute(
-                    "SELECT 1 FROM campaign_log "
-                    "WHERE chat_id=? AND campaign=? AND payload_hash=? "
-                    "AND step_idx=0 AND sent_at>=? LIMIT 1",
-                    (chat_id, campaign, payload_hash, cutoff)
-                )
-            else:
-                cur = con.execute(
-                    "SELECT 1 FROM campaign_log "
-                    "WHERE chat_id=? AND campaign=? AND step_idx=0 AND sent_at>=? LIMIT 1",
-                    (chat_id, campaign, cutoff)
-                )
-            return cur.fetchone() is not None
-        finally:
-            con.close()
-    return await asyncio.to_thread(_op)
+    def _op(con):
+        if payload_hash is not None:
+            cur = con.execute(
+                "SELECT 1 FROM campaign_log "
+                "WHERE chat_id=? AND campaign=? AND payload_hash=? "
+                "AND step_idx=0 AND sent_at>=? LIMIT 1",
+                (chat_id, campaign, payload_hash, cutoff)
+            )
+        else:
+            cur = con.execute(
+                "SELECT 1 FROM campaign_log "
+                "WHERE chat_id=? AND campaign=? AND step_idx=0 AND sent_at>=? LIMIT 1",
+                (chat_id, campaign, cutoff)
+            )
+        return cur.fetchone() is not None
+    return await db_run(_op)
 
 # ─── DEFAULT CAMPAIGNS ───────────────────────────────────────────────────────
 CAMPAIGNS: Dict[str, List[Dict[str, Any]]] = {
@@ -2385,8 +3859,11 @@ CAMPAIGNS: Dict[str, List[Dict[str, Any]]] = {
 
 async def schedule_timesall_followup(chat_id: int, girl_id: int, viewed_at: int):
     # Random 15-30 min delay as requested.
-    await asyncio.sleep(random.randint(15 * 60, 30 * 60))
+    run_at = int(time.time()) + random.randint(15 * 60, 30 * 60)
+    await scheduler_add("timesall_followup", chat_id, run_at,
+                        campaign="timesall_followup", payload={"girl_id": girl_id, "viewed_at": viewed_at})
 
+async def _timesall_followup_fire(chat_id: int, girl_id: int, viewed_at: int):
     # If user had activity after opening full slots, skip follow-up.
     last_seen = await db_user_last_seen(chat_id)
     if last_seen is not None and last_seen > viewed_at + 5:
@@ -2419,34 +3896,29 @@ async def schedule_timesall_followup(chat_id: int, girl_id: int, viewed_at: int)
 # ─── SEND STEPS / RUN CAMPAIGN ───────────────────────────────────────────────
 async def _send_step(chat_id: int, step: Dict[str, Any], ctx: Dict[str, Any], step_idx: int,
                      campaign: str, reason: str|None, girl_id: int|None, payload_hash: str|None):
+    if "_text" not in step:
+        step = _compile_campaign_step(step)
     try:
+        kb = kb_from([
+            [
+                {"text": render_compiled(text_ct, ctx), "url": render_compiled(target, ctx, escape=False)}
+                if kind == "url" else
+                {"text": render_compiled(text_ct, ctx), "cb": target}
+                for text_ct, kind, target in row
+            ] for row in step["_buttons"]
+        ])
         if step.get("kind") == "photo":
-            img = render_raw(step.get("image",""), ctx)
-            caption = render_html(step.get("caption","") or step.get("text",""), ctx)
-            kb = kb_from([
-                [
-                    {
-                        **b,
-                        "text": render_html(b["text"], ctx),
-                        **({"url": render_raw(b["url"], ctx)} if "url" in b else {"cb": b["cb"]})
-                    } for b in row
-                ] for row in step.get("buttons",[])
-            ])
-            await bot.send_photo(chat_id, photo=img, caption=caption, reply_markup=kb)
+            img = render_compiled(step["_image"], ctx, escape=False)
+            caption = render_compiled(step["_caption"], ctx)
+            await send_photo_cached(chat_id, img, caption=caption, reply_markup=kb)
             log.info("SEND step ok: chat=%s camp=%s idx=%s kind=photo", chat_id, campaign, step_idx)
         else:
-            text = render_html(step.get("text",""), ctx)
-            kb = kb_from([
-                [
-                    {
-                        **b,
-                        "text": render_html(b["text"], ctx),
-                        **({"url": render_raw(b["url"], ctx)} if "url" in b else {"cb": b["cb"]})
-                    } for b in row
-                ] for row in step.get("buttons",[])
-            ])
+            text = render_compiled(step["_text"], ctx)
             await bot.send_message(chat_id, text, reply_markup=kb)
             log.info("SEND step ok: chat=%s camp=%s idx=%s kind=text", chat_id, campaign, step_idx)
+    except TelegramForbiddenError:
+        log.info("SEND step skipped: chat=%s camp=%s idx=%s blocked the bot", chat_id, campaign, step_idx)
+        raise
     except Exception as e:
         log.exception("SEND step failed: chat=%s camp=%s idx=%s err=%s", chat_id, campaign, step_idx, e)
 
@@ -2454,26 +3926,14 @@ async def _send_step(chat_id: int, step: Dict[str, Any], ctx: Dict[str, Any], st
 
 async def run_campaign(chat_id: int, campaign: str, ctx: Dict[str, Any], reason: str|None = None,
                        girl_id: int|None = None, payload_hash: str|None = None):
-    steps = await load_campaign_steps_from_db(campaign)
-    if steps is None:  # нет в БД — fallback на дефолт
-        steps = CAMPAIGNS.get(campaign) or []
+    c = await campaign_get(campaign)
+    steps = c["steps"] if c["enabled"] else []
+    if not c["in_db"]:  # нет в БД — fallback на дефолт
         log.info("CAMP '%s': using defaults, steps=%d", campaign, len(steps))
     if not steps:
         log.warning("CAMP '%s': no steps to send → abort", campaign)
         return
-
-    # кастомный кулдаун из БД
-    def _get_cooldown():
-        con = sqlite3.connect(DB_PATH)
-        try:
-            cur = con.execute("SELECT cooldown_hours FROM campaigns WHERE name=?", (campaign,))
-            r = cur.fetchone()
-            if r and r[0] is not None:
-                return int(r[0])
-            return CAMPAIGN_COOLDOWN_HOURS
-        finally:
-            con.close()
-    cooldown_hours = await asyncio.to_thread(_get_cooldown)
+    cooldown_hours = c["cooldown_hours"]
 
     throttled = await _campaign_throttled(chat_id, campaign, cooldown_hours, payload_hash)
     log.info("CAMP '%s': chat=%s steps=%d cooldown=%sh payload_hash=%r throttled=%s reason=%r girl_id=%r",
@@ -2481,17 +3941,166 @@ async def run_campaign(chat_id: int, campaign: str, ctx: Dict[str, Any], reason:
     if throttled:
         return
 
-    async def _runner():
-        for i, step in enumerate(steps):
-            d = max(0, int(step.get("delay",0)))
-            if d:
-                log.debug("CAMP '%s': sleep %ss before step %s", campaign, d, i)
-            await asyncio.sleep(d)
-            try:
-                await _send_step(chat_id, step, ctx, i, campaign, reason, girl_id, payload_hash)
-            except Exception as e:
-                log.exception("CAMP '%s': step %s failed: %s", campaign, i, e)
-    asyncio.create_task(_runner())
+    # шаги идут цепочкой через планировщик: в очереди всегда только следующий шаг
+    await _schedule_campaign_step(chat_id, campaign, 0, max(0, int(steps[0].get("delay", 0))),
+                                  ctx, reason, girl_id, payload_hash)
+
+async def _schedule_campaign_step(chat_id: int, campaign: str, step_idx: int, delay: int, ctx: Dict[str, Any],
+                                  reason: str|None, girl_id: int|None, payload_hash: str|None):
+    if delay:
+        log.debug("CAMP '%s': step %s scheduled in %ss", campaign, step_idx, delay)
+    # run_at в целых секундах: ненулевую задержку округляем вверх, чтобы шаг не ушёл раньше
+    run_at = int(time.time() + delay) + (1 if delay else 0)
+    await scheduler_add("campaign_step", chat_id, run_at, campaign=campaign, payload={
+        "step_idx": step_idx, "ctx": ctx, "reason": reason, "girl_id": girl_id, "payload_hash": payload_hash,
+    })
+
+async def _campaign_step_fire(chat_id: int, campaign: str, step_idx: int, ctx: Dict[str, Any],
+                              reason: str|None, girl_id: int|None, payload_hash: str|None):
+    # шаг берём из реестра в момент отправки — правки в админке применяются к идущим цепочкам
+    c = await campaign_get(campaign)
+    steps = c["steps"] if c["enabled"] else []
+    if step_idx >= len(steps):
+        log.info("CAMP '%s': chat=%s step %s gone (disabled/removed) → stop", campaign, chat_id, step_idx)
+        return
+    try:
+        await _send_step(chat_id, steps[step_idx], ctx, step_idx, campaign, reason, girl_id, payload_hash)
+    except TelegramForbiddenError:
+        return  # остальные задачи юзера снимает scheduler_cancel из tg_send_gate
+    except Exception as e:
+        log.exception("CAMP '%s': step %s failed: %s", campaign, step_idx, e)
+    if step_idx + 1 < len(steps):
+        await _schedule_campaign_step(chat_id, campaign, step_idx + 1, max(0, int(steps[step_idx + 1].get("delay", 0))),
+                                      ctx, reason, girl_id, payload_hash)
+
+# ─── SCHEDULER ───────────────────────────────────────────────────────────────
+# Отложенные задачи лежат в scheduled_jobs; в памяти — только мин-куча
+# (run_at, id) на SCHED_HORIZON_SEC вперёд, остальное догружается окнами по
+# индексу run_at. Один диспетчер забирает созревшие задачи пачкой — не больше,
+# чем свободных мест из SCHED_CONCURRENCY (строки удаляются из БД прямо перед
+# запуском обработчика — at-most-once), остальное ждёт в таблице и переживает
+# рестарт. Просроченное за время простоя выполняется сразу после старта.
+_SCHED_HEAP: List[Tuple[int, int]] = []
+_SCHED_IDS: set[int] = set()  # id задач в куче; отменённые отсюда убираются, куча чистится лениво
+_SCHED_LOADED_UNTIL = -1  # всё с run_at <= этого уже в куче
+_SCHED_WAKE: Optional[asyncio.Event] = None
+_SCHED_RUNNING = 0  # запущенных обработчиков
+
+def _sched_wake():
+    if _SCHED_WAKE is not None:
+        _SCHED_WAKE.set()
+
+async def scheduler_add(kind: str, chat_id: int, run_at: int, campaign: str | None = None,
+                        payload: Optional[Dict[str, Any]] = None) -> int:
+    now = int(time.time())
+    data = json.dumps(payload or {}, ensure_ascii=False, default=str)
+    def _op(con):
+        cur = con.execute(
+            "INSERT INTO scheduled_jobs(run_at, kind, chat_id, campaign, payload, created_at) VALUES(?,?,?,?,?,?)",
+            (run_at, kind, chat_id, campaign, data, now)
+        )
+        return cur.lastrowid
+    job_id = await db_write(_op)
+    # окно проверяем после коммита: если загрузчик окна уже сдвинул границу,
+    # он мог строку и не увидеть — кладём в кучу сами (дубли отсекает _SCHED_IDS)
+    if run_at <= _SCHED_LOADED_UNTIL and job_id not in _SCHED_IDS:
+        _SCHED_IDS.add(job_id)
+        heapq.heappush(_SCHED_HEAP, (run_at, job_id))
+        if _SCHED_HEAP[0][1] == job_id:
+            _sched_wake()
+    return job_id
+
+async def scheduler_cancel(chat_id: int, campaign: str | None = None) -> int:
+    """Отменить отложенные задачи юзера (все или одной кампании). Возвращает число отменённых."""
+    def _op(con):
+        if campaign is None:
+            where, args = "chat_id=?", (chat_id,)
+        else:
+            where, args = "chat_id=? AND campaign=?", (chat_id, campaign)
+        ids = [r[0] for r in con.execute(f"SELECT id FROM scheduled_jobs WHERE {where}", args)]
+        con.execute(f"DELETE FROM scheduled_jobs WHERE {where}", args)
+        return ids
+    ids = await db_write(_op)
+    _SCHED_IDS.difference_update(ids)
+    if ids:
+        log.info("SCHED: cancelled %d job(s) chat=%s campaign=%s", len(ids), chat_id, campaign)
+    return len(ids)
+
+async def _sched_load_window(now: int):
+    global _SCHED_LOADED_UNTIL
+    lo, hi = _SCHED_LOADED_UNTIL, now + max(60, SCHED_HORIZON_SEC)
+    _SCHED_LOADED_UNTIL = hi  # до запроса: задачи, добавленные во время него, кладут себя сами
+    def _op(con):
+        return con.execute(
+            "SELECT run_at, id FROM scheduled_jobs WHERE run_at>? AND run_at<=? ORDER BY run_at", (lo, hi)
+        ).fetchall()
+    for run_at, job_id in await db_run(_op):
+        if job_id not in _SCHED_IDS:
+            _SCHED_IDS.add(job_id)
+            heapq.heappush(_SCHED_HEAP, (run_at, job_id))
+
+async def _sched_take(ids: List[int]) -> List[Tuple[int, str, int, Optional[str], Optional[str]]]:
+    def _op(con):
+        marks = ",".join("?" * len(ids))
+        rows = con.execute(
+            f"SELECT id, kind, chat_id, campaign, payload FROM scheduled_jobs WHERE id IN ({marks}) ORDER BY run_at, id", ids
+        ).fetchall()
+        con.execute(f"DELETE FROM scheduled_jobs WHERE id IN ({marks})", ids)
+        return rows
+    return await db_write(_op)
+
+async def _sched_run(job_id: int, kind: str, chat_id: int, payload: Dict[str, Any]):
+    global _SCHED_RUNNING
+    TG_LANE.set("campaign")  # своя таска — контекст не утекает
+    try:
+        if kind == "campaign_step":
+            await _campaign_step_fire(chat_id, payload.get("campaign") or "", int(payload.get("step_idx") or 0),
+                                      payload.get("ctx") or {}, payload.get("reason"),
+                                      payload.get("girl_id"), payload.get("payload_hash"))
+        elif kind == "timesall_followup":
+            await _timesall_followup_fire(chat_id, int(payload["girl_id"]), int(payload["viewed_at"]))
+        else:
+            log.warning("SCHED: unknown job kind=%s id=%s", kind, job_id)
+    except Exception as e:
+        log.exception("SCHED: job %s (%s) chat=%s failed: %s", job_id, kind, chat_id, e)
+    finally:
+        _SCHED_RUNNING -= 1
+        _sched_wake()  # освободилось место — диспетчер заберёт следующие
+
+async def scheduler_dispatcher():
+    global _SCHED_WAKE, _SCHED_RUNNING
+    _SCHED_WAKE = asyncio.Event()
+    while True:
+        try:
+            now = int(time.time())
+            if now + max(60, SCHED_HORIZON_SEC) // 2 >= _SCHED_LOADED_UNTIL:
+                await _sched_load_window(now)
+            free = max(1, SCHED_CONCURRENCY) - _SCHED_RUNNING
+            due: List[int] = []
+            while _SCHED_HEAP and _SCHED_HEAP[0][0] <= now and len(due) < min(max(1, SCHED_BATCH), free):
+                _, job_id = heapq.heappop(_SCHED_HEAP)
+                if job_id in _SCHED_IDS:
+                    _SCHED_IDS.discard(job_id)
+                    due.append(job_id)
+            if due:
+                for job_id, kind, chat_id, campaign, payload in await _sched_take(due):
+                    try:
+                        data = json.loads(payload) if payload else {}
+                    except Exception:
+                        data = {}
+                    data.setdefault("campaign", campaign)
+                    _SCHED_RUNNING += 1
+                    asyncio.create_task(_sched_run(job_id, kind, chat_id, data))
+                continue
+            timeout = _SCHED_LOADED_UNTIL - max(60, SCHED_HORIZON_SEC) // 2 - now
+            if _SCHED_HEAP and free > 0:  # мест нет — ждём _sched_wake() от завершившегося обработчика
+                timeout = min(timeout, _SCHED_HEAP[0][0] - now)
+            _SCHED_WAKE.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_SCHED_WAKE.wait(), timeout=max(0.05, min(60, timeout)))
+        except Exception as e:
+            log.warning("scheduler_dispatcher loop failed: %s", e)
+            await asyncio.sleep(1)
 
 # ─── KEYBOARDS (user) ────────────────────────────────────────────────────────
 def kb_home() -> InlineKeyboardMarkup:
@@ -2673,6 +4282,17 @@ def kb_bcast_menu():
         [InlineKeyboardButton(text="🏠 Меню", callback_data="adm:menu")]
     ])
 
+def kb_bcast_job(job_id: int, status: str):
+    if status == "running":
+        rows = [[InlineKeyboardButton(text="⏸ Пауза", callback_data=f"adm:bcast:job:pause:{job_id}"),
+                 InlineKeyboardButton(text="✖️ Отменить", callback_data=f"adm:bcast:job:cancel:{job_id}")]]
+    elif status == "paused":
+        rows = [[InlineKeyboardButton(text="▶ Продолжить", callback_data=f"adm:bcast:job:resume:{job_id}"),
+                 InlineKeyboardButton(text="✖️ Отменить", callback_data=f"adm:bcast:job:cancel:{job_id}")]]
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 def kb_settings_menu(current_coupon20: str, current_trial: str, cd_hours: str, featured_ids_str: str):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"COUPON_20: {current_coupon20}", callback_data="adm:set:COUPON_20")],
@@ -2858,7 +4478,8 @@ async def admin_cb(cb: CallbackQuery):
         text = (f"👥 Юзеры\nВсего: <b>{stats['total']}</b>\n"
                 f"Активные 7д: <b>{stats['active7']}</b>\n"
                 f"Активные 30д: <b>{stats['active30']}</b>\n"
-                f"Новые 24ч: <b>{stats['new24']}</b>")
+                f"Новые 24ч: <b>{stats['new24']}</b>\n"
+                f"Заблокировали бота: <b>{stats['blocked']}</b>")
         await cb.message.edit_text(text, reply_markup=kb_users_menu())
         return
 
@@ -2932,7 +4553,7 @@ async def admin_cb(cb: CallbackQuery):
             if not text:
                 await cb.message.answer("Нужен текст/caption для фото")
                 return
-            await bot.send_photo(cb.from_user.id, photo=photo, caption=text, reply_markup=kb)
+            await send_photo_cached(cb.from_user.id, photo, caption=text, reply_markup=kb)
         else:
             if not text:
                 await cb.message.answer("Нужен текст")
@@ -2953,23 +4574,14 @@ async def admin_cb(cb: CallbackQuery):
         if not text:
             await cb.message.answer("Нет текста/caption"); return
         
-        seg = st.get("segment","all")
-        uids = await db_user_ids(seg)
-        sent, fail = 0, 0
-        kb = kb_from(st.get("buttons") or [])
-        await cb.message.answer(f"Начал рассылку по сегменту {seg}. Пользователей: {len(uids)}")
-        
-        for uid in uids:
-            try:
-                if photo:
-                    await bot.send_photo(uid, photo=photo, caption=text, reply_markup=kb)
-                else:
-                    await bot.send_message(uid, text, reply_markup=kb)
-                sent += 1
-            except Exception:
-                fail += 1
-            await asyncio.sleep(0.05)
-        await cb.message.answer(f"Готово. Ушло: {sent}, ошибок: {fail}")
+        job_id = await broadcast_start(cb.from_user.id, st.get("segment","all"), text, photo, st.get("buttons") or [])
+        log.info("BCAST #%s: started by %s", job_id, cb.from_user.id)
+        return
+
+    if cb.data.startswith("adm:bcast:job:") and len(parts) == 5 and parts[4].isdigit():
+        action, job_id = parts[3], int(parts[4])
+        if action in ("pause", "resume", "cancel"):
+            await broadcast_control(job_id, action)
         return
 
     # SETTINGS
@@ -3098,8 +4710,12 @@ async def ping(msg: Message):
 
 @rt.message(Command("refresh"))
 async def refresh(msg: Message):
-    await get_manifest(force=True)
-    await msg.answer("Кэш обновил. Погнали 🔁")
+    ok = await manifest_refresh()
+    info = manifest_info()
+    if ok:
+        await msg.answer(f"Кэш обновил (v{info['version']}, анкет: {info['girls']}). Погнали 🔁")
+    else:
+        await msg.answer(f"Апстрим недоступен — отдаю прошлую копию v{info['version']} ({info['age']:.0f} с). ⚠️")
 
 @rt.message(Command("cancel"))
 async def cancel(msg: Message):
@@ -3143,17 +4759,15 @@ async def cmd_diag(msg: Message):
     if len(parts) == 2 and parts[1].strip().isdigit():
         uid = int(parts[1].strip())
 
-    def _op():
-        con = sqlite3.connect(DB_PATH)
+    def _op(con):
         cur = con.execute("""
             SELECT campaign, step_idx, reason, girl_id, payload_hash, sent_at
             FROM campaign_log WHERE chat_id=? ORDER BY id DESC LIMIT 25
         """, (uid,))
         rows = cur.fetchall()
-        con.close()
         return rows
 
-    rows = await asyncio.to_thread(_op)
+    rows = await db_run(_op)
     if not rows:
         await msg.reply(f"Логов нет для user_id={uid}")
         return
@@ -3163,6 +4777,30 @@ async def cmd_diag(msg: Message):
         lines.append(f"• {t} | {camp} step={idx} reason={rs or '—'} girl={gid or '—'} payload={ph or '—'}")
     await msg.reply("\n".join(lines))
 
+@rt.message(Command("metrics"))
+async def cmd_metrics(msg: Message):
+    """Админские метрики: очереди отправки по полосам, задержки, ошибки."""
+    if not is_admin(msg.from_user.id):
+        return
+    lines = ["📊 <b>Отправка</b> (очередь | ушло | ошибки | wait p50/p95 | total p50/p95, мс)"]
+    for lane, m in tg_metrics().items():
+        lines.append(
+            f"• {lane}: {m['queued']} | {m['sent']} | {m['errors']} "
+            f"(429: {m['retry_after']}, blocked: {m['forbidden']}) | "
+            f"{m['wait_p50_ms']:.0f}/{m['wait_p95_ms']:.0f} | {m['latency_p50_ms']:.0f}/{m['latency_p95_ms']:.0f}"
+        )
+    mi = manifest_info()
+    lines.append(
+        f"\n📦 <b>Манифест</b>: v{mi['version']}, анкет {mi['girls']}, возраст {mi['age']:.0f} с"
+        + (f", ошибок подряд {mi['fails']}" if mi["fails"] else "")
+    )
+    ri = reco_info()
+    lines.append(
+        f"🎯 <b>Рекомендации</b>: кликов {ri['touches']}, оценок {ri['evals']} (пачек {ri['batches']}), "
+        f"отправлено {ri['sent']}, ждут {ri['pending']}, на паузе {ri['quiet']}"
+    )
+    await msg.reply("\n".join(lines))
+
 async def maybe_prompt_resume_checkout_msg(msg: Message) -> bool:
     state = await checkout_state_get(msg.from_user.id)
     if not isinstance(state, dict):
@@ -3240,8 +4878,9 @@ async def start_with_payload(msg: Message, command: CommandObject):
             )
 
     # контекст
-    coupon20 = await settings_get("COUPON_20", COUPON_20)
-    trial = await settings_get("TRIAL_PRICE", TRIAL_PRICE)
+    _, st = settings_snapshot()
+    coupon20 = st.get("COUPON_20", COUPON_20)
+    trial = st.get("TRIAL_PRICE", TRIAL_PRICE)
     base_ctx = {
         "coupon": coupon,
         "coupon20": coupon20,
@@ -3273,7 +4912,7 @@ async def start_with_payload(msg: Message, command: CommandObject):
 
         headers = {"X-Bot-Secret": OPS_BOT_SECRET} if OPS_BOT_SECRET else {}
         try:
-            async with aiohttp.ClientSession() as session:
+            async with http_session("ops") as session:
                 async with session.post(
                     f"{OPS_API_BASE}/bot/link-order",
                     json={
@@ -3326,7 +4965,7 @@ async def start_with_payload(msg: Message, command: CommandObject):
 
         headers = {"X-Bot-Secret": OPS_BOT_SECRET} if OPS_BOT_SECRET else {}
         try:
-            async with aiohttp.ClientSession() as session:
+            async with http_session("ops") as session:
                 async with session.post(
                     f"{OPS_API_BASE}/bot/link-worker",
                     json={
@@ -3366,7 +5005,7 @@ async def start_with_payload(msg: Message, command: CommandObject):
 
     # если пришёл girl_id — карточка и прогрев
     if girl_id is not None:
-        mf = await get_manifest(force=True)
+        mf = await get_manifest()
         g = girl_by_id(mf, girl_id)
         if not g:
             log.warning("START girl_id=%s not found in manifest", girl_id)
@@ -3406,8 +5045,7 @@ async def start_with_payload(msg: Message, command: CommandObject):
 
         with suppress(Exception):
             await db_add_interest(chat_id=msg.chat.id, girl_id=girl_id, source="deeplink")
-        with suppress(Exception):
-            asyncio.create_task(maybe_send_personal_reco(msg.chat.id))
+        reco_touch(msg.chat.id)
 
         slots = {}
         try:
@@ -3423,7 +5061,7 @@ async def start_with_payload(msg: Message, command: CommandObject):
         img     = g.get("image") or g.get("url")
 
         try:
-            await msg.answer_photo(photo=img, caption=caption, reply_markup=kb)
+            await send_photo_cached(msg.chat.id, img, caption=caption, reply_markup=kb)
         except Exception as e:
             log.warning("answer_photo failed, send text instead: %s", e)
             await msg.answer(caption, reply_markup=kb)
@@ -3526,7 +5164,7 @@ async def check_bs(msg: Message):
     featured_str = await settings_get("BESTSELLER_IDS", featured_env)
     forced_ids   = parse_ids(featured_str)
 
-    mf = await get_manifest(force=True)
+    mf = await get_manifest()
     arr = girls_list(mf) or []
     if not arr:
         await msg.reply("🤷‍♂️ В манифесте пусто.")
@@ -4136,7 +5774,7 @@ async def noop_cb(cb: CallbackQuery):
 async def new20_offer(cb: CallbackQuery):
     await _touch_user(cb.from_user.id)
     await ack(cb)
-    coupon20 = await settings_get("COUPON_20", COUPON_20)
+    coupon20 = settings_snapshot()[1].get("COUPON_20", COUPON_20)
     text = (
         "🎁 <b>-20% для новых клиентов</b>\n\n"
         f"Купон: <code>{html.escape(coupon20)}</code>\n"
@@ -4176,6 +5814,7 @@ async def find_girl_flow(cb: CallbackQuery):
 
     def _kb_date():
         return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⚡ Свободны прямо сейчас", callback_data="find:date:now")],
             [InlineKeyboardButton(text="📅 Свободны сегодня", callback_data="find:date:today")],
             [InlineKeyboardButton(text="⏳ Есть ближайшие окна", callback_data="find:date:soon")],
             [InlineKeyboardButton(text="✨ Любая дата", callback_data="find:date:any")],
@@ -4240,6 +5879,7 @@ async def find_girl_flow(cb: CallbackQuery):
 
         lines = ["<b>🎯 Подобрал для тебя:</b>"]
         rows = []
+        free_now = availability(mf).free_at(_msk_now_naive()) if st.get("date") == "now" else {}
         for i, g in enumerate(picks, start=1):
             try:
                 gid = int(g.get("id"))
@@ -4255,6 +5895,8 @@ async def find_girl_flow(cb: CallbackQuery):
             today_slots = _today_slots_from_ops_calendar(g)
             future_slots = collect_available_slots(g, {})
             slot_text = today_slots[0][1] if today_slots else (future_slots[0] if future_slots else "время уточняется")
+            if gid in free_now:
+                slot_text = f"свободна сейчас до {free_now[gid][0]:%H:%M}"
             lines.append(f"{i}. <b>{name}</b> — {html.escape(slot_text)} • {price_text}")
             rows.append([InlineKeyboardButton(text=f"⚡ {g.get('name', f'#{gid}')}", callback_data=f"girls:{idx}")])
 
@@ -4265,24 +5907,62 @@ async def find_girl_flow(cb: CallbackQuery):
         await cb.message.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
         return
 
-@rt.callback_query(F.data == "free:today")
-async def free_today(cb: CallbackQuery):
-    await _touch_user(cb.from_user.id)
-    await ack(cb)
-
+@rt.message(Command("search"))
+async def search_cmd(msg: Message, command: CommandObject):
+    await _touch_user(msg.from_user.id)
+    query = (command.args or "").strip()[:200]
+    if not query:
+        await msg.answer(
+            "Напиши, что ищем: <code>/search имя, игра или категория</code>\n"
+            "Например: <code>/search валорант</code>"
+        )
+        return
     mf = await get_manifest()
-    picks = pick_free_today(mf, limit=5)
-    if not picks:
-        await cb.message.answer(
-            "На сегодня свободных окон пока нет 😕\n"
-            "Можешь посмотреть весь каталог и выбрать удобное время.",
+    found = search_girls(mf, query, limit=8)
+    if not found:
+        await msg.answer(
+            f"По запросу «{html.escape(query)}» никого не нашлось 😕",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="👩 Открыть анкеты", callback_data="girls:0")],
-                [InlineKeyboardButton(text="🏠 В меню", callback_data="home")]
+                [InlineKeyboardButton(text="🔎 Подобрать под себя", callback_data="find:start")],
+                [InlineKeyboardButton(text="👩 Смотреть всех", callback_data="girls:0")],
             ])
         )
         return
 
+    lines = [f"<b>🔎 Нашёл по запросу «{html.escape(query)}»:</b>"]
+    rows = []
+    for i, g in enumerate(found, start=1):
+        gid = g.get("id")
+        name = html.escape(str(g.get("name", f"#{gid}")))
+        price = _girl_price_num(g)
+        price_text = f"{int(price)} ₽" if price is not None else "цена на сайте"
+        lines.append(f"{i}. <b>{name}</b> • {price_text}")
+        rows.append([InlineKeyboardButton(text=f"💜 {g.get('name', f'#{gid}')}", callback_data=f"girls:{int(g.get('_index', 0))}")])
+    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
+    await msg.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+
+# Готовый ответ "Свободны сегодня": один на всех, пока не сменилась версия манифеста,
+# не прошёл самый ранний из показанных слотов и не наступила полночь.
+_free_today_cache: Optional[Tuple[Any, datetime, str, InlineKeyboardMarkup]] = None
+
+def free_today_invalidate() -> None:
+    global _free_today_cache
+    _free_today_cache = None
+
+def _render_free_today(mf: Dict[str, Any], now: datetime) -> Tuple[str, InlineKeyboardMarkup, datetime]:
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    picks = pick_free_today(mf, limit=5)
+    if not picks:
+        text = (
+            "На сегодня свободных окон пока нет 😕\n"
+            "Можешь посмотреть весь каталог и выбрать удобное время."
+        )
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="👩 Открыть анкеты", callback_data="girls:0")],
+            [InlineKeyboardButton(text="🏠 В меню", callback_data="home")]
+        ])
+        return text, kb, midnight
+
     lines = ["<b>🔥 Свободны сегодня</b>"]
     rows = []
     for i, g in enumerate(picks, start=1):
@@ -4302,7 +5982,28 @@ async def free_today(cb: CallbackQuery):
         rows.append([InlineKeyboardButton(text=f"⚡ {g.get('name', f'#{gid}')}", callback_data=f"girls:{idx}")])
 
     rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="home")])
-    await cb.message.answer("\n".join(lines), reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    # список упорядочен по первому слоту: пока не прошёл самый ранний, состав и порядок те же
+    valid_until = min(midnight, min(g["_first_today_dt"] for g in picks))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows), valid_until
+
+def free_today_view(mf: Dict[str, Any]) -> Tuple[str, InlineKeyboardMarkup]:
+    global _free_today_cache
+    now = _msk_now_naive()
+    key = manifest_index(mf)
+    c = _free_today_cache
+    if c is None or c[0] is not key or now > c[1]:
+        text, kb, valid_until = _render_free_today(mf, now)
+        c = _free_today_cache = (key, valid_until, text, kb)
+    return c[2], c[3]
+
+@rt.callback_query(F.data == "free:today")
+async def free_today(cb: CallbackQuery):
+    await _touch_user(cb.from_user.id)
+    await ack(cb)
+
+    mf = await get_manifest()
+    text, kb = free_today_view(mf)
+    await cb.message.answer(text, reply_markup=kb)
 
 # ─── GIRLS FLOW ──────────────────────────────────────────────────────────────
 @rt.callback_query(F.data.startswith("girls:"))
@@ -4322,8 +6023,7 @@ async def show_girl(cb: CallbackQuery):
     # 1) Только логируем интерес (browse), БЕЗ админ-пинга
     with suppress(Exception):
         await db_add_interest(chat_id=cb.from_user.id, girl_id=gid, source="browse")
-    with suppress(Exception):
-        asyncio.create_task(maybe_send_personal_reco(cb.from_user.id))
+    reco_touch(cb.from_user.id)
 
     # 2) Рендер карточки
     slots = {}
@@ -4340,21 +6040,19 @@ async def show_girl(cb: CallbackQuery):
     img     = g.get("image") or g.get("url")
 
     try:
-        await cb.message.edit_media(
-            InputMediaPhoto(media=img, caption=caption, parse_mode=ParseMode.HTML),
-            reply_markup=kb
-        )
+        await edit_photo_cached(cb.message, img, caption, reply_markup=kb)
     except Exception as e:
         log.info("edit_media failed, sending new photo: %s", e)
-        await cb.message.answer_photo(photo=img, caption=caption, reply_markup=kb)
+        await send_photo_cached(cb.message.chat.id, img, caption=caption, reply_markup=kb)
         with suppress(Exception):
             await cb.message.delete()
 
     # 3) Прогрев
     try:
-        if (await settings_get("GIRL_INTEREST_ON_BROWSE", "0")) == "1":
-            coupon20 = await settings_get("COUPON_20", COUPON_20)
-            trial    = await settings_get("TRIAL_PRICE", TRIAL_PRICE)
+        _, st = settings_snapshot()  # все ключи из одной версии
+        if st.get("GIRL_INTEREST_ON_BROWSE", "0") == "1":
+            coupon20 = st.get("COUPON_20", COUPON_20)
+            trial    = st.get("TRIAL_PRICE", TRIAL_PRICE)
             girl_ctx = {
                 "coupon20": coupon20,
                 "trial_price": trial,
@@ -4415,7 +6113,8 @@ async def show_all_times(cb: CallbackQuery):
             await cb.message.answer(chunk.rstrip("\n"))
 
     # Start "still thinking?" follow-up after 15-30 minutes if user went inactive.
-    asyncio.create_task(schedule_timesall_followup(cb.from_user.id, gid, viewed_at))
+    with suppress(Exception):
+        await schedule_timesall_followup(cb.from_user.id, gid, viewed_at)
 
 @rt.callback_query(F.data.startswith("slotsub:"))
 async def slot_sub_cb(cb: CallbackQuery):
@@ -4639,6 +6338,7 @@ async def send_post_purchase_sequence(order: Dict[str, Any]):
     )
 
 async def checkout_post_purchase_watcher():
+    TG_LANE.set("transactional")  # вотчер — отдельная таска, полоса на весь цикл
     paid_statuses = {"processing", "completed"}
     while True:
         try:
@@ -4672,14 +6372,21 @@ async def checkout_post_purchase_watcher():
         await asyncio.sleep(max(15, POST_PURCHASE_POLL_SEC))
 
 async def slot_subscriptions_watcher():
+    TG_LANE.set("transactional")
+    # (chat_id, girl_id) -> (версия манифеста, версия slot_json) последней завершённой сверки
+    # (записывается после отправки и сохранения known_slots);
+    # новые слоты появляются только с новым содержимым, так что при тех же версиях сверять нечего
+    seen: Dict[Tuple[int, int], Tuple[int, int]] = {}
     while True:
         try:
             subs = await db_slot_subscriptions()
             if subs:
-                mf = await get_manifest(force=True)
+                mf = await get_manifest()
+                live = set()
                 for sub in subs:
                     chat_id = sub["chat_id"]
                     gid = sub["girl_id"]
+                    live.add((chat_id, gid))
                     g = girl_by_id(mf, gid)
                     if not g:
                         continue
@@ -4691,6 +6398,9 @@ async def slot_subscriptions_watcher():
                     except Exception as e:
                         log.warning("slots fetch failed in watcher for girl_id=%s: %s", gid, e)
                         continue
+                    ver = (manifest_version(), slots_version(g.get("slot_json") or ""))
+                    if seen.get((chat_id, gid)) == ver:
+                        continue
 
                     current_keys = collect_available_slot_keys(g, slots)
                     try:
@@ -4705,6 +6415,7 @@ async def slot_subscriptions_watcher():
                     if not new_keys:
                         # Keep known state fresh to prevent stale snapshots.
                         await db_slot_sub_update_known(chat_id, gid, current_keys, touched_notify=False)
+                        seen[(chat_id, gid)] = ver
                         continue
 
                     name = html.escape(str(g.get("name", f"#{gid}")))
@@ -4725,20 +6436,36 @@ async def slot_subscriptions_watcher():
                     kb = InlineKeyboardMarkup(inline_keyboard=[
                         [link_button("⚡ Открыть анкету", deeplink)]
                     ])
-                    with suppress(Exception):
+                    try:
                         await bot.send_message(chat_id, text, reply_markup=kb)
+                    except TelegramForbiddenError:
+                        pass  # бот заблокирован — повторять бессмысленно
+                    except Exception as e:
+                        # версию не запоминаем — на следующем круге сверим и отправим ещё раз
+                        log.warning("slot notify failed chat=%s girl_id=%s: %s", chat_id, gid, e)
+                        continue
                     await db_slot_sub_update_known(chat_id, gid, current_keys, touched_notify=True)
+                    seen[(chat_id, gid)] = ver
+                for key in seen.keys() - live:
+                    del seen[key]
         except Exception as e:
             log.warning("slot_subscriptions_watcher loop failed: %s", e)
 
         await asyncio.sleep(60)
 
 async def slot_channel_news_watcher():
+    TG_LANE.set("transactional")
     if not SLOT_NEWS_CHAT_ID:
         return
+    done_version = -1  # версия манифеста, уже полностью сверенная с каналом
     while True:
         try:
-            mf = await get_manifest(force=True)
+            mf = await get_manifest()
+            ver = manifest_version()
+            if ver == done_version:
+                await asyncio.sleep(60)
+                continue
+            failed = 0
             for g in girls_list(mf):
                 try:
                     gid = int(g.get("id"))
@@ -4766,9 +6493,16 @@ async def slot_channel_news_watcher():
                 kb = InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="⚡ Открыть анкету", url=deeplink)]
                 ])
-                with suppress(Exception):
+                try:
                     await bot.send_message(SLOT_NEWS_CHAT_ID, "\n".join(lines), reply_markup=kb)
+                except Exception as e:
+                    # состояние не трогаем — пост уйдёт на следующем круге
+                    log.warning("slot news post failed girl_id=%s: %s", gid, e)
+                    failed += 1
+                    continue
                 await db_channel_state_set(gid, current_keys, posted_now=True)
+            if not failed:
+                done_version = ver
         except Exception as e:
             log.warning("slot_channel_news_watcher loop failed: %s", e)
 
@@ -4839,7 +6573,7 @@ async def favorites_cb(cb: CallbackQuery):
         img = g.get("image") or g.get("url")
 
         try:
-            await cb.message.answer_photo(photo=img, caption=caption, reply_markup=kb)
+            await send_photo_cached(cb.message.chat.id, img, caption=caption, reply_markup=kb)
         except Exception as e:
             log.warning("favorites open answer_photo failed: %s", e)
             await cb.message.answer(caption, reply_markup=kb)
@@ -4976,10 +6710,421 @@ async def inbox_private(msg: Message):
     # остальное игнорим (или добавляй свою общую логику)
     return
 
+# ─── BROADCAST JOBS ──────────────────────────────────────────────────────────
+# Рассылка — строка в broadcast_jobs. Получатели читаются страницами по
+# BCAST_PAGE (keyset по users.chat_id, без списка всех id в памяти), страница
+# отправляется BCAST_CONCURRENCY воркерами, темп и RetryAfter — на send gate
+# (полоса broadcast). После страницы курсор и счётчики пишутся в БД, так что
+# после рестарта рассылка продолжается с места (повториться может только
+# недописанная страница). Пауза/отмена останавливают выдачу получателей,
+# дожидаются начатых отправок и сохраняют курсор.
+_BCAST_TASKS: Dict[int, asyncio.Task] = {}
+_BCAST_STOP: Dict[int, str] = {}  # job_id -> 'paused' | 'cancelled'
+
+def _bcast_since(segment: str) -> Optional[int]:
+    now = int(time.time())
+    if segment == "active7":
+        return now - 7 * 86400
+    if segment == "active30":
+        return now - 30 * 86400
+    return None
+
+def _bcast_where(since: Optional[int]) -> Tuple[str, Tuple[Any, ...]]:
+    # заблокировавших бота не трогаем — всё равно будет Forbidden
+    if since is None:
+        return "blocked_at IS NULL", ()
+    return "last_seen>=? AND blocked_at IS NULL", (since,)
+
+async def db_bcast_job_get(job_id: int) -> Optional[Dict[str, Any]]:
+    def _op(con):
+        cur = con.execute("SELECT * FROM broadcast_jobs WHERE id=?", (job_id,))
+        row = cur.fetchone()
+        return dict(zip([d[0] for d in cur.description], row)) if row else None
+    return await db_run(_op)
+
+async def db_bcast_job_update(job_id: int, **fields):
+    fields["updated_at"] = int(time.time())
+    cols = ", ".join(f"{k}=?" for k in fields)
+    def _op(con):
+        con.execute(f"UPDATE broadcast_jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+    await db_write(_op)
+
+async def db_bcast_recipients(since: Optional[int], after: int, limit: int) -> List[int]:
+    where, args = _bcast_where(since)
+    def _op(con):
+        cur = con.execute(
+            f"SELECT chat_id FROM users WHERE chat_id>? AND {where} ORDER BY chat_id LIMIT ?",
+            (after, *args, limit)
+        )
+        return [r[0] for r in cur.fetchall()]
+    return await db_run(_op)
+
+def _bcast_progress_text(job: Dict[str, Any]) -> str:
+    status = {"running": "идёт", "paused": "пауза", "cancelled": "отменена", "done": "готово"}.get(job["status"], job["status"])
+    done = job["sent"] + job["failed"]
+    pct = f" ({done * 100 // job['total']}%)" if job["total"] else ""
+    return (f"📣 Рассылка #{job['id']} · сегмент {html.escape(job['segment'])}\n"
+            f"Статус: <b>{status}</b>\n"
+            f"Обработано: {done} из ~{job['total']}{pct}\n"
+            f"Ушло: {job['sent']}, ошибок: {job['failed']}")
+
+async def _bcast_progress(job: Dict[str, Any]):
+    if not job.get("admin_chat_id") or not job.get("progress_msg_id"):
+        return
+    with suppress(Exception), tg_lane("transactional"):
+        await bot.edit_message_text(_bcast_progress_text(job), chat_id=job["admin_chat_id"],
+                                    message_id=job["progress_msg_id"],
+                                    reply_markup=kb_bcast_job(job["id"], job["status"]))
+
+async def _bcast_run(job_id: int):
+    TG_LANE.set("broadcast")  # своя таска — контекст не утекает
+    job = await db_bcast_job_get(job_id)
+    if not job or job["status"] != "running":
+        return
+    try:
+        buttons = json.loads(job["buttons_json"]) if job["buttons_json"] else []
+    except Exception:
+        buttons = []
+    kb = kb_from(buttons)
+    photo, text = job["photo"], job["text"]
+    if photo:
+        with tg_lane("transactional"):
+            await media_resolve(photo)  # одна заливка до старта, дальше все шлют file_id
+    last_progress = 0.0
+
+    async def _send_one(uid: int) -> bool:
+        try:
+            if photo:
+                await send_photo_cached(uid, photo, caption=text, reply_markup=kb)
+            else:
+                await bot.send_message(uid, text, reply_markup=kb)
+            return True
+        except Exception as e:
+            log.debug("BCAST #%s: chat=%s failed: %s", job_id, uid, e)
+            return False
+
+    while job_id not in _BCAST_STOP:
+        ids = await db_bcast_recipients(job["seg_since"], job["cursor"], max(1, BCAST_PAGE))
+        if not ids:
+            break
+        pos = 0
+        sent = failed = 0
+
+        async def _worker():
+            nonlocal pos, sent, failed
+            while pos < len(ids) and job_id not in _BCAST_STOP:
+                uid = ids[pos]
+                pos += 1
+                if await _send_one(uid):
+                    sent += 1
+                else:
+                    failed += 1
+
+        await asyncio.gather(*(_worker() for _ in range(min(max(1, BCAST_CONCURRENCY), len(ids)))))
+        # выданы ровно ids[:pos], и все они уже отработали — курсор сдвигаем на них
+        job["cursor"] = ids[pos - 1] if pos else job["cursor"]
+        job["sent"] += sent
+        job["failed"] += failed
+        await db_bcast_job_update(job_id, cursor=job["cursor"], sent=job["sent"], failed=job["failed"])
+        if time.monotonic() - last_progress >= BCAST_PROGRESS_SEC:
+            last_progress = time.monotonic()
+            await _bcast_progress(job)
+
+    job["status"] = _BCAST_STOP.pop(job_id, "done")
+    await db_bcast_job_update(job_id, status=job["status"],
+                              finished_at=int(time.time()) if job["status"] != "paused" else None)
+    log.info("BCAST #%s: %s sent=%s failed=%s", job_id, job["status"], job["sent"], job["failed"])
+    await _bcast_progress(job)
+
+def _bcast_spawn(job_id: int):
+    t = _BCAST_TASKS.get(job_id)
+    if t is not None and not t.done():
+        return
+    task = asyncio.create_task(_bcast_run(job_id))
+    _BCAST_TASKS[job_id] = task
+    task.add_done_callback(lambda _t: _BCAST_TASKS.pop(job_id, None))
+
+async def broadcast_start(admin_chat_id: int, segment: str, text: str, photo: Optional[str],
+                          buttons: List[List[Dict[str, str]]]) -> int:
+    since = _bcast_since(segment)
+    where, args = _bcast_where(since)
+    await last_seen_flush()
+    now = int(time.time())
+    def _op(con):
+        total = con.execute(f"SELECT COUNT(*) FROM users WHERE {where}", args).fetchone()[0]
+        cur = con.execute("""
+            INSERT INTO broadcast_jobs(status, segment, seg_since, text, photo, buttons_json, total,
+                                       admin_chat_id, created_at, updated_at)
+            VALUES('running',?,?,?,?,?,?,?,?,?)
+        """, (segment, since, text, photo, json.dumps(buttons, ensure_ascii=False), total, admin_chat_id, now, now))
+        return cur.lastrowid, total
+    job_id, total = await db_write(_op)
+    job = {"id": job_id, "status": "running", "segment": segment, "total": total, "sent": 0, "failed": 0}
+    with suppress(Exception):
+        m = await bot.send_message(admin_chat_id, _bcast_progress_text(job), reply_markup=kb_bcast_job(job_id, "running"))
+        await db_bcast_job_update(job_id, progress_msg_id=m.message_id)
+    _bcast_spawn(job_id)
+    return job_id
+
+async def broadcast_control(job_id: int, action: str):
+    job = await db_bcast_job_get(job_id)
+    if not job or job["status"] in ("cancelled", "done"):
+        return
+    running = job_id in _BCAST_TASKS
+    if action == "resume":
+        if job["status"] == "paused" and not running:
+            await db_bcast_job_update(job_id, status="running")
+            _BCAST_STOP.pop(job_id, None)
+            _bcast_spawn(job_id)
+            job["status"] = "running"
+            await _bcast_progress(job)
+        return
+    target = "paused" if action == "pause" else "cancelled"
+    if running:
+        _BCAST_STOP[job_id] = target  # раннер сам сохранит курсор и статус
+    elif action == "cancel":
+        await db_bcast_job_update(job_id, status="cancelled", finished_at=int(time.time()))
+        job["status"] = "cancelled"
+        await _bcast_progress(job)
+
+async def broadcast_resume_all():
+    def _op(con):
+        return [r[0] for r in con.execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")]
+    for job_id in await db_run(_op):
+        log.info("BCAST #%s: resuming after restart", job_id)
+        _bcast_spawn(job_id)
+
+# ─── MEDIA WARMER ────────────────────────────────────────────────────────────
+# Заранее заливает фото анкет, чтобы даже первый просмотр шёл по file_id;
+# раз в MEDIA_REVALIDATE_SEC сверяет ETag/хэш и перезаливает изменившиеся.
+async def media_warmer():
+    if MEDIA_WARM_SEC <= 0 or not MEDIA_CACHE_CHAT_ID:
+        return
+    TG_LANE.set("campaign")  # фон: уступаем ответам юзерам
+    last_revalidate = 0.0
+    while True:
+        try:
+            mf = await get_manifest()
+            urls = [g.get("image") for g in girls_list(mf) if g.get("image")]
+            revalidate = time.monotonic() - last_revalidate >= MEDIA_REVALIDATE_SEC
+            stats = await media_warm(urls, revalidate)
+            if revalidate:
+                last_revalidate = time.monotonic()
+            if stats["uploaded"] or stats["changed"] or stats["errors"]:
+                log.info("MEDIA: warm uploaded=%d changed=%d errors=%d", stats["uploaded"], stats["changed"], stats["errors"])
+        except Exception as e:
+            log.warning("media_warmer loop failed: %s", e)
+        await asyncio.sleep(MEDIA_WARM_SEC)
+
+# ─── CO-VIEW MODEL ───────────────────────────────────────────────────────────
+# Догоняет interests порциями по id: для каждого нового просмотра (chat, girl, t)
+# +1 к паре с каждой другой анкетой, которую этот chat смотрел в [t - окно, t).
+# Повторный просмотр той же анкеты в окне пары не умножает. У затронутых анкет
+# пересобирается компактный top-K в coview_topk — его и читают рекомендации.
+def _coview_apply_batch(con: sqlite3.Connection) -> int:
+    window = COVIEW_WINDOW_HOURS * 3600
+    cursor = int(con.execute("SELECT last_interest_id FROM coview_state WHERE id=1").fetchone()[0])
+    rows = con.execute(
+        "SELECT id, chat_id, girl_id, created_at FROM interests WHERE id>? ORDER BY id LIMIT ?",
+        (cursor, COVIEW_BATCH)
+    ).fetchall()
+    if not rows:
+        return 0
+    inc: Dict[Tuple[int, int], int] = {}
+    for iid, chat_id, gid, ts in rows:
+        since = int(ts) - window
+        if con.execute(
+            "SELECT 1 FROM interests WHERE chat_id=? AND girl_id=? AND created_at>=? AND id<? LIMIT 1",
+            (chat_id, gid, since, iid)
+        ).fetchone():
+            continue
+        for (other,) in con.execute(
+            "SELECT DISTINCT girl_id FROM interests WHERE chat_id=? AND created_at>=? AND id<? AND girl_id!=?",
+            (chat_id, since, iid, gid)
+        ):
+            for pair in ((gid, other), (other, gid)):
+                inc[pair] = inc.get(pair, 0) + 1
+    if inc:
+        con.executemany(
+            "INSERT INTO coview_pairs(girl_a, girl_b, cnt) VALUES (?,?,?) "
+            "ON CONFLICT(girl_a, girl_b) DO UPDATE SET cnt = cnt + excluded.cnt",
+            [(a, b, n) for (a, b), n in inc.items()]
+        )
+        now = int(time.time())
+        for gid in {a for a, _ in inc}:
+            top = con.execute(
+                "SELECT girl_b, cnt FROM coview_pairs WHERE girl_a=? ORDER BY cnt DESC, girl_b LIMIT ?",
+                (gid, COVIEW_TOPK)
+            ).fetchall()
+            con.execute(
+                "INSERT INTO coview_topk(girl_id, neighbours, updated_at) VALUES (?,?,?) "
+                "ON CONFLICT(girl_id) DO UPDATE SET neighbours=excluded.neighbours, updated_at=excluded.updated_at",
+                (gid, json.dumps(top, separators=(",", ":")), now)
+            )
+    con.execute("UPDATE coview_state SET last_interest_id=? WHERE id=1", (rows[-1][0],))
+    return len(rows)
+
+async def coview_catch_up() -> int:
+    total = 0
+    while True:
+        n = await db_write(_coview_apply_batch)
+        total += n
+        if n < COVIEW_BATCH:
+            return total
+
+async def coview_updater():
+    if COVIEW_SEC <= 0:
+        return
+    while True:
+        try:
+            n = await coview_catch_up()
+            if n:
+                log.info("COVIEW: applied %d interests", n)
+        except Exception as e:
+            log.warning("coview_updater loop failed: %s", e)
+        await asyncio.sleep(COVIEW_SEC)
+
+def coview_boosts(topk: Dict[int, List[Tuple[int, int]]], viewed_ids: List[int]) -> Dict[int, float]:
+    """girl_id -> прибавка к баллу рекомендации: сумма co-view с просмотренными (по top-K из
+    db_coview_topk), нормированная к RECO_COVIEW_WEIGHT у лучшей."""
+    if RECO_COVIEW_WEIGHT <= 0 or COVIEW_SEC <= 0:
+        return {}
+    acc: Dict[int, int] = {}
+    for gid in dict.fromkeys(viewed_ids):
+        for other, cnt in topk.get(gid, ()):
+            acc[other] = acc.get(other, 0) + cnt
+    if not acc:
+        return {}
+    top = max(acc.values())
+    return {gid: RECO_COVIEW_WEIGHT * cnt / top for gid, cnt in acc.items()}
+
+# ─── DB RETENTION ────────────────────────────────────────────────────────────
+# Логи только растут, а читаются на глубину часов/дней (кулдауны кампаний,
+# анти-спам рекомендаций). Раз в RETENTION_INTERVAL_HOURS старые строки
+# удаляются порциями по RETENTION_CHUNK — каждая порция отдельная короткая
+# операция writer-а, обычные записи проходят между ними. Старые interests
+# перед удалением сворачиваются в interests_daily. Затем incremental_vacuum,
+# ANALYZE и отчёт админу.
+def _retention_rollup_interests(con: sqlite3.Connection, ids_sql: str, params: Tuple[Any, ...]):
+    con.execute(f"""
+        INSERT INTO interests_daily (day, girl_id, source, cnt)
+        SELECT date(created_at, 'unixepoch', '+3 hours'), girl_id, COALESCE(source, ''), COUNT(*)
+        FROM interests WHERE id IN ({ids_sql})
+        GROUP BY 1, 2, 3
+        ON CONFLICT(day, girl_id, source) DO UPDATE SET cnt=cnt+excluded.cnt
+    """, params)
+
+# (таблица, колонка времени, сколько дней хранить, свёртка перед удалением)
+RETENTION_POLICIES: List[Tuple[str, str, int, Optional[Callable[..., None]]]] = [
+    ("campaign_log", "sent_at", CAMPAIGN_LOG_KEEP_DAYS, None),
+    ("interests", "created_at", INTERESTS_KEEP_DAYS, _retention_rollup_interests),
+    ("reco_push_log", "created_at", RECO_PUSH_KEEP_DAYS, None),
+    ("vip_payments", "created_at", VIP_PAYMENTS_KEEP_DAYS, None),
+]
+
+async def _retention_cutoff(table: str, keep_days: int) -> int:
+    keep_sec = keep_days * 86400
+    if table == "campaign_log":
+        # не трогаем окно, в котором _campaign_throttled ещё ищет отправки
+        def _op(con):
+            row = con.execute("SELECT MAX(cooldown_hours) FROM campaigns").fetchone()
+            return int((row and row[0]) or 0)
+        max_cd = max(await db_run(_op), CAMPAIGN_COOLDOWN_HOURS)
+        keep_sec = max(keep_sec, max_cd * 3600)
+    return int(time.time()) - keep_sec
+
+async def _retention_purge(table: str, ts_col: str, cutoff: int,
+                           rollup: Optional[Callable[..., None]]) -> int:
+    ids_sql = f"SELECT id FROM {table} WHERE {ts_col}<? ORDER BY {ts_col} LIMIT ?"
+    params = (cutoff, max(1, RETENTION_CHUNK))
+    def _op(con):
+        if rollup is not None:
+            rollup(con, ids_sql, params)
+        return con.execute(f"DELETE FROM {table} WHERE id IN ({ids_sql})", params).rowcount
+    total = 0
+    while True:
+        n = await db_write(_op)
+        total += n
+        if n < params[1]:
+            return total
+        await asyncio.sleep(0.05)  # отдать writer остальным
+
+def _db_compact(con: sqlite3.Connection) -> Dict[str, Any]:
+    def _size() -> int:
+        return con.execute("PRAGMA page_count").fetchone()[0] * con.execute("PRAGMA page_size").fetchone()[0]
+    before = _size()
+    incremental = con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if incremental:
+        con.execute("PRAGMA incremental_vacuum").fetchall()
+    # без incremental auto_vacuum место освобождается только VACUUM при старте (DB_VACUUM_ON_START=1)
+    con.execute("PRAGMA analysis_limit=1000")
+    con.execute("ANALYZE")
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return {"before": before, "after": _size(), "incremental": incremental}
+
+async def db_retention_run() -> Dict[str, Any]:
+    started = time.monotonic()
+    removed: Dict[str, int] = {}
+    for table, ts_col, keep_days, rollup in RETENTION_POLICIES:
+        if keep_days <= 0:
+            continue
+        try:
+            cutoff = await _retention_cutoff(table, keep_days)
+            removed[table] = await _retention_purge(table, ts_col, cutoff, rollup)
+        except Exception as e:
+            log.warning("RETENTION: %s purge failed: %s", table, e)
+    compact = await db_writer_maintenance(_db_compact)
+    report = {"removed": removed, **compact, "took": time.monotonic() - started}
+    log.info("RETENTION: removed=%s size %d → %d bytes (incremental=%s) in %.1fs",
+             removed, compact["before"], compact["after"], compact["incremental"], report["took"])
+    return report
+
+def _retention_report_text(report: Dict[str, Any]) -> str:
+    mb = lambda b: f"{b / (1024 * 1024):.1f} МБ"
+    lines = ["🧹 <b>Чистка БД</b>"]
+    for table, n in report["removed"].items():
+        note = " (свёрнуто в interests_daily)" if table == "interests" and n else ""
+        lines.append(f"• {table}: −{n}{note}")
+    freed = max(0, report["before"] - report["after"])
+    lines.append(f"Освобождено: {mb(freed)} (файл {mb(report['before'])} → {mb(report['after'])})")
+    if not report["incremental"]:
+        lines.append("auto_vacuum выключен — файл не сжимается, нужен рестарт с DB_VACUUM_ON_START=1")
+    lines.append(f"Время: {report['took']:.1f} с")
+    return "\n".join(lines)
+
+async def db_retention_loop():
+    TG_LANE.set("transactional")
+    if RETENTION_INTERVAL_HOURS <= 0:
+        return
+    await asyncio.sleep(600)  # не в момент старта
+    while True:
+        try:
+            report = await db_retention_run()
+            if ADMIN_CHAT_ID and (any(report["removed"].values()) or report["after"] < report["before"]):
+                with suppress(Exception):
+                    await bot.send_message(ADMIN_CHAT_ID, _retention_report_text(report))
+        except Exception as e:
+            log.warning("db_retention_loop failed: %s", e)
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
 # ─── MAIN ────────────────────────────────────────────────────────────────────
 async def main():
     db_init()
+    http_init()
+    await settings_load()
+    await media_cache_load()
+    await manifest_refresh()
+    asyncio.create_task(manifest_refresher())
     await seed_campaigns_if_empty()
+    asyncio.create_task(last_seen_flusher())
+    asyncio.create_task(db_retention_loop())
+    asyncio.create_task(scheduler_dispatcher())
+    asyncio.create_task(reco_dispatcher())
+    await broadcast_resume_all()
+    asyncio.create_task(media_warmer())
+    asyncio.create_task(coview_updater())
+    if SETTINGS_POLL_SEC > 0:
+        asyncio.create_task(settings_watcher())
     asyncio.create_task(checkout_post_purchase_watcher())
     asyncio.create_task(slot_subscriptions_watcher())
     if SLOT_NEWS_CHAT_ID:
@@ -4989,7 +7134,14 @@ async def main():
         await bot.delete_webhook(drop_pending_updates=True)
     me = await bot.get_me()
     log.info("Bot online: @%s (%s)", me.username, me.id)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        with suppress(Exception):
+            await last_seen_flush()
+        await db_writer_stop()
+        db_close()
+        await http_close()
 
 if __name__ == "__main__":
     asyncio.run(main())
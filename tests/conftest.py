@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# bot.py читает конфиг из окружения при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-token")
+os.environ.setdefault("GIRLS_MANIFEST_URL", "http://127.0.0.1:9/girls.json")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.gettempdir(), "egirlz_bot_test.db"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Чистая база на тест; пулы соединений закрываются после него."""
+    path = tmp_path / "bot.db"
+    monkeypatch.setattr(bot, "DB_PATH", str(path))
+    yield path
+    bot.db_close()
+
+
+@pytest.fixture
+def db(db_path):
+    bot.db_init()
+    return db_path
@@ -0,0 +1,25 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+
+
+def test_batch_failure_reaches_waiters(db, monkeypatch):
+    def broken_connection():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    real_connection = bot._db_writer_connection
+
+    async def scenario():
+        monkeypatch.setattr(bot, "_db_writer_connection", broken_connection)
+        bot.db_write_nowait(lambda con: con.execute("SELECT 1"))
+        with pytest.raises(sqlite3.OperationalError):
+            await asyncio.wait_for(bot.db_write(lambda con: 1), timeout=2)
+        monkeypatch.setattr(bot, "_db_writer_connection", real_connection)
+        # writer жив и дальше принимает записи
+        assert await asyncio.wait_for(bot.db_write(lambda con: 2), timeout=2) == 2
+        await bot.db_writer_stop()
+
+    asyncio.run(scenario())
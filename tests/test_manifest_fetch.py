@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def _patch_upstream(monkeypatch, data):
+    async def fake_get(url, cached):
+        return data, True
+    monkeypatch.setattr(bot, "http_get_json_if_changed", fake_get)
+    for name in ("_manifest_ts", "_manifest_fails", "_manifest_retry_at"):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+
+
+def test_unindexable_manifest_keeps_previous_snapshot(monkeypatch):
+    good = {"girls": [{"id": 1, "name": "Good"}]}
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    monkeypatch.setattr(bot, "_manifest_cache", good)
+    monkeypatch.setattr(bot, "_manifest_version", 7)
+    bot.manifest_index(good)
+    invalidated = []
+    monkeypatch.setattr(bot, "free_today_invalidate", lambda: invalidated.append(1))
+
+    def broken_build(mf):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(bot, "_build_manifest_index", broken_build)
+    _patch_upstream(monkeypatch, {"girls": [{"id": 2, "name": "New"}]})
+    assert asyncio.run(bot._manifest_fetch()) is False
+    assert bot._manifest_cache is good
+    assert bot.manifest_version() == 7
+    assert bot.girl_by_id(bot._manifest_cache, 1)["name"] == "Good"
+    assert not invalidated
+
+
+def test_new_manifest_is_indexed_before_swap(monkeypatch):
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    monkeypatch.setattr(bot, "_manifest_cache", {})
+    monkeypatch.setattr(bot, "_manifest_version", 0)
+    _patch_upstream(monkeypatch, {"girls": [{"id": 5, "name": "Fresh"}]})
+    assert asyncio.run(bot._manifest_fetch()) is True
+    assert bot.manifest_version() == 1
+    assert id(bot._manifest_cache) in bot._mf_indexes
+    assert bot.girl_by_id(bot._manifest_cache, 5)["name"] == "Fresh"
+
+
+def _serve(handler):
+    from aiohttp import web
+
+    async def start():
+        app = web.Application()
+        app.router.add_get("/girls.json", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/girls.json"
+    return start()
+
+
+def test_broken_body_is_not_remembered_as_unchanged(monkeypatch):
+    from aiohttp import web
+
+    good = {"girls": [{"id": 1, "name": "Good"}]}
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    monkeypatch.setattr(bot, "_manifest_cache", good)
+    monkeypatch.setattr(bot, "_manifest_version", 3)
+    monkeypatch.setattr(bot, "_HTTP_VALIDATORS", {})
+    for name in ("_manifest_ts", "_manifest_fails", "_manifest_retry_at"):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+    monkeypatch.setattr(bot, "_manifest_fails", 0)
+
+    async def handler(req):
+        return web.Response(body=b'{"girls": [', headers={"ETag": '"v2"'})
+
+    async def scenario():
+        runner, url = await _serve(handler)
+        monkeypatch.setattr(bot, "GIRLS_MANIFEST_URL", url)
+        try:
+            results = [await bot._manifest_fetch() for _ in range(3)]
+        finally:
+            await bot.http_close()
+            await runner.cleanup()
+        return results
+
+    # каждый опрос заново видит битое тело — это ошибка, а не "не изменилось"
+    assert asyncio.run(scenario()) == [False, False, False]
+    assert bot._manifest_fails == 3
+    assert bot._manifest_cache is good
+    assert not bot._HTTP_VALIDATORS
+
+
+def test_304_without_validators_is_an_error(monkeypatch):
+    from aiohttp import web
+
+    monkeypatch.setattr(bot, "_HTTP_VALIDATORS", {})
+
+    async def handler(req):
+        return web.Response(status=304)
+
+    async def scenario():
+        runner, url = await _serve(handler)
+        try:
+            await bot.http_get_json_if_changed(url, cached=False)
+        finally:
+            await bot.http_close()
+            await runner.cleanup()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
@@ -0,0 +1,57 @@
+import bot
+
+
+def _manifest(n, price=1000):
+    return {"girls": [{"id": i, "name": f"G{i}", "price": price + i, "category_slugs": ["chat"]} for i in range(1, n + 1)]}
+
+
+def test_stale_snapshot_keeps_its_index(monkeypatch):
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    builds = []
+    real_build = bot._build_manifest_index
+
+    def counting_build(mf):
+        builds.append(mf)
+        return real_build(mf)
+
+    monkeypatch.setattr(bot, "_build_manifest_index", counting_build)
+    old = _manifest(5)
+    monkeypatch.setattr(bot, "_manifest_cache", old)
+    old_ix = bot.manifest_index(old)
+
+    new = _manifest(6, price=2000)
+    monkeypatch.setattr(bot, "_manifest_cache", new)  # обновление, пока кто-то держит old
+    new_ix = bot.manifest_index(new)
+    for _ in range(10):
+        assert bot.manifest_index(old) is old_ix
+        assert bot.manifest_index(new) is new_ix
+    assert len(builds) == 2
+    assert bot.girl_by_id(old, 6) is None
+    assert bot.girl_by_id(new, 6)["price"] == 2006
+
+
+def test_current_snapshot_is_never_evicted(monkeypatch):
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    current = _manifest(3)
+    monkeypatch.setattr(bot, "_manifest_cache", current)
+    current_ix = bot.manifest_index(current)
+    for k in range(5):
+        bot.manifest_index(_manifest(2, price=k * 100))
+    assert bot.manifest_index(current) is current_ix
+    assert len(bot._mf_indexes) == bot.MANIFEST_INDEX_KEEP
+
+
+def test_malformed_girl_does_not_break_catalog(monkeypatch):
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    mf = _manifest(4)
+    mf["girls"][1]["acf"] = "n/a"
+    mf["girls"][2]["ops_calendar"] = [{"date": "2026-10-18", "slots": [{"start": 1800, "end": "20:00"}]}]
+    mf["girls"].append("not a girl")
+    for i in range(len(mf["girls"])):
+        assert bot.girl_by_index(mf, i) is not None
+    assert bot.girl_by_id(mf, 1)["name"] == "G1"
+    assert bot.girl_by_id(mf, 4)["name"] == "G4"
+    assert bot.girl_by_id(mf, 2)["acf"] == "n/a"  # в каталоге осталась, в индекс не попала
+    assert bot.girl_rec(mf, 2) is None and bot.girl_rec(mf, 3) is None
+    assert [r.gid for r in bot.girl_recs(mf)] == [1, 4]
+    assert [g["id"] for g in bot.search_girls(mf, "g4")] == [4]
@@ -0,0 +1,89 @@
+import sqlite3
+
+import bot
+
+
+def _make_v0(path):
+    """База как до миграций: users без last_seen/blocked_at, user_version=0."""
+    con = sqlite3.connect(path)
+    con.executescript("""
+        CREATE TABLE users (
+            chat_id     INTEGER PRIMARY KEY,
+            username    TEXT,
+            first_name  TEXT,
+            last_name   TEXT,
+            added_at    INTEGER,
+            last_reason TEXT,
+            last_coupon TEXT
+        );
+        CREATE TABLE interests (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id    INTEGER,
+            girl_id    INTEGER,
+            source     TEXT,
+            created_at INTEGER
+        );
+        INSERT INTO users(chat_id, username, added_at) VALUES (1, 'alice', 1700000000), (2, 'bob', 1700000100);
+        INSERT INTO interests(chat_id, girl_id, source, created_at) VALUES (1, 10, 'browse', 1700000200);
+    """)
+    con.commit()
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 0
+    con.close()
+
+
+def _columns(con, table):
+    return {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+
+
+def _indexes(con):
+    return {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+
+
+def test_upgrade_from_v0(db_path, monkeypatch):
+    _make_v0(db_path)
+    bot.db_init()
+
+    con = sqlite3.connect(db_path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == len(bot.DB_MIGRATIONS) == bot.DB_MIGRATIONS[-1][0]
+    assert {"last_seen", "blocked_at"} <= _columns(con, "users")
+    assert "validator" in _columns(con, "media_cache")
+    assert {
+        "idx_users_last_seen", "idx_interests_chat", "idx_interests_created",
+        "idx_sched_run_at", "idx_broadcast_jobs_status",
+    } <= _indexes(con)
+    assert con.execute("SELECT chat_id, username FROM users ORDER BY chat_id").fetchall() == [(1, "alice"), (2, "bob")]
+    assert con.execute("SELECT chat_id, girl_id FROM interests").fetchall() == [(1, 10)]
+    # старую базу без DB_VACUUM_ON_START не переписываем
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    con.close()
+
+    # вторая инициализация — быстрый путь: ни одна миграция не вызывается
+    def _must_not_run(con):
+        raise AssertionError("migration re-run on a current schema")
+
+    monkeypatch.setattr(bot, "DB_MIGRATIONS", [(v, t, _must_not_run) for v, t, _ in bot.DB_MIGRATIONS])
+    bot.db_init()
+    con = sqlite3.connect(db_path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == len(bot.DB_MIGRATIONS)
+    con.close()
+
+
+def test_fresh_db_gets_full_schema(db_path):
+    bot.db_init()
+    con = sqlite3.connect(db_path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == len(bot.DB_MIGRATIONS)
+    assert {"users", "scheduled_jobs", "coview_pairs", "media_cache"} <= {
+        r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # incremental
+    con.close()
+
+
+def test_vacuum_on_start_enables_incremental(db_path, monkeypatch):
+    _make_v0(db_path)
+    monkeypatch.setattr(bot, "DB_VACUUM_ON_START", 1)
+    bot.db_init()
+    con = sqlite3.connect(db_path)
+    assert con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert con.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 2
+    con.close()
@@ -0,0 +1,82 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+NOW = datetime(2026, 10, 18, 15, 0)
+
+
+def _reference_pick(mf, viewed_ids, limit=3):
+    """Прежний полный перебор O(каталог) из _pick_recommendations — эталон качества."""
+    recs = bot.girl_recs(mf)
+    uniq_viewed = list(dict.fromkeys(viewed_ids))
+    viewed_girls = [g for g in (bot.girl_rec(mf, gid) for gid in uniq_viewed) if g]
+    if len(uniq_viewed) < 2 or len(viewed_girls) < 2:
+        return []
+    pref_tokens = {}
+    prices = []
+    for vg in viewed_girls:
+        for t in vg.style:
+            pref_tokens[t] = pref_tokens.get(t, 0) + 1
+        if vg.price is not None:
+            prices.append(vg.price)
+    target_price = (sum(prices) / len(prices)) if prices else None
+    viewed_set = set(uniq_viewed)
+    scored = []
+    for rec in recs:
+        if rec.gid in viewed_set:
+            continue
+        score = 0.0
+        for t in rec.style:
+            score += pref_tokens.get(t, 0) * 1.5
+        if target_price is not None and rec.price is not None:
+            diff = abs(rec.price - target_price)
+            if diff <= 100:
+                score += 3.0
+            elif diff <= 300:
+                score += 2.0
+            elif diff <= 600:
+                score += 1.0
+        if rec.slots.first(NOW) is not None:
+            score += 0.5
+        scored.append((score, rec.view))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [cand for score, cand in scored if score > 0][:limit]
+
+
+def _synthetic_manifest(n, seed):
+    rnd = random.Random(seed)
+    cats = ["chat", "games", "voice", "anime", "asmr", "bestseller", "main"]
+    games = ["valorant", "dota-2", "cs2", "minecraft", "genshin"]
+    girls = []
+    for i in range(1, n + 1):
+        g = {
+            "id": i,
+            "name": f"G{i}",
+            "category_slugs": rnd.sample(cats, rnd.randint(0, 3)),
+            "acf": {"favorite_games": [f"https://x/{x}.png" for x in rnd.sample(games, rnd.randint(0, 2))]},
+        }
+        if rnd.random() < 0.9:
+            g["price"] = rnd.choice([500, 700, 900, 1000, 1200, 1500, 2000, 3000]) + rnd.choice([0, 50, 99])
+        if rnd.random() < 0.4:
+            day = NOW + timedelta(days=rnd.randint(-1, 2))
+            start = f"{rnd.randint(8, 22):02d}:00"
+            g["ops_calendar"] = [{"date": f"{day:%Y-%m-%d}", "slots": [{"start": start, "end": "23:30"}]}]
+        girls.append(g)
+    return {"girls": girls}
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_sparse_index_matches_reference_scorer(seed, monkeypatch):
+    monkeypatch.setattr(bot, "_mf_indexes", {})
+    monkeypatch.setattr(bot, "_msk_now_naive", lambda: NOW)
+    mf = _synthetic_manifest(600, seed)
+    rnd = random.Random(seed * 101)
+    for _ in range(60):
+        viewed = [rnd.randint(1, 600) for _ in range(rnd.randint(2, 12))]
+        limit = rnd.choice([3, 5, 10])
+        got = [g["id"] for g in bot._pick_recommendations(mf, viewed, limit=limit)]
+        want = [g["id"] for g in _reference_pick(mf, viewed, limit=limit)]
+        assert got == want, (viewed, limit)
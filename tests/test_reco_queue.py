@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import bot
+
+CHATS = list(range(100, 130))
+QUIET = 999
+
+
+def test_browsing_burst_is_debounced_and_batched(monkeypatch):
+    monkeypatch.setattr(bot, "RECO_DEBOUNCE_SEC", 0.05)
+    monkeypatch.setattr(bot, "RECO_EVAL_CONCURRENCY", 3)
+    monkeypatch.setattr(bot, "RECO_COVIEW_WEIGHT", 0)
+    monkeypatch.setattr(bot, "_RECO_DUE", {})
+    monkeypatch.setattr(bot, "_RECO_HEAP", [])
+    monkeypatch.setattr(bot, "_RECO_QUIET", {QUIET: int(time.time()) + 3600})
+    monkeypatch.setattr(bot, "_RECO_STATS", {"touches": 0, "evals": 0, "batches": 0, "sent": 0})
+    calls, sent = [], []
+    in_flight = peak = 0
+
+    async def candidates(chat_ids, limit, within_sec, cooldown_sec):
+        calls.append(list(chat_ids))
+        return {c: [1, 2] for c in chat_ids}, {}
+
+    async def manifest():
+        return {"girls": []}
+
+    async def send_message(chat_id, text, reply_markup=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        sent.append(chat_id)
+
+    async def mark_sent(chat_id):
+        pass
+
+    monkeypatch.setattr(bot, "db_reco_candidates", candidates)
+    monkeypatch.setattr(bot, "get_manifest", manifest)
+    monkeypatch.setattr(bot, "_pick_recommendations", lambda mf, v, limit, coview: [{"id": 3, "name": "Ася"}])
+    monkeypatch.setattr(bot, "db_mark_reco_sent", mark_sent)
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+
+    async def scenario():
+        task = asyncio.create_task(bot.reco_dispatcher())
+        await asyncio.sleep(0)
+        for _ in range(10):  # быстрое листание: 10 кликов подряд в каждом чате
+            for chat_id in CHATS + [QUIET]:
+                bot.reco_touch(chat_id)
+            await asyncio.sleep(0.005)
+        for _ in range(100):
+            if len(sent) == len(CHATS):
+                break
+            await asyncio.sleep(0.02)
+        task.cancel()
+
+    asyncio.run(scenario())
+    evaluated = [c for batch in calls for c in batch]
+    assert sorted(evaluated) == CHATS  # одна оценка на чат, заглушённый чат БД не трогает
+    assert len(calls) == bot._RECO_STATS["batches"]  # одно обращение к БД на пачку
+    assert bot._RECO_STATS["touches"] == 10 * (len(CHATS) + 1)
+    assert sorted(sent) == CHATS
+    assert peak == 3  # отправки упираются в RECO_EVAL_CONCURRENCY, но не выше
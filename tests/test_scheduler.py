@@ -0,0 +1,71 @@
+import asyncio
+import sqlite3
+import time
+
+import bot
+
+
+def test_dispatcher_takes_only_free_slots(db, monkeypatch):
+    monkeypatch.setattr(bot, "SCHED_CONCURRENCY", 5)
+    monkeypatch.setattr(bot, "_SCHED_HEAP", [])
+    monkeypatch.setattr(bot, "_SCHED_IDS", set())
+    monkeypatch.setattr(bot, "_SCHED_LOADED_UNTIL", -1)
+    monkeypatch.setattr(bot, "_SCHED_RUNNING", 0)
+    running, peak, done = 0, 0, []
+
+    async def slow_fire(chat_id, girl_id, viewed_at):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        done.append(chat_id)
+
+    monkeypatch.setattr(bot, "_timesall_followup_fire", slow_fire)
+
+    async def scenario():
+        now = int(time.time())
+        for chat_id in range(40):
+            await bot.scheduler_add("timesall_followup", chat_id, now - 1, payload={"girl_id": 1, "viewed_at": now})
+        task = asyncio.create_task(bot.scheduler_dispatcher())
+        await asyncio.sleep(0.02)
+        # занято 5 мест — остальные строки ещё в таблице и переживут рестарт
+        left = sqlite3.connect(db).execute("SELECT COUNT(*) FROM scheduled_jobs").fetchone()[0]
+        for _ in range(100):
+            if len(done) == 40:
+                break
+            await asyncio.sleep(0.02)
+        task.cancel()
+        await bot.db_writer_stop()
+        return left
+
+    left = asyncio.run(scenario())
+    assert left == 35
+    assert peak == 5
+    assert sorted(done) == list(range(40))
+
+
+def test_blocked_user_jobs_cancelled(db):
+    from aiogram.exceptions import TelegramForbiddenError
+    from aiogram.methods import SendMessage
+
+    async def forbidden(bot_, method):
+        raise TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")
+
+    async def scenario():
+        now = int(time.time())
+        for chat_id in (7, 7, 8):
+            await bot.scheduler_add("timesall_followup", chat_id, now + 3600, payload={"girl_id": 1, "viewed_at": now})
+        try:
+            await bot.tg_send_gate(forbidden, bot.bot, SendMessage(chat_id=7, text="шаг"))
+        except TelegramForbiddenError:
+            pass
+        for _ in range(50):
+            await asyncio.sleep(0.01)
+            if not sqlite3.connect(db).execute("SELECT 1 FROM scheduled_jobs WHERE chat_id=7").fetchone():
+                break
+        await bot.db_writer_stop()
+
+    asyncio.run(scenario())
+    con = sqlite3.connect(db)
+    assert con.execute("SELECT chat_id FROM scheduled_jobs").fetchall() == [(8,)]
@@ -0,0 +1,19 @@
+import asyncio
+
+import bot
+
+
+def test_seeded_defaults_reach_the_snapshot(db, monkeypatch):
+    monkeypatch.setattr(bot, "_SETTINGS", None)
+    monkeypatch.setattr(bot, "_SETTINGS_VERSION", -1)
+
+    async def scenario():
+        await bot.settings_load()  # порядок как в main(): снимок снят до сидирования
+        await bot.seed_campaigns_if_empty()
+        await bot.db_writer_stop()
+
+    asyncio.run(scenario())
+    _, st = bot.settings_snapshot()
+    assert st.get("COUPON_20") == bot.COUPON_20
+    assert st.get("TRIAL_PRICE") == bot.TRIAL_PRICE
+    assert st.get("CAMPAIGN_COOLDOWN_HOURS") == str(bot.CAMPAIGN_COOLDOWN_HOURS)
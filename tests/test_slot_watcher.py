@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def test_failed_notify_is_retried(monkeypatch):
+    girl = {"id": 5, "name": "Ася"}
+    sent, known = [], []
+    rounds = 0
+
+    async def subs():
+        return [{"chat_id": 42, "girl_id": 5, "known_slots": "[]"}]
+
+    async def manifest():
+        return {"girls": [girl]}
+
+    async def send_message(chat_id, text, reply_markup=None):
+        sent.append(chat_id)
+        if len(sent) == 1:
+            raise RuntimeError("network down")
+
+    async def update_known(chat_id, gid, keys, touched_notify):
+        known.append((chat_id, gid, tuple(keys), touched_notify))
+
+    async def sleep(_):
+        nonlocal rounds
+        rounds += 1
+        if rounds == 3:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(bot, "db_slot_subscriptions", subs)
+    monkeypatch.setattr(bot, "get_manifest", manifest)
+    monkeypatch.setattr(bot, "girl_by_id", lambda mf, gid: girl)
+    monkeypatch.setattr(bot, "collect_available_slot_keys", lambda g, slots: ["2026-10-18|18:00|20:00"])
+    monkeypatch.setattr(bot, "db_slot_sub_update_known", update_known)
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    monkeypatch.setattr(bot.asyncio, "sleep", sleep)
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(bot.slot_subscriptions_watcher())
+    # первая отправка упала — версия не запомнена, на втором круге уведомление ушло;
+    # на третьем версия та же — повторов нет
+    assert sent == [42, 42]
+    assert known == [(42, 5, ("2026-10-18|18:00|20:00",), True)]